@@ -11,7 +11,6 @@ from clms.downloadtool.api.services.cdse.cdse_integration import (
 from clms.downloadtool.api.services.datarequest_post.utils import (
     generate_task_group_id,
     get_s3_paths_encoded,
-    get_task_id,
     to_iso8601,
 )
 from clms.downloadtool.utility import IDownloadToolUtility
@@ -46,6 +45,8 @@ def process_cdse_batches(cdse_datasets, user_id):
     cdse_parent_task = {}
     cdse_task_group_id = generate_task_group_id()
     cdse_batch_ids, gpkg_filenames = [], []
+    # Child tasks are registered together with the parent at the end
+    cdse_child_tasks = []
 
     is_failed_in_cdse = False
     for cdse_dataset in cdse_datasets["Datasets"]:
@@ -97,11 +98,8 @@ def process_cdse_batches(cdse_datasets, user_id):
             cdse_data_object["UserID"] = user_id
             cdse_data_object["cdse_task_group_id"] = cdse_task_group_id
 
-            # Post child task to utility
-            utility_response_json = utility.datarequest_post(
-                cdse_data_object)
-            utility_task_id = get_task_id(utility_response_json)
-            log.info("utility_task_id: %s", utility_task_id)
+            # The dataset gets its DatasetPath below, keep it unchanged
+            cdse_child_tasks.append(copy.deepcopy(cdse_data_object))
 
             # Prepare parent task base object (without file-specific info)
             cdse_parent_task = copy.deepcopy(cdse_data_object)
@@ -140,8 +138,10 @@ def process_cdse_batches(cdse_datasets, user_id):
                 "Message": "Failed to create batches in CDSE.",
                 "FinalizationDateTime": now
             })
-        utility_response_json = utility.datarequest_post(cdse_parent_task)
-        utility_task_id = get_task_id(utility_response_json)
-        log.info("utility_task_id: %s", utility_task_id)
+        # Register the child tasks and the parent task in one transaction
+        utility_response_json = utility.datarequest_post_bulk(
+            cdse_child_tasks + [cdse_parent_task]
+        )
+        log.info("utility_task_ids: %s", list(utility_response_json))
 
     return cdse_parent_task, None
@@ -41,6 +41,10 @@ class datarequest_delete(Service):
             self.request.response.setStatus(404)
             return {"status": "error", "msg": response_json}
 
+        if "Error, task already finished" in response_json:
+            self.request.response.setStatus(409)
+            return {"status": "error", "msg": response_json}
+
         # Try to get the FME task id to signal finalization
         fme_task_id = response_json.get("FMETaskId", None)
         if fme_task_id:
@@ -3,18 +3,92 @@
 For HTTP GET operations we can use standard HTTP parameter passing
 (through the URL)
 
+The matching tasks are streamed as a JSON array, so the response size
+does not depend on the worker memory.
 """
+import json
+
 from clms.downloadtool.utility import IDownloadToolUtility
 from plone.restapi.services import Service
+from ZPublisher.Iterators import IUnboundStreamIterator
 from zope.component import getUtility
+from zope.interface import implementer
+
+AVAILABLE_FILTERS = [
+    "Status",
+    "UserID",
+    "TaskID",
+    "FMETaskID",
+    "CDSEBatchID",
+    "cdse_task_role",
+    "cdse_task_group_id",
+]
+
+# Number of tasks encoded in each chunk written to the client
+CHUNK_SIZE = 100
 
 
-AVAILABLE_FILTERS = ["Status", "UserID", "TaskID", "FMETaskID"]
+@implementer(IUnboundStreamIterator)
+class JSONArrayStreamIterator:
+    """Encode the items of an iterable as a JSON array, chunk by chunk.
+
+    The first chunk is encoded on creation, so query errors are raised
+    while the request is still being handled instead of mid-stream.
+    """
+
+    def __init__(self, items, chunk_size=CHUNK_SIZE):
+        self.items = items
+        self._chunks = self._encode(chunk_size)
+        self._first = next(self._chunks)
+
+    def _encode(self, chunk_size):
+        """Yield the encoded array in chunks of chunk_size items"""
+        separator = "["
+        chunk = []
+        for item in self.items:
+            chunk.append(json.dumps(item))
+            if len(chunk) >= chunk_size:
+                yield (separator + ",".join(chunk)).encode("utf-8")
+                separator = ","
+                chunk = []
+        if chunk:
+            yield (separator + ",".join(chunk) + "]").encode("utf-8")
+        elif separator == "[":
+            yield b"[]"
+        else:
+            yield b"]"
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if self._first is not None:
+            chunk, self._first = self._first, None
+            return chunk
+        return next(self._chunks)
+
+    def close(self):
+        """Release the underlying DB cursor when the client goes away"""
+        self._chunks.close()
+        close = getattr(self.items, "close", None)
+        if close is not None:
+            close()
 
 
 class DatarequestInspect(Service):
     """Inspect download requests"""
 
+    def render(self):
+        """Stream the JSON array of matching tasks"""
+        self.check_permission()
+        content = self.reply()
+        self.request.response.setHeader("Content-Type", self.content_type)
+        if isinstance(content, JSONArrayStreamIterator):
+            return content
+        return json.dumps(
+            content, indent=2, sort_keys=True, separators=(", ", ": ")
+        )
+
     def reply(self):
         """JSON endpoint"""
         utility = getUtility(IDownloadToolUtility)
@@ -26,7 +100,9 @@ class DatarequestInspect(Service):
                 query[available_filter] = self.request.get(available_filter)
 
         if query:
-            response_json = utility.datarequest_inspect(**query)
+            response_json = JSONArrayStreamIterator(
+                utility.datarequest_inspect_iter(**query)
+            )
             self.request.response.setStatus(200)
         else:
             response_json = {
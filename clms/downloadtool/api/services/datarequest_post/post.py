@@ -4,11 +4,9 @@ For HTTP GET operations we can use standard HTTP parameter passing
 through the URL)
 """
 from datetime import datetime, timezone, timedelta
-from functools import reduce
 from logging import getLogger
 
 from clms.downloadtool.api.services.utils import (
-    duplicated_values_exist,
     calculate_bounding_box_area,
     get_available_gcs_values,
 )
@@ -372,31 +370,13 @@ class DataRequestPost(Service):
         if total_requested > 5:
             return self.rsp("DOWNLOAD_LIMIT")
 
-        inprogress_requests = utility.datarequest_search(
-            user_id, "In_progress"
-        ).values()
-        queued_requests = utility.datarequest_search(
-            user_id, "Queued"
-        ).values()
-
-        inprogress_datasets = reduce(
-            lambda x, y: x + y,
-            [item.get("Datasets", []) for item in inprogress_requests],
-            [],
-        )
-        queued_datasets = reduce(
-            lambda x, y: x + y,
-            [item.get("Datasets", []) for item in queued_requests],
-            [],
-        )
-
         requested_datasets = (
             general_download_data_object.get("Datasets", []) +
             cdse_datasets.get("Datasets", [])
         )
 
-        if duplicated_values_exist(
-            requested_datasets + inprogress_datasets + queued_datasets
+        if utility.datarequest_duplicated_datasets(
+            user_id, requested_datasets
         ):
             return self.rsp("DUPLICATED")
 
@@ -3,12 +3,25 @@
 For HTTP GET operations we can use standard HTTP parameter passing
 (through the URL)
 
+Returns an object with the tasks of the user keyed by task id. When
+the client paginates, with limit or cursor, it returns a list of the
+tasks, each one with its TaskId, sorted by registration date, and the
+X-Total-Count and X-Next-Cursor headers.
+
+Optional parameters:
+- limit: page size, enables keyset pagination
+- cursor: value of the X-Next-Cursor header of the previous page
+- sort_order: ascending or descending (default) registration date
+- fields: comma separated list of task fields to return
+
 """
 from clms.downloadtool.utility import IDownloadToolUtility
 from plone import api
 from plone.restapi.services import Service
 from zope.component import getUtility
 
+MAX_PAGE_SIZE = 1000
+
 
 class datarequest_search(Service):
     """Search datarequest"""
@@ -26,15 +39,58 @@ class datarequest_search(Service):
 
         user_id = user.getId()
 
-        response_json = utility.datarequest_search(user_id, status)
+        limit = self.request.get("limit")
+        if limit:
+            try:
+                limit = int(limit)
+            except ValueError:
+                limit = 0
+            if not 0 < limit <= MAX_PAGE_SIZE:
+                self.request.response.setStatus(400)
+                return {
+                    "status": "error",
+                    "msg": "Error, limit must be between 1 and {0}".format(
+                        MAX_PAGE_SIZE
+                    ),
+                }
+        else:
+            limit = None
 
-        if "Error, UserID not defined" in response_json:
-            self.request.response.setStatus(400)
-            return {"status": "error", "msg": response_json}
+        fields = self.request.get("fields")
+        if fields:
+            if isinstance(fields, str):
+                fields = fields.split(",")
+            fields = [field.strip() for field in fields if field.strip()]
+        else:
+            fields = None
 
-        if "Error, status not recognized" in response_json:
+        cursor = self.request.get("cursor")
+        response_json = utility.datarequest_search_page(
+            user_id,
+            status,
+            limit=limit,
+            cursor=cursor,
+            sort_order=self.request.get("sort_order") or "descending",
+            fields=fields,
+        )
+
+        if isinstance(response_json, str):
             self.request.response.setStatus(400)
             return {"status": "error", "msg": response_json}
 
+        if limit is None and not cursor:
+            self.request.response.setStatus(200)
+            return {
+                item.pop("TaskId"): item for item in response_json["items"]
+            }
+
+        self.request.response.setHeader(
+            "X-Total-Count", str(response_json["total"])
+        )
+        if response_json["next_cursor"]:
+            self.request.response.setHeader(
+                "X-Next-Cursor", response_json["next_cursor"]
+            )
+
         self.request.response.setStatus(200)
-        return response_json
+        return response_json["items"]
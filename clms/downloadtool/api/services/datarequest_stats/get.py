@@ -0,0 +1,31 @@
+# -*- coding: utf-8 -*-
+"""
+For HTTP GET operations we can use standard HTTP parameter passing
+(through the URL)
+
+Task counts by status, by role and by hour of registration, and the age
+percentiles of the queued tasks, aggregated by the database.
+
+Optional parameters:
+- hours: hours of registration counted in by_hour (default 24)
+
+"""
+from clms.downloadtool.utility import IDownloadToolUtility
+from plone.restapi.services import Service
+from zope.component import getUtility
+
+
+class DatarequestStats(Service):
+    """Download request statistics"""
+
+    def reply(self):
+        """JSON endpoint"""
+        utility = getUtility(IDownloadToolUtility)
+        response_json = utility.datarequest_stats(self.request.get("hours"))
+
+        if isinstance(response_json, str):
+            self.request.response.setStatus(400)
+            return {"status": "error", "msg": response_json}
+
+        self.request.response.setStatus(200)
+        return response_json
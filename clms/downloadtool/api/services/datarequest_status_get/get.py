@@ -3,7 +3,20 @@
 For HTTP GET operations we can use standard HTTP parameter passing
 (through the URL)
 
+Optional parameters:
+- wait: seconds to wait for a change of the task (long polling)
+- since: value of the X-Task-Updated-At header of the previous response,
+  the change to wait for must be newer. It is an ISO 8601 timestamp such
+  as 2026-03-02T10:00:00.123456+00:00, URL-encode it: an unencoded + is
+  read as a space and the value is refused
+
+A waiting request answers 429 with a Retry-After header when too many
+requests are already waiting, see DOWNLOADTOOL_STATUS_MAX_WAITERS, and
+501 when task changes are not notified (DOWNLOADTOOL_DB_NOTIFY or
+DOWNLOADTOOL_CACHE), clients then poll without wait.
+
 """
+from datetime import datetime, timezone
 from logging import getLogger
 
 from clms.downloadtool.utility import IDownloadToolUtility
@@ -12,6 +25,11 @@ from zope.component import getUtility
 
 log = getLogger(__name__)
 
+MAX_WAIT = 60
+
+# Seconds a client should wait before retrying when no waiter is free
+RETRY_AFTER = 5
+
 
 class datarequest_status_get(Service):
     """ Get datarequest status
@@ -26,6 +44,10 @@ class datarequest_status_get(Service):
             self.request.response.setStatus(400)
             return {"status": "error", "msg": "Error, TaskID not defined"}
 
+        wait = self.request.get("wait")
+        if wait:
+            return self.reply_wait(utility, task_id, wait)
+
         response_json = utility.datarequest_status_get(task_id)
         if "Error, task not found" in response_json:
             self.request.response.setStatus(404)
@@ -33,3 +55,52 @@ class datarequest_status_get(Service):
 
         self.request.response.setStatus(200)
         return response_json
+
+    def reply_wait(self, utility, task_id, wait):
+        """ Reply once the task changed or wait seconds elapsed """
+        try:
+            wait = float(wait)
+        except ValueError:
+            wait = -1
+        if not 0 <= wait <= MAX_WAIT:
+            self.request.response.setStatus(400)
+            return {
+                "status": "error",
+                "msg": "Error, wait must be between 0 and {0}".format(
+                    MAX_WAIT
+                ),
+            }
+
+        since = self.request.get("since")
+        if since:
+            try:
+                since = datetime.fromisoformat(since)
+            except ValueError:
+                self.request.response.setStatus(400)
+                return {"status": "error", "msg": "Error, invalid since"}
+            if since.tzinfo is None:
+                since = since.replace(tzinfo=timezone.utc)
+        else:
+            since = None
+
+        response = utility.datarequest_status_wait(task_id, wait, since)
+        if response == "Error, too many waiting requests":
+            self.request.response.setStatus(429)
+            self.request.response.setHeader("Retry-After", str(RETRY_AFTER))
+            return {"status": "error", "msg": response}
+
+        if response == "Error, waiting for changes is not enabled":
+            self.request.response.setStatus(501)
+            return {"status": "error", "msg": response}
+
+        if isinstance(response, str):
+            self.request.response.setStatus(404)
+            return {"status": "error", "msg": response}
+
+        task, updated_at = response
+        if updated_at is not None:
+            self.request.response.setHeader(
+                "X-Task-Updated-At", updated_at.isoformat()
+            )
+        self.request.response.setStatus(200)
+        return task
@@ -95,6 +95,10 @@ class datarequest_status_patch(Service):
             self.request.response.setStatus(404)
             return {"status": "error", "msg": response_json}
 
+        if "Error, task already finished" in response_json:
+            self.request.response.setStatus(409)
+            return {"status": "error", "msg": response_json}
+
         self.request.response.setStatus(200)
 
         return response_json
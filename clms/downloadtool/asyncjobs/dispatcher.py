@@ -0,0 +1,207 @@
+"""Background dispatch of async jobs after commit.
+
+With DOWNLOADTOOL_JOBS_DISPATCH=background the commit of a transaction
+only hands its jobs to a JobDispatcher, whose thread adds them to Redis.
+Redis latency is then not part of the response time of the request.
+"""
+import atexit
+import logging
+import os
+import queue
+import threading
+import time
+
+from clms.downloadtool.storage.metrics import Histogram, render_families
+from clms.downloadtool.storage.pool import env_number
+
+log = logging.getLogger("clms.async")
+
+# Job batches waiting for the dispatcher thread, further batches are
+# sent by the committing thread
+DEFAULT_DISPATCH_QUEUE_SIZE = 1000
+
+# Retries of a failed send, and seconds before the first retry, doubled
+# after each one
+DEFAULT_DISPATCH_RETRIES = 3
+DEFAULT_DISPATCH_RETRY_DELAY = 0.5
+
+# Waiting batches sent together by the dispatcher thread
+DISPATCH_MAX_BATCHES = 50
+
+# Seconds to wait for the waiting jobs at shutdown
+DISPATCH_DRAIN_TIMEOUT = 10.0
+
+_STOP = object()
+
+
+def background_dispatch_enabled():
+    """Return True when jobs are dispatched by a background thread."""
+    return os.environ.get(
+        "DOWNLOADTOOL_JOBS_DISPATCH", ""
+    ).strip() == "background"
+
+
+class JobDispatcher:
+    """Sends job batches from a bounded queue on a daemon thread.
+
+    ``send`` is called with a list of jobs. A failed send is retried with
+    exponential backoff, then the jobs are logged and counted as failed.
+    When the queue is full the submitting thread sends the jobs itself.
+    """
+
+    def __init__(self, send, maxsize=DEFAULT_DISPATCH_QUEUE_SIZE,
+                 retries=DEFAULT_DISPATCH_RETRIES,
+                 retry_delay=DEFAULT_DISPATCH_RETRY_DELAY):
+        self.send = send
+        self.retries = retries
+        self.retry_delay = retry_delay
+        self._queue = queue.Queue(maxsize=maxsize)
+        self._lock = threading.Lock()
+        self._latency = Histogram()
+        self._counters = {
+            "dispatched": 0,
+            "failed": 0,
+            "retried": 0,
+            "overflow": 0,
+        }
+        self._closed = False
+        self._thread = threading.Thread(
+            target=self._run, name="downloadtool-job-dispatcher", daemon=True
+        )
+        self._thread.start()
+
+    def submit(self, jobs):
+        """Hand jobs to the dispatcher thread without waiting."""
+        if not self._closed:
+            try:
+                self._queue.put_nowait((time.monotonic(), list(jobs)))
+                return
+            except queue.Full:
+                pass
+        self._count("overflow")
+        log.warning("Job dispatcher unavailable, sending %s jobs now",
+                    len(jobs))
+        self._send([(time.monotonic(), list(jobs))])
+
+    def _count(self, name, value=1):
+        """Increase a counter."""
+        with self._lock:
+            self._counters[name] += value
+
+    def _send(self, batches):
+        """Send queued batches, retrying failures."""
+        jobs = [job for _, batch in batches for job in batch]
+        delay = self.retry_delay
+        for attempt in range(self.retries + 1):
+            try:
+                self.send(jobs)
+                break
+            except Exception:
+                if attempt == self.retries:
+                    log.exception("Error dispatching jobs %s.", jobs)
+                    self._count("failed", len(jobs))
+                    return
+                self._count("retried")
+                log.warning("Error dispatching %s jobs, retrying in %ss",
+                            len(jobs), delay)
+                time.sleep(delay)
+                delay *= 2
+        now = time.monotonic()
+        with self._lock:
+            self._counters["dispatched"] += len(jobs)
+            for submitted, batch in batches:
+                for _ in batch:
+                    self._latency.observe(now - submitted)
+
+    def _run(self):
+        """Send the queued batches until the stop marker."""
+        while True:
+            batches = [self._queue.get()]
+            while len(batches) < DISPATCH_MAX_BATCHES:
+                try:
+                    batches.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            stop = _STOP in batches
+            batches = [batch for batch in batches if batch is not _STOP]
+            if batches:
+                self._send(batches)
+            if stop:
+                return
+
+    def close(self, timeout=DISPATCH_DRAIN_TIMEOUT):
+        """Send the waiting jobs and stop the thread.
+
+        Returns True when every waiting job was handled in time.
+        """
+        self._closed = True
+        # Blocks while the queue is full, the thread is emptying it
+        self._queue.put(_STOP)
+        self._thread.join(timeout)
+        return not self._thread.is_alive()
+
+    def stats(self):
+        """Return the queue depth and the dispatch counters."""
+        with self._lock:
+            return dict(self._counters, queue_depth=self._queue.qsize())
+
+    def render(self):
+        """Return the dispatcher metrics in the Prometheus text format."""
+        families = []
+
+        def family(name, kind, help_text, samples):
+            families.append((name, kind, help_text, samples))
+
+        stats = self.stats()
+        name = "downloadtool_jobs_queue_depth"
+        family(name, "gauge", "Job batches waiting for the dispatcher.",
+               [(name, (), stats["queue_depth"])])
+        for key, help_text in (
+            ("dispatched", "Jobs added to Redis by the dispatcher."),
+            ("failed", "Jobs dropped after their last retry."),
+            ("retried", "Retried job sends."),
+            ("overflow", "Job sends made by the committing thread."),
+        ):
+            name = "downloadtool_jobs_{0}_total".format(key)
+            family(name, "counter", help_text, [(name, (), stats[key])])
+        name = "downloadtool_jobs_dispatch_latency_seconds"
+        with self._lock:
+            samples = list(self._latency.samples(name, ()))
+        family(name, "histogram", "Time from commit to Redis of jobs.",
+               samples)
+        return render_families(families)
+
+
+_dispatcher = None
+_dispatcher_lock = threading.Lock()
+
+
+def get_dispatcher(send):
+    """Return the process JobDispatcher, started on first use.
+
+    It is drained when the process exits.
+    """
+    global _dispatcher
+    with _dispatcher_lock:
+        if _dispatcher is None:
+            _dispatcher = JobDispatcher(
+                send,
+                maxsize=env_number(
+                    "DOWNLOADTOOL_JOBS_QUEUE_SIZE",
+                    DEFAULT_DISPATCH_QUEUE_SIZE, int
+                ),
+                retries=env_number(
+                    "DOWNLOADTOOL_JOBS_RETRIES", DEFAULT_DISPATCH_RETRIES, int
+                ),
+                retry_delay=env_number(
+                    "DOWNLOADTOOL_JOBS_RETRY_DELAY",
+                    DEFAULT_DISPATCH_RETRY_DELAY,
+                ),
+            )
+            atexit.register(_dispatcher.close)
+        return _dispatcher
+
+
+def current_dispatcher():
+    """Return the process JobDispatcher, None when not started."""
+    return _dispatcher
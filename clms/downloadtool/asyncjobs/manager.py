@@ -14,11 +14,28 @@ logger = logging.getLogger(__name__)
 
 
 class CallbacksDataManager:
-    """Transaction aware data manager for calling callbacks at commit time"""
+    """Transaction aware data manager for calling callbacks at commit time
+
+    One manager is joined to each transaction, see get_data_manager, and
+    runs every callback queued during the transaction at commit. Callbacks
+    are kept as (key, callback) pairs: a callback queued with the key of
+    a pending one replaces it, so only the last one runs. Callbacks with
+    a ``batch`` function are not called one by one, each batch function
+    is called once with the list of its callbacks.
+
+    Callbacks with a ``vote`` function are not run at commit: each vote
+    function is called once with its callbacks when the transaction
+    votes, and an error aborts the transaction. A vote function may
+    return an object whose ``commit`` is called when the transaction
+    finishes and whose ``rollback`` is called when it aborts. The
+    manager sorts after the other resource managers, so it votes last
+    and finishes right after them.
+    """
 
     def __init__(self):
         self.sp = 0
         self.callbacks = []
+        self.voted = []
         self.txn = None
 
     def tpc_begin(self, txn):
@@ -27,10 +44,26 @@ class CallbacksDataManager:
 
     def tpc_finish(self, txn):
         """tpc finish"""
+        voted, self.voted = self.voted, []
+        for prepared in voted:
+            try:
+                prepared.commit()
+            except Exception:
+                logger.exception("Error committing %s.", prepared)
         self.callbacks = []
 
     def tpc_vote(self, txn):
         """tpc vote"""
+        votes = {}
+        for _, callback in self.callbacks:
+            vote = getattr(callback, "vote", None)
+            if vote is not None:
+                votes.setdefault(vote, []).append(callback)
+
+        for vote, callbacks in votes.items():
+            prepared = vote(callbacks)
+            if prepared is not None:
+                self.voted.append(prepared)
 
     def tpc_abort(self, txn):
         """tpc abort"""
@@ -39,6 +72,12 @@ class CallbacksDataManager:
         if self.txn is not None:
             self.txn = None
 
+        voted, self.voted = self.voted, []
+        for prepared in voted:
+            try:
+                prepared.rollback()
+            except Exception:
+                logger.exception("Error rolling back %s.", prepared)
         self.callbacks = []
 
     def abort(self, txn):
@@ -49,14 +88,27 @@ class CallbacksDataManager:
         """commit"""
         self._checkTransaction(txn)
 
-        for callback in self.callbacks:
+        batches = {}
+        for _, callback in self.callbacks:
+            if getattr(callback, "vote", None) is not None:
+                # Run by tpc_vote
+                continue
+            batch = getattr(callback, "batch", None)
+            if batch is not None:
+                batches.setdefault(batch, []).append(callback)
+                continue
             try:
                 callback()
             except Exception:
                 logger.exception("Error executing callback.")
 
+        for batch, callbacks in batches.items():
+            try:
+                batch(callbacks)
+            except Exception:
+                logger.exception("Error executing callbacks %s.", callbacks)
+
         self.txn = None
-        self.callbacks = []
 
     def savepoint(self):
         """savepoint"""
@@ -65,13 +117,18 @@ class CallbacksDataManager:
         return Savepoint(self)
 
     def sortKey(self):
-        """sortKey"""
-        return self.__class__.__name__
+        """sortKey, after the ZODB connections: the vote is the last one
+        and the transactions held by it are short"""
+        return "~" + self.__class__.__name__
 
-    def add(self, callback):
-        """add"""
+    def add(self, callback, key=None):
+        """add, replacing the pending callback with the same key"""
         logger.info("Add callback to queue %s", callback)
-        self.callbacks.append(callback)
+        if key is not None:
+            self.callbacks = [
+                entry for entry in self.callbacks if entry[0] != key
+            ]
+        self.callbacks.append((key, callback))
 
     def _checkTransaction(self, txn):
         """check transaction"""
@@ -102,8 +159,21 @@ class Savepoint:
         self.dm.callbacks = self.callbacks[:]
 
 
-def queue_callback(callback):
-    """queue callback"""
-    cdm = CallbacksDataManager()
-    transaction.get().join(cdm)
-    cdm.add(callback)
+def get_data_manager(txn=None):
+    """Return the CallbacksDataManager of a transaction.
+
+    The manager is created and joined on the first call of a transaction.
+    """
+    txn = txn or transaction.get()
+    try:
+        return txn.data(CallbacksDataManager)
+    except KeyError:
+        cdm = CallbacksDataManager()
+        txn.join(cdm)
+        txn.set_data(CallbacksDataManager, cdm)
+        return cdm
+
+
+def queue_callback(callback, key=None):
+    """queue callback, see CallbacksDataManager.add"""
+    get_data_manager().add(callback, key=key)
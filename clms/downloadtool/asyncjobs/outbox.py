@@ -0,0 +1,148 @@
+"""Transactional outbox of async jobs.
+
+With DOWNLOADTOOL_JOBS_DISPATCH=outbox the jobs of a Zope transaction
+are stored in the outbox table of the download tool repository when the
+transaction votes. A failure to store them aborts the transaction, so
+jobs are not lost when Redis is down. The outbox transaction is
+committed when the Zope transaction finishes and rolled back when it
+aborts, so the jobs of an aborted or retried request are never
+published. A job with a coalescing key replaces the unpublished job
+with the same key.
+
+The jobs are committed with the Zope transaction, not with the task
+rows: the repository writes tasks in transactions of their own, already
+committed when the request ends. A Zope abort keeps the tasks of the
+request without their jobs, and a ConflictError retry writes them
+again. The outbox transaction is held from the vote, the last one of
+the transaction, until the finish: one pooled connection, or the
+SQLite write lock, for a short time.
+
+A relay publishes the stored jobs
+to the bullmq queues in batches, from the downloadtool-outbox-relay
+worker view or as a long running process::
+
+    downloadtool_outbox_relay --interval 1
+
+Delivery is at least once: a job is published again when the relay
+stops between publishing it and deleting it.
+"""
+import argparse
+import json
+import logging
+import os
+import sys
+import time
+
+from clms.downloadtool.storage import get_repository
+
+log = logging.getLogger("clms.async")
+
+# Jobs published per relay transaction
+DEFAULT_RELAY_BATCH_SIZE = 100
+
+# Seconds between polls of the outbox by the relay process
+DEFAULT_RELAY_INTERVAL = 1.0
+
+
+def outbox_enabled():
+    """Return True when jobs are stored in the outbox at commit."""
+    return os.environ.get(
+        "DOWNLOADTOOL_JOBS_DISPATCH", ""
+    ).strip() == "outbox"
+
+
+def _outbox_jobs(jobs):
+    """Return QueuedJobs as outbox job dicts."""
+    # Imported here, queues imports this module
+    from clms.downloadtool.asyncjobs.queues import job_key
+
+    rows = []
+    for job in jobs:
+        key = job_key(job.queue_name, job.job_name, job.data)
+        rows.append({
+            "queue_name": job.queue_name,
+            "job_name": job.job_name,
+            "data": job.data,
+            "opts": job.opts,
+            "job_key": None if key is None else json.dumps(key),
+        })
+    return rows
+
+
+def store_jobs(jobs):
+    """Store QueuedJobs in the outbox of the download tool repository.
+
+    Returns the PreparedOutboxJobs, committed or rolled back with the
+    Zope transaction by the data manager.
+    """
+    # Imported here, the relay process does not load the Zope utility
+    from zope.component import getUtility
+    from clms.downloadtool.utility import IDownloadToolUtility
+
+    return getUtility(IDownloadToolUtility).outbox_prepare_jobs(
+        _outbox_jobs(jobs)
+    )
+
+
+def relay_jobs(repository, publish, batch_size=DEFAULT_RELAY_BATCH_SIZE,
+               max_seconds=None):
+    """Publish outbox jobs in batches until the outbox is empty.
+
+    ``publish`` is called with each batch, see
+    DownloadtoolRepository.relay_outbox_jobs. The relay stops after
+    ``max_seconds`` when given. Returns a dict with the number of
+    published jobs and whether the outbox was emptied.
+    """
+    started = time.monotonic()
+    published = 0
+    while True:
+        if max_seconds is not None and (
+            time.monotonic() - started >= max_seconds
+        ):
+            return {"published": published, "complete": False}
+        count = repository.relay_outbox_jobs(publish, batch_size=batch_size)
+        published += count
+        if count < batch_size:
+            break
+    if published:
+        log.info("Published %s outbox jobs", published)
+    return {"published": published, "complete": True}
+
+
+def main(argv=None):
+    """Run the outbox relay from the command line."""
+    parser = argparse.ArgumentParser(
+        description="Publish the outbox jobs to the bullmq queues."
+    )
+    parser.add_argument(
+        "--batch-size", type=int, default=DEFAULT_RELAY_BATCH_SIZE,
+        help="jobs published per transaction",
+    )
+    parser.add_argument(
+        "--interval", type=float, default=None,
+        help="keep polling the outbox every this many seconds",
+    )
+    args = parser.parse_args(argv)
+    if args.batch_size < 1:
+        parser.error("--batch-size must be at least 1")
+    logging.basicConfig(level=logging.INFO, stream=sys.stderr)
+
+    # Imported here, it needs bullmq
+    from clms.downloadtool.asyncjobs.queues import publish_jobs
+
+    repository = get_repository()
+    if args.interval is None:
+        result = relay_jobs(repository, publish_jobs, args.batch_size)
+        sys.stdout.write(json.dumps(result, sort_keys=True) + "\n")
+        return
+
+    while True:
+        try:
+            relay_jobs(repository, publish_jobs, args.batch_size)
+        except Exception:
+            log.exception("Error publishing outbox jobs.")
+        time.sleep(args.interval)
+
+
+if __name__ == "__main__":
+    main()
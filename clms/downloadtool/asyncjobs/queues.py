@@ -1,14 +1,24 @@
 """Queue integration for CDSE async processing.
 
 Schedules heavy CDSE batch jobs to run asynchronously after
-the Plone transaction commits successfully.
+the Plone transaction commits successfully. All the jobs of a
+transaction are added in one event loop and Redis connection, by the
+committing thread or, with DOWNLOADTOOL_JOBS_DISPATCH=background, by a
+background JobDispatcher. With DOWNLOADTOOL_JOBS_DISPATCH=outbox they
+are stored in the outbox table and published by the outbox relay.
 """
 
 import asyncio
 import os
 import logging
 from bullmq import Queue
+from redis.asyncio import Redis
+from clms.downloadtool.asyncjobs.dispatcher import (
+    background_dispatch_enabled,
+    get_dispatcher,
+)
 from clms.downloadtool.asyncjobs.manager import queue_callback
+from clms.downloadtool.asyncjobs.outbox import outbox_enabled, store_jobs
 
 log = logging.getLogger("clms.async")
 
@@ -21,15 +31,104 @@ REDIS_DB = int(os.environ.get("REDIS_DB", 0))
 redis_opts = dict(host=REDIS_HOST, port=REDIS_PORT, db=REDIS_DB)
 
 # Define all queues used in CLMS async operations
-QUEUES = {
-    "cdse_jobs": Queue("cdse_jobs", {"connection": redis_opts}),
-    "downloadtool_jobs": Queue(
-        "downloadtool_jobs", {"connection": redis_opts}),
-}
+QUEUE_NAMES = ("cdse_jobs", "downloadtool_jobs")
+
+
+# DownloadTool updates of one task where only the last one of a
+# transaction is needed: patches send the whole task object
+COALESCED_OPERATIONS = ("datarequest_status_patch", "datarequest_remove_task")
+
+
+def job_key(queue_name, job_name, data):
+    """Return the (operation, task id) key of coalesced jobs, or None."""
+    if not isinstance(data, dict):
+        return None
+    operation = data.get("operation")
+    if operation not in COALESCED_OPERATIONS:
+        return None
+    updates = data.get("updates")
+    if isinstance(updates, dict):
+        task_id = updates.get("utility_task_id")
+    else:
+        task_id = updates
+    if task_id is None:
+        return None
+    return (queue_name, job_name, operation, str(task_id))
+
+
+def enqueue_jobs(jobs):
+    """Add QueuedJobs to Redis with one event loop and connection.
+
+    The jobs of each queue are sent together by addBulk, in one pipeline.
+    """
+    bulks = {}
+    for job in jobs:
+        bulks.setdefault(job.queue_name, []).append(
+            {"name": job.job_name, "data": job.data, "opts": job.opts}
+        )
+    log.info("Scheduling %s async jobs in queues %s",
+             len(jobs), ", ".join(bulks))
+
+    async def inner():
+        # bullmq reads the replies as text
+        connection = Redis(decode_responses=True, **redis_opts)
+        try:
+            for queue_name, bulk in bulks.items():
+                queue = Queue(queue_name, {"connection": connection})
+                await queue.addBulk(bulk)
+        finally:
+            await connection.aclose()
+
+    asyncio.run(inner())
+
+
+def dispatch_jobs(jobs):
+    """Add QueuedJobs to Redis now, or hand them to the JobDispatcher."""
+    if background_dispatch_enabled():
+        get_dispatcher(enqueue_jobs).submit(jobs)
+    else:
+        enqueue_jobs(jobs)
+
+
+def publish_jobs(rows):
+    """Add the jobs published by the outbox relay to Redis."""
+    enqueue_jobs([QueuedJob(**row) for row in rows])
+
+
+class QueuedJob:
+    """A job to add to Redis after commit.
+
+    The data manager adds all the jobs of a transaction together with
+    ``batch``, calling the job adds it alone. In outbox mode the jobs
+    are stored by ``vote`` instead.
+    """
+
+    batch = staticmethod(dispatch_jobs)
+
+    def __init__(self, queue_name, job_name, data, opts):
+        self.queue_name = queue_name
+        self.job_name = job_name
+        self.data = data
+        self.opts = opts
+
+    @property
+    def vote(self):
+        """Store the job in the outbox when the transaction votes"""
+        return store_jobs if outbox_enabled() else None
+
+    def __call__(self):
+        dispatch_jobs([self])
+
+    def __repr__(self):
+        return "<QueuedJob {0} in {1}>".format(self.job_name, self.queue_name)
 
 
 def queue_job(queue_name, job_name, data, opts=None):
-    """Add a job to Redis to be executed asynchronously *after commit*."""
+    """Add a job to Redis to be executed asynchronously *after commit*.
+
+    A job of a COALESCED_OPERATIONS operation replaces the pending one of
+    the same operation and task.
+    """
 
     opts = opts or {
         "delay": 0,          # Delay in milliseconds
@@ -38,16 +137,11 @@ def queue_job(queue_name, job_name, data, opts=None):
         "lifo": False,       # FIFO queueing
     }
 
-    def callback():
-        log.info("Scheduling async job '%s' in queue '%s'",
-                 job_name, queue_name)
-
-        async def inner():
-            queue = QUEUES[queue_name]
-            await queue.add(job_name, data, opts)
-            await queue.close()
-
-        asyncio.run(inner())
+    if queue_name not in QUEUE_NAMES:
+        raise KeyError(queue_name)
 
     # Use the transaction-aware queue_callback
-    queue_callback(callback)
+    queue_callback(
+        QueuedJob(queue_name, job_name, data, opts),
+        key=job_key(queue_name, job_name, data),
+    )
@@ -12,6 +12,8 @@ from zExceptions import Unauthorized
 from clms.downloadtool.api.services.cdse.cdse_tasks_queue import (
     process_cdse_batches,
 )
+from clms.downloadtool.asyncjobs.dispatcher import current_dispatcher
+from clms.downloadtool.asyncjobs.queues import publish_jobs
 from clms.downloadtool.utility import IDownloadToolUtility
 
 logger = logging.getLogger(__name__)
@@ -111,3 +113,155 @@ class DownloadToolUpdates(BrowserView):
 
         self.request.response.setHeader("Content-Type", "application/json")
         return json.dumps(result)
+
+
+class ArchiveFinishedTasks(BrowserView):
+    """
+        Called periodically by a worker to move old finished tasks to the
+        archive table.
+
+        Optionally receives an object containing:
+        - days (age of the archived tasks, see archive_finished_tasks)
+    """
+
+    def __call__(self):
+        alsoProvides(self.request, IDisableCSRFProtection)
+        check_token_security(self.request)
+
+        with adopt_user(username="admin"):
+            try:
+                data = json.loads(self.request.get("BODY") or "{}")
+                utility = getUtility(IDownloadToolUtility)
+                res = utility.archive_finished_tasks(data.get("days"))
+                if isinstance(res, str):
+                    result = {"error": res}
+                else:
+                    result = dict(res, status="ok")
+
+            except Exception as e:
+                logger.exception("Error while archiving finished tasks.")
+                result = {"error": str(e)}
+
+        self.request.response.setHeader("Content-Type", "application/json")
+        return json.dumps(result)
+
+
+class PurgeExpiredTasks(BrowserView):
+    """
+        Called periodically by a worker to delete tasks past the retention
+        days of their status, in chunks.
+
+        Optionally receives an object containing:
+        - days (retention days by status, see retention_days)
+        - batch_size (tasks deleted per transaction)
+        - pause (seconds to wait between chunks)
+        - max_seconds (stop after this time, the next call goes on)
+    """
+
+    def __call__(self):
+        alsoProvides(self.request, IDisableCSRFProtection)
+        check_token_security(self.request)
+
+        with adopt_user(username="admin"):
+            try:
+                data = json.loads(self.request.get("BODY") or "{}")
+                utility = getUtility(IDownloadToolUtility)
+                res = utility.purge_expired_tasks(
+                    data.get("days"),
+                    batch_size=data.get("batch_size"),
+                    pause=data.get("pause"),
+                    max_seconds=data.get("max_seconds"),
+                )
+                if isinstance(res, str):
+                    result = {"error": res}
+                else:
+                    result = dict(res, status="ok")
+
+            except Exception as e:
+                logger.exception("Error while purging expired tasks.")
+                result = {"error": str(e)}
+
+        self.request.response.setHeader("Content-Type", "application/json")
+        return json.dumps(result)
+
+
+class OutboxRelay(BrowserView):
+    """
+        Called periodically by a worker to publish the outbox jobs to the
+        bullmq queues, see clms.downloadtool.asyncjobs.outbox.
+
+        Optionally receives an object containing:
+        - batch_size (jobs published per transaction)
+        - max_seconds (stop after this time, the next call goes on)
+    """
+
+    def __call__(self):
+        alsoProvides(self.request, IDisableCSRFProtection)
+        check_token_security(self.request)
+
+        try:
+            data = json.loads(self.request.get("BODY") or "{}")
+            utility = getUtility(IDownloadToolUtility)
+            res = utility.relay_outbox_jobs(
+                publish_jobs,
+                batch_size=data.get("batch_size"),
+                max_seconds=data.get("max_seconds"),
+            )
+            if isinstance(res, str):
+                result = {"error": res}
+            else:
+                result = dict(res, status="ok")
+
+        except Exception as e:
+            logger.exception("Error while publishing outbox jobs.")
+            result = {"error": str(e)}
+
+        self.request.response.setHeader("Content-Type", "application/json")
+        return json.dumps(result)
+
+
+class RepositoryMetrics(BrowserView):
+    """
+        Scraped by Prometheus: latency, rows, errors and collisions of the
+        download tool repository calls, in the Prometheus text format.
+
+        Requires DOWNLOADTOOL_METRICS=1.
+    """
+
+    def __call__(self):
+        check_token_security(self.request)
+
+        utility = getUtility(IDownloadToolUtility)
+        res = utility.repository_metrics()
+        if res.startswith("Error"):
+            self.request.response.setStatus(404)
+            self.request.response.setHeader("Content-Type", "text/plain")
+            return res
+
+        self.request.response.setHeader(
+            "Content-Type", "text/plain; version=0.0.4; charset=utf-8"
+        )
+        return res
+
+
+class JobDispatcherMetrics(BrowserView):
+    """
+        Scraped by Prometheus: queue depth, dispatch latency and failures
+        of the background job dispatcher, in the Prometheus text format.
+
+        Requires DOWNLOADTOOL_JOBS_DISPATCH=background.
+    """
+
+    def __call__(self):
+        check_token_security(self.request)
+
+        dispatcher = current_dispatcher()
+        if dispatcher is None:
+            self.request.response.setStatus(404)
+            self.request.response.setHeader("Content-Type", "text/plain")
+            return "Error, the job dispatcher is not running"
+
+        self.request.response.setHeader(
+            "Content-Type", "text/plain; version=0.0.4; charset=utf-8"
+        )
+        return dispatcher.render()
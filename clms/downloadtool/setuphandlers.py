@@ -1,9 +1,18 @@
 # -*- coding: utf-8 -*-
 """ Custom setup
 """
+from logging import getLogger
+
+from clms.downloadtool.storage.cache import unwrap_repository
+from clms.downloadtool.storage.db import DownloadtoolRepository
+from clms.downloadtool.storage.migrations import migrate
+from clms.downloadtool.utility import IDownloadToolUtility
 from Products.CMFPlone.interfaces import INonInstallable
+from zope.component import getUtility
 from zope.interface import implementer
 
+log = getLogger(__name__)
+
 
 @implementer(INonInstallable)
 class HiddenProfiles:
@@ -20,9 +29,25 @@ class HiddenProfiles:
         return ["clms.downloadtool.upgrades"]
 
 
+def migrate_task_storage():
+    """Create or upgrade the PostgreSQL download tasks table"""
+    try:
+        repository = unwrap_repository(
+            getUtility(IDownloadToolUtility)._get_repository()
+        )
+    except RuntimeError:
+        log.warning("Download task storage is not configured, not migrated")
+        return []
+    if not isinstance(repository, DownloadtoolRepository):
+        return []
+    applied = migrate(repository)
+    log.info("Applied download task storage migrations: %s", applied)
+    return applied
+
+
 def post_install(context):
     """Post install script"""
-    # Do something at the end of the installation of this package.
+    migrate_task_storage()
 
 
 def uninstall(context):
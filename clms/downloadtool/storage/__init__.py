@@ -1 +1,21 @@
 """Storage backends for download tasks."""
+
+
+def get_repository():
+    """Return the task repository configured through env.
+
+    A SqliteDownloadtoolRepository when DOWNLOADTOOL_SQLITE_PATH is set,
+    a DownloadtoolRepository otherwise. It is used by the command line
+    tools, which do not load the Zope utility.
+    """
+    # Imported here, the backends import this package
+    from clms.downloadtool.storage.sqlite import (
+        SqliteDownloadtoolRepository,
+        sqlite_path,
+    )
+
+    if sqlite_path():
+        return SqliteDownloadtoolRepository()
+    from clms.downloadtool.storage.db import DownloadtoolRepository
+
+    return DownloadtoolRepository()
@@ -0,0 +1,592 @@
+"""asyncio PostgreSQL storage for download tool tasks.
+
+Same tasks table as DownloadtoolRepository, with coroutine methods on a
+pooled asyncpg connection, for standalone async workers updating tasks
+without going through the Plone views. Requires the ``async`` extra
+(asyncpg).
+
+Only the task reads and writes of a worker are supported: insert_task,
+insert_task_next_id, insert_tasks_bulk, get_task, get_task_with_version,
+has_duplicate_datasets, search_tasks, inspect_tasks, iter_inspect_tasks,
+update_task, transition_task, update_tasks_bulk, delete_task,
+delete_tasks_by_group, delete_all and has_tasks. Paginated searches,
+watch_task, task_stats, the retention jobs (purge_tasks,
+archive_finished_tasks) and the outbox stay on DownloadtoolRepository,
+used by the Plone views and the console scripts.
+"""
+import json
+from contextlib import asynccontextmanager
+
+from clms.downloadtool.storage.db import (
+    ARCHIVE_TABLE_NAME,
+    BULK_FINISHED_SQL,
+    DATASETS_TABLE_NAME,
+    FINISHED_STATUSES,
+    QUERY_COLUMNS,
+    TABLE_NAME,
+    TASK_COLUMNS,
+    TASK_ID_SEQUENCE,
+    TRANSITION_DONE,
+    TRANSITION_INVALID_STATUS,
+    TRANSITION_NOT_FOUND,
+    TRANSITION_PERMISSION_DENIED,
+    _get_dsn,
+    _get_itersize,
+    _now_utc,
+    _synced_columns_sql,
+    _task_columns,
+    _tasks_with_archive,
+    dataset_fingerprints_sql,
+    duplicate_datasets_sql,
+)
+from clms.downloadtool.storage.notify import (
+    ALL_CHANGED,
+    NOTIFY_CHANNEL,
+    notify_enabled,
+)
+from clms.downloadtool.storage.pool import default_pool_size, env_number
+
+try:
+    import asyncpg
+    _ASYNCPG_IMPORT_ERROR = None
+except ImportError as exc:
+    asyncpg = None
+    _ASYNCPG_IMPORT_ERROR = exc
+
+
+def _get_asyncpg():
+    """Return the asyncpg module or raise when unavailable."""
+    if _ASYNCPG_IMPORT_ERROR is not None:
+        raise RuntimeError(
+            "asyncpg is required for async downloadtool storage: {0}".format(
+                _ASYNCPG_IMPORT_ERROR
+            )
+        ) from _ASYNCPG_IMPORT_ERROR
+    return asyncpg
+
+
+async def _init_connection(conn):
+    """Decode and encode JSONB as Python objects."""
+    await conn.set_type_codec(
+        "jsonb", encoder=json.dumps, decoder=json.loads, schema="pg_catalog"
+    )
+
+
+class AsyncDownloadtoolRepository:
+    """asyncio DB access layer for download tool tasks.
+
+    See the module docstring for the supported methods, they take the
+    arguments and return the results of the sync repository.
+
+    The connection pool is created on first use, in the running event
+    loop, with up to ``size`` connections (DOWNLOADTOOL_DB_POOL_SIZE).
+    Use it as an async context manager, or call ``close`` when done.
+    """
+
+    def __init__(self, dsn=None, size=None, notify=None):
+        self.dsn = dsn or _get_dsn()
+        self.asyncpg = _get_asyncpg()
+        if size is None:
+            size = env_number(
+                "DOWNLOADTOOL_DB_POOL_SIZE", default_pool_size(), cast=int
+            )
+        self.size = max(1, int(size))
+        self.notify = notify_enabled() if notify is None else notify
+        self.pool = None
+
+    async def __aenter__(self):
+        await self._get_pool()
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        await self.close()
+
+    async def _get_pool(self):
+        """Return the connection pool, creating it when needed."""
+        if self.pool is None:
+            self.pool = await self.asyncpg.create_pool(
+                self.dsn,
+                min_size=1,
+                max_size=self.size,
+                init=_init_connection,
+            )
+        return self.pool
+
+    async def close(self):
+        """Close the pool connections."""
+        if self.pool is not None:
+            pool, self.pool = self.pool, None
+            await pool.close()
+
+    @asynccontextmanager
+    async def _connection(self):
+        """Yield a pooled connection wrapped in a transaction."""
+        pool = await self._get_pool()
+        async with pool.acquire() as conn:
+            async with conn.transaction():
+                yield conn
+
+    async def _notify(self, conn, changes):
+        """Send change notifications when enabled."""
+        if self.notify and changes:
+            await conn.execute(
+                "SELECT pg_notify($1, change) FROM unnest($2::text[]) "
+                "AS change",
+                NOTIFY_CHANNEL,
+                [json.dumps(change) for change in changes],
+            )
+
+    @staticmethod
+    async def _fingerprint(conn, task_ids, replace=False):
+        """Store the dataset fingerprints of tasks."""
+        if replace:
+            await conn.execute(
+                "DELETE FROM {datasets} "
+                "WHERE task_id = ANY($1::text[])".format(
+                    datasets=DATASETS_TABLE_NAME
+                ),
+                task_ids,
+            )
+        await conn.execute(dataset_fingerprints_sql("$1::text[]"), task_ids)
+
+    async def insert_task(self, task_id, payload):
+        """Insert a task row, returning True if inserted."""
+        columns = _task_columns(payload)
+        columns["updated_at"] = _now_utc()
+        async with self._connection() as conn:
+            inserted = await conn.fetchval(
+                """
+                INSERT INTO {table} (task_id, payload, {columns})
+                VALUES ($1, $2, {values})
+                ON CONFLICT (task_id) DO NOTHING
+                RETURNING task_id
+                """.format(
+                    table=TABLE_NAME,
+                    columns=", ".join(columns),
+                    values=", ".join(
+                        "${0}".format(number)
+                        for number in range(3, len(columns) + 3)
+                    ),
+                ),
+                str(task_id), payload, *columns.values()
+            )
+            if inserted is None:
+                return False
+            if isinstance(payload.get("Datasets"), list):
+                await self._fingerprint(conn, [str(task_id)])
+            await self._notify(conn, [
+                {"task_id": str(task_id), "user_id": columns["user_id"]}
+            ])
+            return True
+
+    async def insert_task_next_id(self, payload):
+        """Insert a task with the next sequence id and return the id."""
+        columns = _task_columns(payload)
+        columns["updated_at"] = _now_utc()
+        async with self._connection() as conn:
+            task_id = await conn.fetchval(
+                """
+                INSERT INTO {table} (task_id, payload, {columns})
+                VALUES (nextval('{sequence}')::text, $1, {values})
+                RETURNING task_id
+                """.format(
+                    table=TABLE_NAME,
+                    sequence=TASK_ID_SEQUENCE,
+                    columns=", ".join(columns),
+                    values=", ".join(
+                        "${0}".format(number)
+                        for number in range(2, len(columns) + 2)
+                    ),
+                ),
+                payload, *columns.values()
+            )
+            if isinstance(payload.get("Datasets"), list):
+                await self._fingerprint(conn, [task_id])
+            await self._notify(conn, [
+                {"task_id": task_id, "user_id": columns["user_id"]}
+            ])
+            return task_id
+
+    async def insert_tasks_bulk(self, tasks):
+        """Insert several tasks in one statement and transaction.
+
+        Returns the task ids, or None when one of them already exists,
+        like the sync repository.
+        """
+        if not tasks:
+            return []
+        now = _now_utc()
+        missing_ids = sum(1 for task_id, _ in tasks if task_id is None)
+        try:
+            async with self._connection() as conn:
+                next_ids = iter(())
+                if missing_ids:
+                    next_ids = iter(await conn.fetchval(
+                        "SELECT array_agg(nextval('{sequence}')::text) "
+                        "FROM generate_series(1, $1)".format(
+                            sequence=TASK_ID_SEQUENCE
+                        ),
+                        missing_ids,
+                    ))
+                task_ids = []
+                arrays = {name: [] for name in TASK_COLUMNS}
+                for task_id, payload in tasks:
+                    if task_id is None:
+                        task_id = next(next_ids)
+                    task_ids.append(str(task_id))
+                    columns = _task_columns(payload)
+                    columns["updated_at"] = now
+                    columns["task_id"] = str(task_id)
+                    columns["payload"] = json.dumps(payload)
+                    for name in TASK_COLUMNS:
+                        arrays[name].append(columns[name])
+                types = ["text[]"] * len(TASK_COLUMNS)
+                types[TASK_COLUMNS.index("registration_datetime")] = (
+                    "timestamptz[]"
+                )
+                types[TASK_COLUMNS.index("updated_at")] = "timestamptz[]"
+                selected = ["v." + name for name in TASK_COLUMNS]
+                selected[TASK_COLUMNS.index("payload")] = "v.payload::jsonb"
+                await conn.execute(
+                    """
+                    INSERT INTO {table} ({columns})
+                    SELECT {selected}
+                    FROM unnest({arrays}) AS v ({columns})
+                    """.format(
+                        table=TABLE_NAME,
+                        columns=", ".join(TASK_COLUMNS),
+                        selected=", ".join(selected),
+                        arrays=", ".join(
+                            "${0}::{1}".format(number, type_name)
+                            for number, type_name in enumerate(types, 1)
+                        ),
+                    ),
+                    *arrays.values()
+                )
+                fingerprinted = [
+                    task_id for task_id, (_, payload) in zip(task_ids, tasks)
+                    if isinstance(payload.get("Datasets"), list)
+                ]
+                if fingerprinted:
+                    await self._fingerprint(conn, fingerprinted)
+                await self._notify(conn, [
+                    {"task_id": task_id, "user_id": user_id}
+                    for task_id, user_id in zip(task_ids, arrays["user_id"])
+                ])
+        except self.asyncpg.UniqueViolationError:
+            return None
+        return task_ids
+
+    async def get_task(self, task_id):
+        """Fetch a task payload by task id."""
+        row = await self.get_task_with_version(task_id)
+        return row[0] if row else None
+
+    async def get_task_with_version(self, task_id):
+        """Fetch (payload, updated_at) of a task, None when missing."""
+        async with self._connection() as conn:
+            row = await conn.fetchrow(
+                "SELECT payload, updated_at FROM {table} WHERE task_id = $1 "
+                "UNION ALL "
+                "SELECT payload, updated_at FROM {archive} "
+                "WHERE task_id = $1 LIMIT 1".format(
+                    table=TABLE_NAME, archive=ARCHIVE_TABLE_NAME
+                ),
+                str(task_id),
+            )
+            return tuple(row) if row else None
+
+    async def has_duplicate_datasets(self, user_id, datasets):
+        """Return True when a dataset repeats among the requested ones and
+        those of the user's Queued and In_progress tasks."""
+        async with self._connection() as conn:
+            return await conn.fetchval(
+                duplicate_datasets_sql("$2", "$1::jsonb"),
+                list(datasets), str(user_id)
+            )
+
+    async def search_tasks(self, user_id, status=None):
+        """Return list of (task_id, payload) for a user and status."""
+        params = [str(user_id)]
+        where = "user_id = $1"
+        if status is not None:
+            where += " AND status = $2"
+            params.append(status)
+        source = TABLE_NAME
+        if status is None or status in FINISHED_STATUSES:
+            source = _tasks_with_archive(
+                ("task_id", "payload", "user_id", "status")
+            )
+        async with self._connection() as conn:
+            rows = await conn.fetch(
+                "SELECT task_id, payload FROM {source} WHERE {where}".format(
+                    source=source, where=where
+                ),
+                *params
+            )
+            return [(row[0], row[1]) for row in rows]
+
+    @staticmethod
+    def _inspect_query(query=None):
+        """Return the SQL and params selecting tasks by payload fields."""
+        params = []
+        where = ""
+        if query:
+            conditions = []
+            for key, value in query.items():
+                column = QUERY_COLUMNS.get(key)
+                if column is not None:
+                    params.append(str(value))
+                    conditions.append(
+                        "{0} = ${1}".format(column, len(params))
+                    )
+                else:
+                    params.append({key: value})
+                    conditions.append(
+                        "payload @> ${0}::jsonb".format(len(params))
+                    )
+            where = " WHERE {conds}".format(conds=" OR ".join(conditions))
+        sql = "SELECT task_id, payload FROM {table}{where} ORDER BY task_id"
+        return sql.format(table=TABLE_NAME, where=where), params
+
+    async def inspect_tasks(self, query=None):
+        """Return list of (task_id, payload) filtered by payload fields."""
+        sql, params = self._inspect_query(query)
+        async with self._connection() as conn:
+            rows = await conn.fetch(sql, *params)
+            return [(row[0], row[1]) for row in rows]
+
+    async def iter_inspect_tasks(self, query=None, itersize=None):
+        """Yield (task_id, payload) filtered by payload fields.
+
+        Rows are read through a server-side cursor ``itersize`` rows at a
+        time.
+        """
+        sql, params = self._inspect_query(query)
+        async with self._connection() as conn:
+            cursor = conn.cursor(
+                sql, *params, prefetch=itersize or _get_itersize()
+            )
+            async for row in cursor:
+                yield row[0], row[1]
+
+    async def update_task(self, task_id, updates, status=None):
+        """Merge updates into the payload and return the new payload."""
+        async with self._connection() as conn:
+            row = await conn.fetchrow(
+                """
+                UPDATE {table} AS t
+                SET payload = t.payload || v.updates,
+                    status = COALESCE($1::text, t.status),
+                    {synced},
+                    updated_at = $2
+                FROM (SELECT $3::jsonb AS updates) AS v
+                WHERE t.task_id = $4
+                RETURNING t.payload, t.user_id
+                """.format(table=TABLE_NAME, synced=_synced_columns_sql()),
+                status, _now_utc(), updates, str(task_id)
+            )
+            if row is None:
+                return None
+            if "Datasets" in updates:
+                await self._fingerprint(conn, [str(task_id)], replace=True)
+            await self._notify(conn, [
+                {"task_id": str(task_id), "user_id": row[1]}
+            ])
+            return row[0]
+
+    async def transition_task(self, task_id, expected_statuses, updates,
+                              user_id=None, exclude=False):
+        """Merge updates into a task only when its status is expected.
+
+        Returns a tuple (outcome, payload), like the sync repository.
+        """
+        conditions = ["t.task_id = $1"]
+        params = [str(task_id), updates.get("Status"), _now_utc(), updates]
+        if user_id is not None:
+            params.append(str(user_id))
+            conditions.append("t.user_id = ${0}".format(len(params)))
+        if expected_statuses is not None:
+            params.append(list(expected_statuses))
+            if exclude:
+                condition = "NOT (COALESCE(t.status, '') = ANY(${0}))"
+            else:
+                condition = "t.status = ANY(${0})"
+            conditions.append(condition.format(len(params)))
+        async with self._connection() as conn:
+            row = await conn.fetchrow(
+                """
+                WITH current AS (
+                    SELECT payload, user_id FROM {table} WHERE task_id = $1
+                    UNION ALL
+                    SELECT payload, user_id FROM {archive} WHERE task_id = $1
+                    LIMIT 1
+                ), updated AS (
+                    UPDATE {table} AS t
+                    SET payload = t.payload || v.updates,
+                        status = COALESCE($2::text, t.status),
+                        {synced},
+                        updated_at = $3
+                    FROM (SELECT $4::jsonb AS updates) AS v
+                    WHERE {conditions}
+                    RETURNING t.payload, t.user_id
+                )
+                SELECT updated.payload, updated.user_id,
+                       current.payload, current.user_id
+                FROM (SELECT 1) AS one
+                LEFT JOIN updated ON true
+                LEFT JOIN current ON true
+                """.format(
+                    table=TABLE_NAME,
+                    archive=ARCHIVE_TABLE_NAME,
+                    synced=_synced_columns_sql(),
+                    conditions=" AND ".join(conditions),
+                ),
+                *params
+            )
+            payload, owner, current, current_owner = row
+            if payload is None:
+                if current is None:
+                    return TRANSITION_NOT_FOUND, None
+                if user_id is not None and current_owner != str(user_id):
+                    return TRANSITION_PERMISSION_DENIED, current
+                return TRANSITION_INVALID_STATUS, current
+            if "Datasets" in updates:
+                await self._fingerprint(conn, [str(task_id)], replace=True)
+            await self._notify(conn, [
+                {"task_id": str(task_id), "user_id": owner}
+            ])
+            return TRANSITION_DONE, payload
+
+    async def update_tasks_bulk(self, updates):
+        """Merge updates into several payloads in one statement.
+
+        Only the tasks whose payload changes are written and notified,
+        finished tasks keep their status, see the sync repository.
+        Returns a tuple ({task_id: new_payload}, [missing task ids],
+        [skipped finished task ids]).
+        """
+        if not updates:
+            return {}, [], []
+        task_ids = [str(task_id) for task_id in updates]
+        encoded = [json.dumps(changes) for changes in updates.values()]
+        statuses = [changes.get("Status") for changes in updates.values()]
+        async with self._connection() as conn:
+            # The final SELECT sees the tasks as they were before the
+            # UPDATE, the unchanged ones are read from there
+            rows = await conn.fetch(
+                """
+                WITH v AS (
+                    SELECT u.task_id, u.updates::jsonb AS updates, u.status
+                    FROM unnest($2::text[], $3::text[], $4::text[])
+                        AS u (task_id, updates, status)
+                ), changed AS (
+                    UPDATE {table} AS t
+                    SET payload = t.payload || v.updates,
+                        status = COALESCE(v.status, t.status),
+                        {synced},
+                        updated_at = $1
+                    FROM v
+                    WHERE t.task_id = v.task_id
+                    AND t.payload || v.updates <> t.payload
+                    AND NOT ({finished})
+                    RETURNING t.task_id, t.payload, t.user_id
+                )
+                SELECT task_id, payload, user_id, 'changed' FROM changed
+                UNION ALL
+                SELECT t.task_id, t.payload, t.user_id,
+                    CASE WHEN {finished} THEN 'finished'
+                    ELSE 'unchanged' END
+                FROM {table} AS t JOIN v ON t.task_id = v.task_id
+                WHERE t.task_id NOT IN (SELECT task_id FROM changed)
+                """.format(
+                    table=TABLE_NAME,
+                    synced=_synced_columns_sql(),
+                    finished=BULK_FINISHED_SQL.format(finished="$5::text[]"),
+                ),
+                _now_utc(),
+                task_ids,
+                encoded,
+                statuses,
+                list(FINISHED_STATUSES),
+            )
+            changed = {row[0] for row in rows if row[3] == "changed"}
+            refingerprint = [
+                str(task_id) for task_id, task_updates in updates.items()
+                if "Datasets" in task_updates and str(task_id) in changed
+            ]
+            if refingerprint:
+                await self._fingerprint(conn, refingerprint, replace=True)
+            await self._notify(conn, [
+                {"task_id": row[0], "user_id": row[2]}
+                for row in rows if row[3] == "changed"
+            ])
+        updated = {row[0]: row[1] for row in rows if row[3] != "finished"}
+        finished = [row[0] for row in rows if row[3] == "finished"]
+        missing = [
+            task_id for task_id in task_ids
+            if task_id not in updated and task_id not in finished
+        ]
+        return updated, missing, finished
+
+    async def delete_task(self, task_id):
+        """Delete one task by id, returning True when removed."""
+        removed = []
+        async with self._connection() as conn:
+            for table in (TABLE_NAME, ARCHIVE_TABLE_NAME):
+                removed.extend(await conn.fetch(
+                    "DELETE FROM {table} WHERE task_id = $1 "
+                    "RETURNING user_id".format(table=table),
+                    str(task_id),
+                ))
+            await self._notify(conn, [
+                {"task_id": str(task_id), "user_id": row[0]}
+                for row in removed
+            ])
+        return bool(removed)
+
+    async def delete_tasks_by_group(self, cdse_task_group_id, role=None):
+        """Delete the tasks of a CDSE task group, optionally by role.
+
+        Returns the list of removed task ids.
+        """
+        params = [str(cdse_task_group_id)]
+        where = "cdse_task_group_id = $1"
+        if role is not None:
+            where += " AND cdse_task_role = $2"
+            params.append(role)
+        async with self._connection() as conn:
+            rows = await conn.fetch(
+                "DELETE FROM {table} WHERE {where} "
+                "RETURNING task_id, user_id".format(
+                    table=TABLE_NAME, where=where
+                ),
+                *params
+            )
+            await self._notify(conn, [
+                {"task_id": row[0], "user_id": row[1]} for row in rows
+            ])
+            return [row[0] for row in rows]
+
+    async def delete_all(self):
+        """Delete all task rows and return the number removed."""
+        removed = 0
+        async with self._connection() as conn:
+            for table in (TABLE_NAME, ARCHIVE_TABLE_NAME):
+                status = await conn.execute(
+                    "DELETE FROM {table}".format(table=table)
+                )
+                removed += int(status.split()[-1])
+            await self._notify(conn, [ALL_CHANGED])
+        return removed
+
+    async def has_tasks(self):
+        """Return True when the tables have at least one task."""
+        async with self._connection() as conn:
+            row = await conn.fetchrow(
+                "SELECT 1 FROM {table} UNION ALL "
+                "SELECT 1 FROM {archive} LIMIT 1".format(
+                    table=TABLE_NAME, archive=ARCHIVE_TABLE_NAME
+                )
+            )
+            return row is not None
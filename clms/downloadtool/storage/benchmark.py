@@ -0,0 +1,475 @@
+"""Benchmark of the task repositories with synthetic tasks.
+
+Tasks are generated like the ones registered by DataRequestPost and by
+process_cdse_batches, loaded into each backend and used to time the
+repository calls of the download tool. Results are written as JSON
+lines, one per backend, size and operation::
+
+    downloadtool_benchmark --sizes 10000,100000 --backends memory,sqlite
+
+PostgreSQL is benchmarked when DOWNLOADTOOL_BENCHMARK_DSN is set. Its
+tasks table must be empty, the loaded tasks are deleted at the end.
+"""
+import argparse
+import base64
+import json
+import logging
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+import uuid
+from datetime import datetime, timedelta, timezone
+
+from clms.downloadtool.storage.memory import MemoryDownloadtoolRepository
+from clms.downloadtool.storage.metrics import _count_rows
+from clms.downloadtool.storage.schema import TASK_ID_SEQUENCE_START
+from clms.downloadtool.storage.sqlite import SqliteDownloadtoolRepository
+
+log = logging.getLogger(__name__)
+
+DEFAULT_SIZES = (10000, 100000, 1000000)
+DEFAULT_BACKENDS = ("memory", "sqlite", "postgresql")
+
+# Calls timed per operation, and tasks patched per update_tasks_bulk call
+DEFAULT_SAMPLES = 200
+BULK_PATCH_SIZE = 100
+
+# Tasks per insert_tasks_bulk call when loading
+LOAD_BATCH_SIZE = 1000
+
+# Status of the generated tasks, weighted like a long running install
+STATUSES = (
+    ("Finished_ok", 60),
+    ("Finished_nok", 8),
+    ("Cancelled", 7),
+    ("Rejected", 5),
+    ("In_progress", 12),
+    ("Queued", 8),
+)
+
+# Share of CDSE task groups among the generated requests
+CDSE_SHARE = 0.2
+
+FINISHED = ("Finished_ok", "Finished_nok", "Cancelled", "Rejected")
+
+
+def _skewed(rng, items):
+    """Return an item, the first ones are picked more often."""
+    return items[int(len(items) * rng.random() ** 2)]
+
+
+def _encoded_path(rng):
+    """Return a base64 encoded dataset path."""
+    path = "/vsis3/clms/dataset-{0:06d}/{1}.tif".format(
+        rng.randrange(1000000), rng.choice(("raster", "vector", "layer"))
+    )
+    return base64.b64encode(path.encode("utf-8")).decode("utf-8")
+
+
+def _dataset(rng, cdse=False):
+    """Return a requested dataset, as stored by DataRequestPost."""
+    dataset = {
+        "DatasetID": uuid.UUID(int=rng.getrandbits(128)).hex,
+        "DatasetTitle": "Synthetic dataset {0}".format(rng.randrange(500)),
+        "FileStructure": "",
+        "OutputGCS": rng.choice(("EPSG:4326", "EPSG:3035", "EPSG:3857")),
+        "DatasetFormat": rng.choice(("Geotiff", "Netcdf", "Shapefile")),
+        "OutputFormat": rng.choice(("Geotiff", "Netcdf", "GPKG")),
+        "DatasetPath": "" if cdse else _encoded_path(rng),
+        "DatasetSource": "CDSE" if cdse else rng.choice(
+            ("EEA", "WEKEO", "LEGACY", "LandCover")
+        ),
+        "WekeoChoices": "",
+        "Metadata": [
+            "https://sdi.eea.europa.eu/catalogue/copernicus/api/records/"
+            "{0}/formatters/xml?approved=true".format(
+                uuid.UUID(int=rng.getrandbits(128))
+            )
+        ],
+    }
+    if rng.random() < 0.5:
+        dataset["NUTSID"] = "ES{0:03d}".format(rng.randrange(300))
+        dataset["NUTSName"] = "Region {0}".format(dataset["NUTSID"])
+    else:
+        west = rng.uniform(-20.0, 30.0)
+        south = rng.uniform(30.0, 65.0)
+        dataset["BoundingBox"] = [
+            west, south + 5.0, west + 5.0, south
+        ]
+    if cdse or rng.random() < 0.3:
+        start = datetime(2018, 1, 1, tzinfo=timezone.utc) + timedelta(
+            days=rng.randrange(2000)
+        )
+        dataset["TemporalFilter"] = {
+            "StartDate": start.isoformat(),
+            "EndDate": (start + timedelta(days=30)).isoformat(),
+        }
+    return dataset
+
+
+class TaskGenerator:
+    """Deterministic generator of synthetic download tasks.
+
+    Users are skewed, a few of them register most of the requests. The
+    generated task ids, users, FME task ids and CDSE groups are kept to
+    pick the arguments of the timed calls.
+    """
+
+    def __init__(self, size, seed=0):
+        self.size = size
+        self.rng = random.Random(seed)
+        self.users = ["user-{0}".format(number)
+                      for number in range(max(1, size // 20))]
+        self.now = datetime(2025, 1, 1, tzinfo=timezone.utc)
+        self.next_id = TASK_ID_SEQUENCE_START
+        self.task_ids = []
+        self.fme_task_ids = []
+        self.group_ids = []
+
+    def _task_id(self):
+        """Return the next task id."""
+        task_id = str(self.next_id)
+        self.next_id += 1
+        return task_id
+
+    def _user(self):
+        """Return a skewed random user."""
+        return _skewed(self.rng, self.users)
+
+    def _status(self):
+        """Return a weighted random status."""
+        return self.rng.choices(
+            [status for status, _ in STATUSES],
+            [weight for _, weight in STATUSES],
+        )[0]
+
+    def _registered(self):
+        """Return a registration datetime within two years."""
+        return self.now - timedelta(seconds=self.rng.randrange(63072000))
+
+    def request(self):
+        """Return a (task_id, payload) registered by DataRequestPost."""
+        status = self._status()
+        registered = self._registered()
+        payload = {
+            "Datasets": [
+                self._dataset() for _ in range(self.rng.randint(1, 3))
+            ],
+            "Status": status,
+            "UserID": self._user(),
+            "RegistrationDateTime": registered.isoformat(),
+        }
+        if status != "Queued":
+            fme_task_id = str(self.rng.randrange(10 ** 6, 10 ** 7))
+            payload["FMETaskId"] = fme_task_id
+            self.fme_task_ids.append(fme_task_id)
+        if status in FINISHED:
+            payload["FinalizationDateTime"] = (
+                registered + timedelta(minutes=self.rng.randint(1, 600))
+            ).isoformat()
+        if status in ("Finished_nok", "Rejected"):
+            payload["Message"] = "The request could not be processed."
+        if status == "Finished_ok":
+            payload["DownloadURL"] = "https://example.com/{0}.zip".format(
+                uuid.UUID(int=self.rng.getrandbits(128)).hex
+            )
+            payload["FileSize"] = self.rng.randrange(10 ** 4, 10 ** 10)
+        task_id = self._task_id()
+        self.task_ids.append(task_id)
+        return task_id, payload
+
+    def _dataset(self, cdse=False):
+        """Return a requested dataset."""
+        return _dataset(self.rng, cdse=cdse)
+
+    def cdse_group(self):
+        """Return the (task_id, payload) of a CDSE parent and its children.
+
+        They are built like in process_cdse_batches.
+        """
+        user_id = self._user()
+        registered = self._registered().isoformat()
+        group_id = "-".join(
+            "{0:04d}".format(self.rng.randrange(10000)) for _ in range(4)
+        )
+        datasets = [
+            self._dataset(cdse=True)
+            for _ in range(self.rng.randint(1, 2))
+        ]
+        tasks = []
+        batch_ids = []
+        gpkg_names = []
+        for dataset in datasets:
+            for _ in range(self.rng.randint(1, 3)):
+                batch_id = str(uuid.UUID(int=self.rng.getrandbits(128)))
+                gpkg_name = "{0}.gpkg".format(uuid.UUID(
+                    int=self.rng.getrandbits(128)
+                ))
+                batch_ids.append(batch_id)
+                gpkg_names.append(gpkg_name)
+                tasks.append((self._task_id(), {
+                    "UserID": user_id,
+                    "RegistrationDateTime": registered,
+                    "GpkgFileName": gpkg_name,
+                    "CDSEBatchID": batch_id,
+                    "Status": "QUEUED",
+                    "Datasets": dataset,
+                    "cdse_task_role": "child",
+                    "cdse_task_group_id": group_id,
+                }))
+        tasks.append((self._task_id(), {
+            "UserID": user_id,
+            "cdse_task_group_id": group_id,
+            "RegistrationDateTime": registered,
+            "cdse_task_role": "parent",
+            "Status": self._status(),
+            "Datasets": datasets,
+            "CDSEBatchIDs": batch_ids,
+            "GpkgFileNames": gpkg_names,
+        }))
+        self.task_ids.extend(task_id for task_id, _ in tasks)
+        self.group_ids.append(group_id)
+        return tasks
+
+    def __iter__(self):
+        """Yield (task_id, payload) until size tasks are generated."""
+        generated = 0
+        while generated < self.size:
+            if self.rng.random() < CDSE_SHARE:
+                tasks = self.cdse_group()[:self.size - generated]
+            else:
+                tasks = [self.request()]
+            generated += len(tasks)
+            for task in tasks:
+                yield task
+
+
+def _batches(iterable, size):
+    """Yield lists of at most size items."""
+    batch = []
+    for item in iterable:
+        batch.append(item)
+        if len(batch) == size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def _percentile(durations, fraction):
+    """Return a percentile of sorted durations."""
+    index = min(len(durations) - 1, int(round(fraction * len(durations))))
+    return durations[index]
+
+
+def summarize(backend, size, operation, durations, rows):
+    """Return the result record of one timed operation."""
+    durations = sorted(durations)
+    total = sum(durations)
+    return {
+        "backend": backend,
+        "size": size,
+        "operation": operation,
+        "calls": len(durations),
+        "rows": rows,
+        "seconds": total,
+        "mean": total / len(durations) if durations else 0.0,
+        "p50": _percentile(durations, 0.5) if durations else 0.0,
+        "p95": _percentile(durations, 0.95) if durations else 0.0,
+        "p99": _percentile(durations, 0.99) if durations else 0.0,
+        "max": durations[-1] if durations else 0.0,
+        "calls_per_second": len(durations) / total if total else 0.0,
+    }
+
+
+def _timed(calls):
+    """Run (function, args) calls, return their durations and rows."""
+    durations = []
+    rows = 0
+    for function, args in calls:
+        started = time.perf_counter()
+        result = function(*args)
+        durations.append(time.perf_counter() - started)
+        rows += _count_rows(function.__name__, result)
+    return durations, rows
+
+
+def run_benchmark(repository, backend, size, samples=DEFAULT_SAMPLES,
+                  seed=0):
+    """Load size synthetic tasks into repository and time its calls.
+
+    Returns the list of result records, see ``summarize``.
+    """
+    generator = TaskGenerator(size, seed=seed)
+    rng = random.Random(seed + 1)
+    results = []
+
+    def record(operation, calls):
+        durations, rows = _timed(calls)
+        results.append(summarize(backend, size, operation, durations, rows))
+        log.info("%s %s %s: %.3fs", backend, size, operation,
+                 results[-1]["seconds"])
+
+    record("bulk_insert", (
+        (repository.insert_tasks_bulk, (batch,))
+        for batch in _batches(generator, LOAD_BATCH_SIZE)
+    ))
+    record("insert", [
+        (repository.insert_task, generator.request())
+        for _ in range(samples)
+    ])
+    record("get", [
+        (repository.get_task, (rng.choice(generator.task_ids),))
+        for _ in range(samples)
+    ])
+    record("search", [
+        (repository.search_tasks, (
+            _skewed(rng, generator.users),
+            rng.choice((None, "Queued", "In_progress", "Finished_ok")),
+        ))
+        for _ in range(samples)
+    ])
+    record("inspect", [
+        (repository.inspect_tasks, (
+            {"FMETaskId": rng.choice(generator.fme_task_ids)},
+        ))
+        for _ in range(samples if generator.fme_task_ids else 0)
+    ])
+    record("bulk_patch", [
+        (repository.update_tasks_bulk, ({
+            task_id: {"Status": "In_progress"}
+            for task_id in rng.sample(
+                generator.task_ids,
+                min(BULK_PATCH_SIZE, len(generator.task_ids)),
+            )
+        },))
+        for _ in range(samples)
+    ])
+    record("group_delete", [
+        (repository.delete_tasks_by_group, (group_id,))
+        for group_id in rng.sample(
+            generator.group_ids, min(samples, len(generator.group_ids))
+        )
+    ])
+    return results
+
+
+def _memory_backend():
+    """Yield an empty in-memory repository."""
+    yield MemoryDownloadtoolRepository()
+
+
+def _sqlite_backend():
+    """Yield a repository on a temporary SQLite file."""
+    directory = tempfile.mkdtemp(prefix="downloadtool-benchmark-")
+    repository = SqliteDownloadtoolRepository(
+        os.path.join(directory, "tasks.db")
+    )
+    try:
+        yield repository
+    finally:
+        repository.close()
+        shutil.rmtree(directory)
+
+
+def _postgresql_backend():
+    """Yield the PostgreSQL repository, when configured."""
+    dsn = os.environ.get("DOWNLOADTOOL_BENCHMARK_DSN", "").strip()
+    if not dsn:
+        log.info("DOWNLOADTOOL_BENCHMARK_DSN is not set, skip postgresql")
+        return
+    # Imported here, psycopg2 is only needed for this backend
+    from clms.downloadtool.storage.db import DownloadtoolRepository
+    from clms.downloadtool.storage.migrations import migrate
+
+    repository = DownloadtoolRepository(dsn=dsn, notify=False)
+    migrate(repository)
+    if repository.has_tasks():
+        raise RuntimeError(
+            "The tasks table of DOWNLOADTOOL_BENCHMARK_DSN is not empty"
+        )
+    try:
+        yield repository
+    finally:
+        repository.delete_all()
+
+
+BACKENDS = {
+    "memory": _memory_backend,
+    "sqlite": _sqlite_backend,
+    "postgresql": _postgresql_backend,
+}
+
+
+def benchmark(sizes=DEFAULT_SIZES, backends=DEFAULT_BACKENDS,
+              samples=DEFAULT_SAMPLES, seed=0):
+    """Yield the result records of each backend and size."""
+    for backend in backends:
+        for size in sizes:
+            # Each size starts from an empty repository
+            for repository in BACKENDS[backend]():
+                for result in run_benchmark(
+                    repository, backend, size, samples=samples, seed=seed
+                ):
+                    yield result
+
+
+def _numbers(value):
+    """Parse comma separated numbers."""
+    return tuple(int(number) for number in value.split(",") if number)
+
+
+def _names(value):
+    """Parse comma separated backend names."""
+    names = tuple(name for name in value.split(",") if name)
+    unknown = set(names) - set(BACKENDS)
+    if unknown:
+        raise argparse.ArgumentTypeError(
+            "unknown backends: {0}".format(", ".join(sorted(unknown)))
+        )
+    return names
+
+
+def main(argv=None):
+    """Run the benchmark from the command line."""
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument(
+        "--sizes", type=_numbers, default=DEFAULT_SIZES,
+        help="comma separated numbers of tasks to load",
+    )
+    parser.add_argument(
+        "--backends", type=_names, default=DEFAULT_BACKENDS,
+        help="comma separated backends: memory, sqlite, postgresql",
+    )
+    parser.add_argument(
+        "--samples", type=int, default=DEFAULT_SAMPLES,
+        help="calls timed per operation",
+    )
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument(
+        "--output", default="-", help="JSON lines file, - for stdout",
+    )
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.INFO, stream=sys.stderr)
+
+    started = datetime.now(timezone.utc).isoformat()
+    output = sys.stdout if args.output == "-" else open(
+        args.output, "a", encoding="utf-8"
+    )
+    try:
+        for result in benchmark(
+            args.sizes, args.backends, samples=args.samples, seed=args.seed
+        ):
+            result["started"] = started
+            output.write(json.dumps(result, sort_keys=True) + "\n")
+            output.flush()
+    finally:
+        if output is not sys.stdout:
+            output.close()
+
+
+if __name__ == "__main__":
+    main()
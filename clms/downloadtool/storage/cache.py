@@ -0,0 +1,300 @@
+"""Read-through cache in front of a download tool task repository."""
+import copy
+import os
+import threading
+import time
+from collections import OrderedDict
+
+from clms.downloadtool.storage.db import TRANSITION_DONE
+from clms.downloadtool.storage.metrics import (
+    InstrumentedDownloadtoolRepository,
+)
+from clms.downloadtool.storage.notify import get_listener
+from clms.downloadtool.storage.pool import env_number
+
+DEFAULT_CACHE_SIZE = 10000
+# Bounds staleness when a change notification is lost
+DEFAULT_CACHE_TTL = 30.0
+
+
+def cache_enabled():
+    """Return True when the task cache is enabled through env."""
+    return os.environ.get("DOWNLOADTOOL_CACHE", "").strip() == "1"
+
+
+def cache_settings():
+    """Return the cache keyword arguments configured in environment."""
+    return {
+        "maxsize": env_number(
+            "DOWNLOADTOOL_CACHE_SIZE", DEFAULT_CACHE_SIZE, cast=int
+        ),
+        "ttl": env_number("DOWNLOADTOOL_CACHE_TTL", DEFAULT_CACHE_TTL),
+    }
+
+
+def unwrap_repository(repository):
+    """Return the repository behind cache and metrics wrappers, if any."""
+    while isinstance(repository, (
+        CachedDownloadtoolRepository, InstrumentedDownloadtoolRepository
+    )):
+        repository = repository.repository
+    return repository
+
+
+class CachedDownloadtoolRepository:
+    """Repository wrapper caching get_task and search results.
+
+    search_tasks results and search_tasks_page pages are cached per user.
+
+    Entries are evicted least recently used beyond ``maxsize`` and expire
+    after ``ttl`` seconds. Writes through this wrapper invalidate the
+    entries of the changed tasks right away; writes of other processes
+    are seen through the task change notifications when the wrapped
+    repository has a ``dsn``, otherwise only after ``ttl``. Methods
+    without caching are delegated to the wrapped repository.
+    """
+
+    def __init__(self, repository, maxsize=DEFAULT_CACHE_SIZE,
+                 ttl=DEFAULT_CACHE_TTL, listen=True):
+        self.repository = repository
+        self.maxsize = max(1, int(maxsize))
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        # user_id -> keys of the cached searches and pages of the user
+        self._user_keys = {}
+        self._lock = threading.Lock()
+        # Bumped by invalidations, so values read meanwhile are not stored
+        self._generation = 0
+        self.hits = 0
+        self.misses = 0
+        if listen and getattr(repository, "dsn", None):
+            get_listener(repository).subscribe(self.invalidate)
+
+    def __getattr__(self, name):
+        return getattr(self.repository, name)
+
+    def _get(self, key):
+        """Return (copy of the fresh cached value or None, generation)."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] > time.monotonic():
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return copy.deepcopy(entry[1]), self._generation
+            if entry is not None:
+                self._forget(key)
+            self.misses += 1
+            return None, self._generation
+
+    def _set(self, key, value, generation):
+        """Store a copy of a value read at a cache generation.
+
+        The value is dropped when an invalidation happened since.
+        """
+        with self._lock:
+            if generation != self._generation:
+                return
+            self._entries[key] = (
+                time.monotonic() + self.ttl, copy.deepcopy(value)
+            )
+            self._entries.move_to_end(key)
+            if key[0] != "task":
+                self._user_keys.setdefault(key[1], set()).add(key)
+            while len(self._entries) > self.maxsize:
+                self._forget(next(iter(self._entries)))
+
+    def _forget(self, key):
+        """Drop an entry and its user index reference, lock held."""
+        del self._entries[key]
+        if key[0] == "task":
+            return
+        keys = self._user_keys.get(key[1])
+        if keys is not None:
+            keys.discard(key)
+            if not keys:
+                del self._user_keys[key[1]]
+
+    def invalidate(self, change):
+        """Drop the entries affected by a task change.
+
+        ``change`` has the ``task_id`` and ``user_id`` of a changed task,
+        or is ALL_CHANGED. Searches are dropped by user, or when the user
+        is unknown, every search returning the task. Pages also count
+        the tasks of their user, with an unknown user they are all
+        dropped. Only the keys indexed for the user are visited.
+        """
+        if change.get("all"):
+            self.clear()
+            return
+        task_id = str(change.get("task_id"))
+        user_id = change.get("user_id")
+        with self._lock:
+            self._generation += 1
+            self._entries.pop(("task", task_id), None)
+            if user_id is not None:
+                stale = list(self._user_keys.get(str(user_id), ()))
+            else:
+                stale = [
+                    key for keys in self._user_keys.values() for key in keys
+                    if key[0] == "page" or any(
+                        row[0] == task_id for row in self._entries[key][1]
+                    )
+                ]
+            for key in stale:
+                self._forget(key)
+
+    def clear(self):
+        """Drop every cache entry."""
+        with self._lock:
+            self._generation += 1
+            self._entries.clear()
+            self._user_keys.clear()
+
+    def get_task(self, task_id):
+        """Fetch a task payload by task id."""
+        key = ("task", str(task_id))
+        payload, generation = self._get(key)
+        if payload is None:
+            payload = self.repository.get_task(task_id)
+            if payload is not None:
+                self._set(key, payload, generation)
+        return payload
+
+    def search_tasks(self, user_id, status=None):
+        """Return list of (task_id, payload) for a user and status."""
+        key = ("search", str(user_id), status)
+        rows, generation = self._get(key)
+        if rows is None:
+            rows = [
+                (task_id, payload) for task_id, payload in
+                self.repository.search_tasks(user_id, status=status)
+            ]
+            self._set(key, rows, generation)
+        return rows
+
+    def search_tasks_page(self, user_id, status=None, limit=None, after=None,
+                          descending=True, fields=None):
+        """Return one keyset page of a user's tasks."""
+        key = (
+            "page", str(user_id), status, limit,
+            tuple(after) if after is not None else None,
+            descending,
+            tuple(fields) if fields is not None else None,
+        )
+        page, generation = self._get(key)
+        if page is None:
+            rows, next_after, total = self.repository.search_tasks_page(
+                user_id, status=status, limit=limit, after=after,
+                descending=descending, fields=fields,
+            )
+            page = ([tuple(row) for row in rows], next_after, total)
+            self._set(key, page, generation)
+        return page
+
+    def insert_task(self, task_id, payload):
+        """Insert a task, returning True if inserted."""
+        inserted = self.repository.insert_task(task_id, payload)
+        if inserted:
+            self.invalidate(
+                {"task_id": task_id, "user_id": payload.get("UserID")}
+            )
+        return inserted
+
+    def insert_task_next_id(self, payload):
+        """Insert a task with the next sequence id and return the id."""
+        task_id = self.repository.insert_task_next_id(payload)
+        self.invalidate({"task_id": task_id, "user_id": payload.get("UserID")})
+        return task_id
+
+    def insert_tasks_bulk(self, tasks):
+        """Insert several tasks, returning their ids or None."""
+        task_ids = self.repository.insert_tasks_bulk(tasks)
+        for task_id, (_, payload) in zip(task_ids or (), tasks):
+            self.invalidate(
+                {"task_id": task_id, "user_id": payload.get("UserID")}
+            )
+        return task_ids
+
+    def update_task(self, task_id, updates, status=None):
+        """Merge updates into the payload and return the new payload."""
+        payload = self.repository.update_task(task_id, updates, status=status)
+        if payload is not None:
+            self.invalidate(
+                {"task_id": task_id, "user_id": payload.get("UserID")}
+            )
+        return payload
+
+    def transition_task(self, task_id, expected_statuses, updates,
+                        user_id=None, exclude=False):
+        """Merge updates into a task only when its status is expected."""
+        outcome, payload = self.repository.transition_task(
+            task_id, expected_statuses, updates,
+            user_id=user_id, exclude=exclude,
+        )
+        if outcome == TRANSITION_DONE:
+            self.invalidate(
+                {"task_id": task_id, "user_id": payload.get("UserID")}
+            )
+        return outcome, payload
+
+    def update_tasks_bulk(self, updates):
+        """Merge updates into several payloads."""
+        updated, missing, finished = self.repository.update_tasks_bulk(
+            updates
+        )
+        unchanged = {
+            str(task_id) for task_id, changes in updates.items()
+            if not changes
+        }
+        for task_id, payload in updated.items():
+            if task_id in unchanged:
+                continue
+            self.invalidate(
+                {"task_id": task_id, "user_id": payload.get("UserID")}
+            )
+        return updated, missing, finished
+
+    def delete_task(self, task_id):
+        """Delete one task by id, returning True when removed."""
+        # The user of the task keeps the pages of other users cached
+        payload = self.get_task(task_id)
+        removed = self.repository.delete_task(task_id)
+        self.invalidate({
+            "task_id": task_id,
+            "user_id": payload.get("UserID") if payload else None,
+        })
+        return removed
+
+    def delete_tasks_by_group(self, cdse_task_group_id, role=None):
+        """Delete the tasks of a CDSE task group, optionally by role."""
+        task_ids = self.repository.delete_tasks_by_group(
+            cdse_task_group_id, role=role
+        )
+        for task_id in task_ids:
+            self.invalidate({"task_id": task_id})
+        return task_ids
+
+    def purge_tasks(self, status, older_than, batch_size=1000):
+        """Delete at most batch_size tasks registered before a datetime."""
+        task_ids = self.repository.purge_tasks(
+            status, older_than, batch_size=batch_size
+        )
+        for task_id in task_ids:
+            self.invalidate({"task_id": task_id})
+        return task_ids
+
+    def delete_all(self):
+        """Delete all tasks and return the number removed."""
+        removed = self.repository.delete_all()
+        self.clear()
+        return removed
+
+    def cache_stats(self):
+        """Return cache size, hits and misses."""
+        with self._lock:
+            return {
+                "size": len(self._entries),
+                "maxsize": self.maxsize,
+                "hits": self.hits,
+                "misses": self.misses,
+            }
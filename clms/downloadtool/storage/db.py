@@ -1,8 +1,22 @@
 """PostgreSQL storage for download tool tasks."""
 import json
 import os
+import time
+from contextlib import ExitStack, contextmanager
 from datetime import datetime, timezone
 
+from clms.downloadtool.storage.notify import (
+    ALL_CHANGED,
+    get_watchers,
+    notify_changes,
+    notify_enabled,
+)
+from clms.downloadtool.storage.pool import (
+    ConnectionPool,
+    pool_enabled,
+    pool_settings,
+)
+
 try:
     import psycopg2
     from psycopg2 import extras
@@ -13,6 +27,85 @@ except ImportError as exc:
     _PSYCOPG2_IMPORT_ERROR = exc
 
 TABLE_NAME = "downloadtool_tasks"
+TASK_ID_SEQUENCE = "downloadtool_task_id_seq"
+
+# Finished tasks are moved here by archive_finished_tasks
+ARCHIVE_TABLE_NAME = "downloadtool_tasks_archive"
+
+# Fingerprints of the Datasets of each task, for duplicate detection
+DATASETS_TABLE_NAME = "downloadtool_task_datasets"
+
+# Async jobs waiting to be published to Redis by the outbox relay
+OUTBOX_TABLE_NAME = "downloadtool_job_outbox"
+
+# Fields of an outbox job, the arguments of a bullmq job. A job may also
+# have a job_key: it replaces the unpublished job with the same key.
+OUTBOX_FIELDS = ("queue_name", "job_name", "data", "opts")
+
+# Statuses of tasks still waiting for FME or CDSE
+ACTIVE_STATUSES = ("Queued", "In_progress")
+
+# Statuses of tasks that will not change anymore
+FINISHED_STATUSES = ("Finished_ok", "Finished_nok", "Cancelled", "Rejected")
+
+# Condition of the bulk updates moving a finished task to another status,
+# on the task table ``t`` and the updates ``v``
+BULK_FINISHED_SQL = (
+    "v.status IS NOT NULL "
+    "AND COALESCE(t.status, '') = ANY({finished}) "
+    "AND t.status <> v.status"
+)
+
+# Outcomes of transition_task
+TRANSITION_DONE = "done"
+TRANSITION_NOT_FOUND = "not_found"
+TRANSITION_PERMISSION_DENIED = "permission_denied"
+TRANSITION_INVALID_STATUS = "invalid_status"
+
+# Task roles counted by task_stats, tasks without CDSE role are FME tasks
+STATS_ROLES = (("parent", "cdse_parent"), ("child", "cdse_child"))
+STATS_DEFAULT_ROLE = "fme"
+
+# Percentiles of the age in seconds of Queued and In_progress tasks
+QUEUE_AGE_PERCENTILES = (0.5, 0.9, 0.99)
+
+# Serializes archive jobs, which create the monthly archive partitions
+ARCHIVE_LOCK_ID = 4733202
+
+# Rows fetched per round trip by server-side cursors
+DEFAULT_ITERSIZE = 2000
+
+# Indexed columns copied from payload keys, kept in sync on update
+PAYLOAD_COLUMNS = (
+    ("fme_task_id", "FMETaskId"),
+    ("cdse_batch_id", "CDSEBatchID"),
+    ("cdse_task_role", "cdse_task_role"),
+    ("cdse_task_group_id", "cdse_task_group_id"),
+)
+
+# inspect_tasks filters answered by indexed columns instead of payload
+QUERY_COLUMNS = {
+    "Status": "status",
+    "UserID": "user_id",
+    "FMETaskID": "fme_task_id",
+    "FMETaskId": "fme_task_id",
+    "CDSEBatchID": "cdse_batch_id",
+    "cdse_task_role": "cdse_task_role",
+    "cdse_task_group_id": "cdse_task_group_id",
+}
+
+# Keyset pagination order, tasks without registration date sort first
+SORT_KEY = "COALESCE(registration_datetime, '-infinity')"
+
+# Columns shared by the tasks table and the archive table
+TASK_COLUMNS = (
+    "task_id",
+    "payload",
+    "user_id",
+    "status",
+    "registration_datetime",
+    "updated_at",
+) + tuple(column for column, _ in PAYLOAD_COLUMNS)
 
 
 def _get_psycopg2():
@@ -34,6 +127,15 @@ def _get_dsn():
     return dsn
 
 
+def _get_itersize():
+    """Return the server-side cursor batch size from environment."""
+    value = os.environ.get("DOWNLOADTOOL_DB_ITERSIZE", "").strip()
+    try:
+        return max(1, int(value)) if value else DEFAULT_ITERSIZE
+    except ValueError:
+        return DEFAULT_ITERSIZE
+
+
 def _parse_datetime(value):
     """Parse ISO-like timestamps into datetime objects."""
     if not value:
@@ -57,22 +159,247 @@ def _now_utc():
 
 def _task_columns(payload):
     """Extract indexed columns from the task payload."""
-    return {
+    columns = {
         "user_id": payload.get("UserID"),
         "status": payload.get("Status"),
-        "cdse_task_group_id": payload.get("cdse_task_group_id"),
         "registration_datetime": _parse_datetime(
             payload.get("RegistrationDateTime")
         ),
     }
+    for column, key in PAYLOAD_COLUMNS:
+        value = payload.get(key)
+        columns[column] = str(value) if value is not None else None
+    return columns
+
+
+def _synced_columns_sql():
+    """Return SET clauses copying updated payload keys to their columns.
+
+    The updates must be available as ``v.updates`` and the task table
+    aliased as ``t``.
+    """
+    return ",\n".join(
+        "{column} = CASE WHEN v.updates ? '{key}' "
+        "THEN v.updates->>'{key}' ELSE t.{column} END".format(
+            column=column, key=key
+        )
+        for column, key in PAYLOAD_COLUMNS
+    )
+
+
+def _month_partition(month):
+    """Return the name and UTC bounds of a monthly archive partition."""
+    start = month.replace(
+        day=1, hour=0, minute=0, second=0, microsecond=0,
+        tzinfo=timezone.utc,
+    )
+    if start.month == 12:
+        end = start.replace(year=start.year + 1, month=1)
+    else:
+        end = start.replace(month=start.month + 1)
+    name = "{0}_{1:%Y_%m}".format(ARCHIVE_TABLE_NAME, start)
+    return name, start, end
+
+
+def _stats_role_sql():
+    """Return the SQL CASE naming the task_stats role of a task."""
+    return "CASE {0} ELSE '{1}' END".format(
+        " ".join(
+            "WHEN cdse_task_role = '{0}' THEN '{1}'".format(role, name)
+            for role, name in STATS_ROLES
+        ),
+        STATS_DEFAULT_ROLE,
+    )
+
+
+def _stats_role(role):
+    """Return the task_stats role of a task with the given CDSE role."""
+    return dict(STATS_ROLES).get(role, STATS_DEFAULT_ROLE)
+
+
+def _percentile_cont(values, fraction):
+    """Return a percentile of sorted values, like SQL percentile_cont."""
+    position = fraction * (len(values) - 1)
+    lower = int(position)
+    upper = min(lower + 1, len(values) - 1)
+    return values[lower] + (values[upper] - values[lower]) * (
+        position - lower
+    )
+
+
+def _hour_key(hour):
+    """Return the ISO text of a UTC registration hour."""
+    if hour.tzinfo is None:
+        hour = hour.replace(tzinfo=timezone.utc)
+    return hour.astimezone(timezone.utc).replace(
+        minute=0, second=0, microsecond=0
+    ).isoformat()
+
+
+def task_stats_result(counts, hours, ages=None, percentiles=None):
+    """Return the task_stats dict of the aggregated rows of a repository.
+
+    ``counts`` are (status, role, count) rows and ``hours`` are
+    (registration hour, count) rows. The queue age is computed from the
+    ages in seconds of the active tasks, or taken from ``percentiles``,
+    a tuple (count, [percentile values], max) computed by the database.
+    """
+    by_status = {}
+    by_role = {name: 0 for _, name in STATS_ROLES}
+    by_role[STATS_DEFAULT_ROLE] = 0
+    total = 0
+    for status, role, count in counts:
+        # Tasks without status are counted under an empty status
+        status = "" if status is None else str(status)
+        by_status[status] = by_status.get(status, 0) + count
+        by_role[role] = by_role.get(role, 0) + count
+        total += count
+
+    by_hour = {}
+    for hour, count in hours:
+        key = _hour_key(hour)
+        by_hour[key] = by_hour.get(key, 0) + count
+
+    if percentiles is None:
+        ages = sorted(ages or ())
+        percentiles = (
+            len(ages),
+            [_percentile_cont(ages, fraction)
+             for fraction in QUEUE_AGE_PERCENTILES] if ages else None,
+            ages[-1] if ages else None,
+        )
+    count, values, maximum = percentiles
+    queue_age = {"count": count, "max": maximum}
+    for index, fraction in enumerate(QUEUE_AGE_PERCENTILES):
+        queue_age["p{0:g}".format(fraction * 100)] = (
+            values[index] if values else None
+        )
+    return {
+        "total": total,
+        "by_status": by_status,
+        "by_role": by_role,
+        "by_hour": dict(sorted(by_hour.items())),
+        "queue_age": queue_age,
+    }
+
+
+def _tasks_with_archive(columns):
+    """Return a FROM item with the columns of live and archived tasks."""
+    return (
+        "(SELECT {columns} FROM {table} "
+        "UNION ALL SELECT {columns} FROM {archive}) AS tasks"
+    ).format(
+        columns=", ".join(columns),
+        table=TABLE_NAME,
+        archive=ARCHIVE_TABLE_NAME,
+    )
+
+
+def _fingerprint_sql(value):
+    """Return the SQL hashing a JSONB value into a dataset fingerprint."""
+    return "encode(sha512(convert_to(({0})::text, 'UTF8')), 'hex')".format(
+        value
+    )
+
+
+def dataset_fingerprints_sql(task_ids_param=None):
+    """Return the SQL storing the fingerprints of the tasks' Datasets.
+
+    Only tasks whose Datasets is a list have fingerprints. With
+    ``task_ids_param``, the placeholder of a task id array, only those
+    tasks are fingerprinted.
+    """
+    where = ""
+    if task_ids_param is not None:
+        where = " AND t.task_id = ANY({0})".format(task_ids_param)
+    return (
+        "INSERT INTO {datasets} (task_id, position, fingerprint) "
+        "SELECT t.task_id, d.position, {fingerprint} "
+        "FROM {table} AS t CROSS JOIN LATERAL jsonb_array_elements("
+        "CASE WHEN jsonb_typeof(t.payload->'Datasets') = 'array' "
+        "THEN t.payload->'Datasets' ELSE '[]' END"
+        ") WITH ORDINALITY AS d (dataset, position) "
+        "WHERE jsonb_typeof(t.payload->'Datasets') = 'array'{where} "
+        "ON CONFLICT DO NOTHING"
+    ).format(
+        datasets=DATASETS_TABLE_NAME,
+        table=TABLE_NAME,
+        fingerprint=_fingerprint_sql("d.dataset"),
+        where=where,
+    )
+
+
+def duplicate_datasets_sql(user_param, datasets_param):
+    """Return SQL finding duplicates among requested and active datasets.
+
+    ``user_param`` and ``datasets_param`` are the placeholders of the user
+    id and of the JSONB array of requested datasets.
+    """
+    return (
+        "SELECT EXISTS (SELECT 1 FROM ("
+        "SELECT {requested} AS fingerprint "
+        "FROM jsonb_array_elements({datasets_param}) AS r (dataset) "
+        "UNION ALL "
+        "SELECT d.fingerprint FROM {table} AS t "
+        "JOIN {datasets} AS d ON d.task_id = t.task_id "
+        "WHERE t.user_id = {user_param} AND t.status IN ({active})"
+        ") AS f GROUP BY fingerprint HAVING count(*) > 1)"
+    ).format(
+        requested=_fingerprint_sql("r.dataset"),
+        datasets_param=datasets_param,
+        table=TABLE_NAME,
+        datasets=DATASETS_TABLE_NAME,
+        user_param=user_param,
+        active=", ".join("'{0}'".format(status) for status in ACTIVE_STATUSES),
+    )
+
+
+def unique_outbox_jobs(jobs):
+    """Return outbox jobs keeping the last one of each job_key."""
+    unique = {}
+    for number, job in enumerate(jobs):
+        unique[job.get("job_key") or number] = job
+    return list(unique.values())
+
+
+def _nothing():
+    """Do nothing, the commit and rollback of no outbox jobs."""
+
+
+class PreparedOutboxJobs:
+    """Outbox jobs stored in a transaction that is still open.
+
+    ``commit`` makes them visible to the outbox relay, ``rollback``
+    drops them. ``count`` is the number of stored jobs.
+    """
+
+    def __init__(self, count, commit=_nothing, rollback=_nothing):
+        self.count = count
+        self.commit = commit
+        self.rollback = rollback
 
 
 class DownloadtoolRepository:
-    """DB access layer for download tool tasks."""
+    """DB access layer for download tool tasks.
+
+    Finished tasks may be moved to the archive table, where reads by id
+    and by user still find them. Archived tasks are read only.
+    With ``notify`` enabled, writes send task change notifications, see
+    clms.downloadtool.storage.notify.
+    """
 
-    def __init__(self, dsn=None):
+    def __init__(self, dsn=None, pooled=None, notify=None):
         self.dsn = dsn or _get_dsn()
         self.psycopg2, self.extras = _get_psycopg2()
+        self.notify = notify_enabled() if notify is None else notify
+        if pooled is None:
+            pooled = pool_enabled()
+        self.pool = (
+            ConnectionPool(self._connect, **pool_settings())
+            if pooled else None
+        )
+        # RepositoryMetrics set by InstrumentedDownloadtoolRepository
+        self.metrics = None
 
     def _connect(self):
         """Open a DB connection with JSONB decoding enabled."""
@@ -80,52 +407,264 @@ class DownloadtoolRepository:
         self.extras.register_default_jsonb(conn, loads=json.loads)
         return conn
 
+    @contextmanager
+    def _connection(self):
+        """Yield a connection wrapped in a transaction.
+
+        The transaction is committed on success and rolled back on error.
+        Pooled connections go back to the pool, others are closed.
+        """
+        started = time.monotonic()
+        if self.pool is None:
+            conn = self._connect()
+            self._connection_acquired(started)
+            try:
+                with conn:
+                    yield conn
+            finally:
+                conn.close()
+            return
+
+        conn = self.pool.getconn()
+        self._connection_acquired(started)
+        discard = False
+        try:
+            with conn:
+                yield conn
+        except self.psycopg2.OperationalError:
+            discard = True
+            raise
+        finally:
+            self.pool.putconn(conn, discard=discard)
+
+    def _connection_acquired(self, started):
+        """Record the connection acquisition time when instrumented."""
+        if self.metrics is not None:
+            self.metrics.observe_connection(time.monotonic() - started)
+
+    def _notify(self, cursor, changes):
+        """Send change notifications when enabled."""
+        if self.notify:
+            notify_changes(cursor, changes)
+
+    @staticmethod
+    def _fingerprint(cursor, task_ids, replace=False):
+        """Store the dataset fingerprints of tasks."""
+        if replace:
+            cursor.execute(
+                "DELETE FROM {datasets} WHERE task_id = ANY(%s)".format(
+                    datasets=DATASETS_TABLE_NAME
+                ),
+                (task_ids,),
+            )
+        cursor.execute(dataset_fingerprints_sql("%s"), (task_ids,))
+
+    def pool_stats(self):
+        """Return connection pool metrics, or None when not pooled."""
+        return self.pool.stats() if self.pool is not None else None
+
     def insert_task(self, task_id, payload):
         """Insert a task row, returning True if inserted."""
         columns = _task_columns(payload)
-        now = _now_utc()
-        with self._connect() as conn:
+        columns["updated_at"] = _now_utc()
+        with self._connection() as conn:
             with conn.cursor() as cursor:
                 cursor.execute(
                     """
-                    INSERT INTO {table} (
-                        task_id,
-                        payload,
-                        user_id,
-                        status,
-                        cdse_task_group_id,
-                        registration_datetime,
-                        updated_at
-                    )
-                    VALUES (%s, %s, %s, %s, %s, %s, %s)
+                    INSERT INTO {table} (task_id, payload, {columns})
+                    VALUES (%s, %s, {values})
                     ON CONFLICT (task_id) DO NOTHING
                     RETURNING task_id
-                    """.format(table=TABLE_NAME),
-                    (
-                        str(task_id),
-                        self.extras.Json(payload),
-                        columns["user_id"],
-                        columns["status"],
-                        columns["cdse_task_group_id"],
-                        columns["registration_datetime"],
-                        now,
+                    """.format(
+                        table=TABLE_NAME,
+                        columns=", ".join(columns),
+                        values=", ".join(["%s"] * len(columns)),
+                    ),
+                    (str(task_id), self.extras.Json(payload)) + tuple(
+                        columns.values()
                     ),
                 )
-                return cursor.fetchone() is not None
+                if cursor.fetchone() is None:
+                    return False
+                if isinstance(payload.get("Datasets"), list):
+                    self._fingerprint(cursor, [str(task_id)])
+                self._notify(cursor, [
+                    {"task_id": str(task_id), "user_id": columns["user_id"]}
+                ])
+                return True
+
+    def insert_task_next_id(self, payload):
+        """Insert a task with the next sequence id and return the id."""
+        columns = _task_columns(payload)
+        columns["updated_at"] = _now_utc()
+        with self._connection() as conn:
+            with conn.cursor() as cursor:
+                cursor.execute(
+                    """
+                    INSERT INTO {table} (task_id, payload, {columns})
+                    VALUES (nextval('{sequence}')::text, %s, {values})
+                    RETURNING task_id
+                    """.format(
+                        table=TABLE_NAME,
+                        sequence=TASK_ID_SEQUENCE,
+                        columns=", ".join(columns),
+                        values=", ".join(["%s"] * len(columns)),
+                    ),
+                    (self.extras.Json(payload),) + tuple(columns.values()),
+                )
+                task_id = cursor.fetchone()[0]
+                if isinstance(payload.get("Datasets"), list):
+                    self._fingerprint(cursor, [task_id])
+                self._notify(cursor, [
+                    {"task_id": task_id, "user_id": columns["user_id"]}
+                ])
+                return task_id
+
+    def insert_tasks_bulk(self, tasks):
+        """Insert several tasks in one transaction.
+
+        ``tasks`` is a list of (task_id, payload), a None task_id takes the
+        next sequence id. Returns the task ids in the order of ``tasks``,
+        or None, inserting nothing, when one of the ids already exists.
+        """
+        if not tasks:
+            return []
+        now = _now_utc()
+        with self._connection() as conn:
+            with conn.cursor() as cursor:
+                missing_ids = sum(1 for task_id, _ in tasks if task_id is None)
+                next_ids = iter(())
+                if missing_ids:
+                    cursor.execute(
+                        "SELECT nextval('{sequence}')::text "
+                        "FROM generate_series(1, %s)".format(
+                            sequence=TASK_ID_SEQUENCE
+                        ),
+                        (missing_ids,),
+                    )
+                    next_ids = iter([row[0] for row in cursor.fetchall()])
+                task_ids = []
+                rows = []
+                params = []
+                for task_id, payload in tasks:
+                    if task_id is None:
+                        task_id = next(next_ids)
+                    task_id = str(task_id)
+                    columns = _task_columns(payload)
+                    columns["updated_at"] = now
+                    task_ids.append(task_id)
+                    rows.append(
+                        "(%s, %s, {0})".format(
+                            ", ".join(["%s"] * len(columns))
+                        )
+                    )
+                    params.extend([task_id, self.extras.Json(payload)])
+                    params.extend(columns.values())
+                cursor.execute(
+                    """
+                    INSERT INTO {table} (task_id, payload, {columns})
+                    VALUES {values}
+                    ON CONFLICT (task_id) DO NOTHING
+                    RETURNING task_id, user_id
+                    """.format(
+                        table=TABLE_NAME,
+                        columns=", ".join(columns),
+                        values=", ".join(rows),
+                    ),
+                    tuple(params),
+                )
+                inserted = cursor.fetchall()
+                if len(inserted) < len(task_ids):
+                    conn.rollback()
+                    return None
+                fingerprinted = [
+                    task_id for task_id, (_, payload) in zip(task_ids, tasks)
+                    if isinstance(payload.get("Datasets"), list)
+                ]
+                if fingerprinted:
+                    self._fingerprint(cursor, fingerprinted)
+                self._notify(cursor, [
+                    {"task_id": task_id, "user_id": user_id}
+                    for task_id, user_id in inserted
+                ])
+                return task_ids
 
     def get_task(self, task_id):
         """Fetch a task payload by task id."""
-        with self._connect() as conn:
+        with self._connection() as conn:
             with conn.cursor() as cursor:
                 cursor.execute(
-                    "SELECT payload FROM {table} WHERE task_id = %s".format(
-                        table=TABLE_NAME
+                    "SELECT payload FROM {table} WHERE task_id = %s "
+                    "UNION ALL "
+                    "SELECT payload FROM {archive} WHERE task_id = %s "
+                    "LIMIT 1".format(
+                        table=TABLE_NAME, archive=ARCHIVE_TABLE_NAME
                     ),
-                    (str(task_id),),
+                    (str(task_id), str(task_id)),
                 )
                 row = cursor.fetchone()
                 return row[0] if row else None
 
+    @staticmethod
+    def _search_source(status):
+        """Return the FROM item of user searches.
+
+        Searches for an unfinished status never need the archive.
+        """
+        if status is not None and status not in FINISHED_STATUSES:
+            return TABLE_NAME
+        return _tasks_with_archive(
+            ("task_id", "payload", "user_id", "status",
+             "registration_datetime")
+        )
+
+    def get_task_with_version(self, task_id):
+        """Fetch (payload, updated_at) of a task, None when missing."""
+        with self._connection() as conn:
+            with conn.cursor() as cursor:
+                cursor.execute(
+                    "SELECT payload, updated_at FROM {table} "
+                    "WHERE task_id = %s "
+                    "UNION ALL "
+                    "SELECT payload, updated_at FROM {archive} "
+                    "WHERE task_id = %s "
+                    "LIMIT 1".format(
+                        table=TABLE_NAME, archive=ARCHIVE_TABLE_NAME
+                    ),
+                    (str(task_id), str(task_id)),
+                )
+                row = cursor.fetchone()
+                return tuple(row) if row else None
+
+    @contextmanager
+    def watch_task(self, task_id):
+        """Yield an event set when the task changes.
+
+        The event comes from the change notifications of every process,
+        so None is yielded when they are disabled.
+        """
+        watchers = get_watchers(self) if self.notify else None
+        if watchers is None:
+            yield None
+            return
+        with watchers.watch(task_id) as event:
+            yield event
+
+    def has_duplicate_datasets(self, user_id, datasets):
+        """Return True when a dataset repeats among the requested ones and
+        those of the user's Queued and In_progress tasks.
+
+        Stored fingerprints are compared, so active payloads are neither
+        fetched nor hashed again.
+        """
+        with self._connection() as conn:
+            with conn.cursor() as cursor:
+                cursor.execute(
+                    duplicate_datasets_sql("%s", "%s::jsonb"),
+                    (self.extras.Json(list(datasets)), str(user_id)),
+                )
+                return cursor.fetchone()[0]
+
     def search_tasks(self, user_id, status=None):
         """Return list of (task_id, payload) for a user and status."""
         params = [str(user_id)]
@@ -133,80 +672,661 @@ class DownloadtoolRepository:
         if status is not None:
             where.append("status = %s")
             params.append(status)
-        with self._connect() as conn:
+        with self._connection() as conn:
             with conn.cursor() as cursor:
                 query = (
-                    "SELECT task_id, payload FROM {table} WHERE {where}"
+                    "SELECT task_id, payload FROM {source} WHERE {where}"
                 ).format(
-                    table=TABLE_NAME, where=" AND ".join(where)
+                    source=self._search_source(status),
+                    where=" AND ".join(where),
                 )
                 cursor.execute(query, tuple(params))
                 return cursor.fetchall()
 
-    def inspect_tasks(self, query=None):
-        """Return list of (task_id, payload) filtered by payload fields."""
+    def search_tasks_page(self, user_id, status=None, limit=None, after=None,
+                          descending=True, fields=None):
+        """Return one keyset page of a user's tasks.
+
+        Tasks are ordered by (registration_datetime, task_id). ``after`` is
+        the sort key of the last task of the previous page and ``fields``
+        restricts the returned payload keys. Returns a tuple
+        (rows, next_after, total) where rows are (task_id, payload) and
+        next_after is None on the last page.
+        """
+        params = [str(user_id)]
+        where = ["user_id = %s"]
+        if status is not None:
+            where.append("status = %s")
+            params.append(status)
+        source = self._search_source(status)
+        count_query = "SELECT count(*) FROM {source} WHERE {where}".format(
+            source=source, where=" AND ".join(where)
+        )
+        count_params = tuple(params)
+
+        direction = "DESC" if descending else "ASC"
+        if after is not None:
+            where.append(
+                "({sort_key}, task_id) {op} "
+                "(COALESCE(%s::timestamptz, '-infinity'), %s)".format(
+                    sort_key=SORT_KEY, op="<" if descending else ">"
+                )
+            )
+            params.extend([after[0], str(after[1])])
+
+        payload = "payload"
+        if fields is not None:
+            payload = (
+                "COALESCE((SELECT jsonb_object_agg(key, value) "
+                "FROM jsonb_each(payload) WHERE key = ANY(%s)), '{}')"
+            )
+            params.insert(0, list(fields))
+
+        query = (
+            "SELECT task_id, {payload}, registration_datetime "
+            "FROM {source} WHERE {where} "
+            "ORDER BY {sort_key} {direction}, task_id {direction}"
+        ).format(
+            payload=payload,
+            source=source,
+            where=" AND ".join(where),
+            sort_key=SORT_KEY,
+            direction=direction,
+        )
+        if limit is not None:
+            query += " LIMIT %s"
+            params.append(limit + 1)
+
+        with self._connection() as conn:
+            with conn.cursor() as cursor:
+                cursor.execute(query, tuple(params))
+                rows = cursor.fetchall()
+                if after is None and (limit is None or len(rows) <= limit):
+                    total = len(rows)
+                else:
+                    cursor.execute(count_query, count_params)
+                    total = cursor.fetchone()[0]
+
+        next_after = None
+        if limit is not None and len(rows) > limit:
+            rows = rows[:limit]
+            next_after = (rows[-1][2], rows[-1][0])
+        return [(row[0], row[1]) for row in rows], next_after, total
+
+    def _inspect_query(self, query=None):
+        """Return the SQL and params selecting tasks by payload fields.
+
+        Keys with an indexed column are compared as text, other keys
+        through JSONB containment so the payload GIN index applies.
+        """
         params = []
         where = ""
         if query:
             conditions = []
             for key, value in query.items():
-                conditions.append("payload->>%s = %s")
-                params.extend([key, str(value)])
+                column = QUERY_COLUMNS.get(key)
+                if column is not None:
+                    conditions.append("{0} = %s".format(column))
+                    params.append(str(value))
+                else:
+                    conditions.append("payload @> %s")
+                    params.append(self.extras.Json({key: value}))
             where = " WHERE {conds}".format(conds=" OR ".join(conditions))
-        with self._connect() as conn:
+        sql = "SELECT task_id, payload FROM {table}{where} ORDER BY task_id"
+        return sql.format(table=TABLE_NAME, where=where), tuple(params)
+
+    def inspect_tasks(self, query=None):
+        """Return list of (task_id, payload) filtered by payload fields."""
+        sql, params = self._inspect_query(query)
+        with self._connection() as conn:
             with conn.cursor() as cursor:
-                cursor.execute(
-                    "SELECT task_id, payload FROM {table}{where} "
-                    "ORDER BY task_id".format(
-                        table=TABLE_NAME, where=where
-                    ),
-                    tuple(params),
-                )
+                cursor.execute(sql, params)
                 return cursor.fetchall()
 
+    def iter_inspect_tasks(self, query=None, itersize=None):
+        """Yield (task_id, payload) filtered by payload fields.
+
+        Rows are read through a server-side cursor ``itersize`` rows at a
+        time, so memory use does not depend on the number of matches.
+        """
+        sql, params = self._inspect_query(query)
+        with self._connection() as conn:
+            with conn.cursor(name="downloadtool_inspect") as cursor:
+                cursor.itersize = itersize or _get_itersize()
+                cursor.execute(sql, params)
+                for row in cursor:
+                    yield row[0], row[1]
+
     def update_task(self, task_id, updates, status=None):
         """Merge updates into the payload and return the new payload."""
         now = _now_utc()
-        with self._connect() as conn:
+        with self._connection() as conn:
             with conn.cursor() as cursor:
                 cursor.execute(
                     """
-                    UPDATE {table}
-                    SET payload = payload || %s::jsonb,
-                        status = COALESCE(%s, status),
+                    UPDATE {table} AS t
+                    SET payload = t.payload || v.updates,
+                        status = COALESCE(%s, t.status),
+                        {synced},
                         updated_at = %s
-                    WHERE task_id = %s
-                    RETURNING payload
-                    """.format(table=TABLE_NAME),
-                    (self.extras.Json(updates), status, now, str(task_id)),
+                    FROM (SELECT %s::jsonb AS updates) AS v
+                    WHERE t.task_id = %s
+                    RETURNING t.payload, t.user_id
+                    """.format(
+                        table=TABLE_NAME, synced=_synced_columns_sql()
+                    ),
+                    (status, now, self.extras.Json(updates), str(task_id)),
                 )
                 row = cursor.fetchone()
-                return row[0] if row else None
+                if row is None:
+                    return None
+                if "Datasets" in updates:
+                    self._fingerprint(cursor, [str(task_id)], replace=True)
+                self._notify(cursor, [
+                    {"task_id": str(task_id), "user_id": row[1]}
+                ])
+                return row[0]
+
+    def transition_task(self, task_id, expected_statuses, updates,
+                        user_id=None, exclude=False):
+        """Merge updates into a task only when its status is expected.
+
+        The status, and the owner when ``user_id`` is given, are checked
+        by the UPDATE itself, so a concurrent change of the task is not
+        overwritten. ``expected_statuses`` None accepts any status and
+        with ``exclude`` the task must not have any of the statuses.
+        Returns a tuple (outcome, payload) where outcome is one of the
+        TRANSITION_* constants and payload is the new payload when done,
+        otherwise the current one.
+        """
+        conditions = ["t.task_id = %s"]
+        params = [str(task_id)]
+        if user_id is not None:
+            conditions.append("t.user_id = %s")
+            params.append(str(user_id))
+        if expected_statuses is not None:
+            if exclude:
+                conditions.append("NOT (COALESCE(t.status, '') = ANY(%s))")
+            else:
+                conditions.append("t.status = ANY(%s)")
+            params.append(list(expected_statuses))
+        with self._connection() as conn:
+            with conn.cursor() as cursor:
+                cursor.execute(
+                    """
+                    WITH current AS (
+                        SELECT payload, user_id FROM {table}
+                        WHERE task_id = %s
+                        UNION ALL
+                        SELECT payload, user_id FROM {archive}
+                        WHERE task_id = %s
+                        LIMIT 1
+                    ), updated AS (
+                        UPDATE {table} AS t
+                        SET payload = t.payload || v.updates,
+                            status = COALESCE(%s, t.status),
+                            {synced},
+                            updated_at = %s
+                        FROM (SELECT %s::jsonb AS updates) AS v
+                        WHERE {conditions}
+                        RETURNING t.payload, t.user_id
+                    )
+                    SELECT updated.payload, updated.user_id,
+                           current.payload, current.user_id
+                    FROM (SELECT 1) AS one
+                    LEFT JOIN updated ON true
+                    LEFT JOIN current ON true
+                    """.format(
+                        table=TABLE_NAME,
+                        archive=ARCHIVE_TABLE_NAME,
+                        synced=_synced_columns_sql(),
+                        conditions=" AND ".join(conditions),
+                    ),
+                    (
+                        str(task_id),
+                        str(task_id),
+                        updates.get("Status"),
+                        _now_utc(),
+                        self.extras.Json(updates),
+                    ) + tuple(params),
+                )
+                payload, owner, current, current_owner = cursor.fetchone()
+                if payload is None:
+                    if current is None:
+                        return TRANSITION_NOT_FOUND, None
+                    if user_id is not None and current_owner != str(user_id):
+                        return TRANSITION_PERMISSION_DENIED, current
+                    return TRANSITION_INVALID_STATUS, current
+                if "Datasets" in updates:
+                    self._fingerprint(cursor, [str(task_id)], replace=True)
+                self._notify(cursor, [
+                    {"task_id": str(task_id), "user_id": owner}
+                ])
+                return TRANSITION_DONE, payload
+
+    def update_tasks_bulk(self, updates):
+        """Merge updates into several payloads in one statement.
+
+        ``updates`` maps task ids to the dict merged into each payload.
+        Only the tasks whose payload changes are written and notified,
+        the others, like those with empty update dicts, only return the
+        current payload. A finished task keeps its status: updates of
+        another Status are skipped, like in transition_task.
+        Returns a tuple ({task_id: new_payload}, [missing task ids],
+        [skipped finished task ids]).
+        """
+        if not updates:
+            return {}, [], []
+        rows = [
+            (
+                str(task_id),
+                self.extras.Json(task_updates),
+                task_updates.get("Status"),
+            )
+            for task_id, task_updates in updates.items()
+        ]
+        params = []
+        for row in rows:
+            params.extend(row)
+        params.extend([_now_utc(), list(FINISHED_STATUSES)])
+        params.append(list(FINISHED_STATUSES))
+        with self._connection() as conn:
+            with conn.cursor() as cursor:
+                # The final SELECT sees the tasks as they were before the
+                # UPDATE, the unchanged ones are read from there
+                cursor.execute(
+                    """
+                    WITH v (task_id, updates, status) AS (
+                        VALUES {values}
+                    ), changed AS (
+                        UPDATE {table} AS t
+                        SET payload = t.payload || v.updates,
+                            status = COALESCE(v.status, t.status),
+                            {synced},
+                            updated_at = %s
+                        FROM v
+                        WHERE t.task_id = v.task_id
+                        AND t.payload || v.updates <> t.payload
+                        AND NOT ({finished})
+                        RETURNING t.task_id, t.payload, t.user_id
+                    )
+                    SELECT task_id, payload, user_id, 'changed' FROM changed
+                    UNION ALL
+                    SELECT t.task_id, t.payload, t.user_id,
+                        CASE WHEN {finished} THEN 'finished'
+                        ELSE 'unchanged' END
+                    FROM {table} AS t JOIN v ON t.task_id = v.task_id
+                    WHERE t.task_id NOT IN (SELECT task_id FROM changed)
+                    """.format(
+                        table=TABLE_NAME,
+                        synced=_synced_columns_sql(),
+                        values=", ".join(
+                            ["(%s, %s::jsonb, %s)"] * len(rows)
+                        ),
+                        finished=BULK_FINISHED_SQL.format(finished="%s"),
+                    ),
+                    tuple(params),
+                )
+                result = cursor.fetchall()
+                changed = {
+                    task_id for task_id, _, _, state in result
+                    if state == "changed"
+                }
+                refingerprint = [
+                    str(task_id) for task_id, task_updates in updates.items()
+                    if "Datasets" in task_updates and str(task_id) in changed
+                ]
+                if refingerprint:
+                    self._fingerprint(cursor, refingerprint, replace=True)
+                self._notify(cursor, [
+                    {"task_id": task_id, "user_id": user_id}
+                    for task_id, _, user_id, state in result
+                    if state == "changed"
+                ])
+        updated = {
+            task_id: payload for task_id, payload, _, state in result
+            if state != "finished"
+        }
+        finished = [
+            task_id for task_id, _, _, state in result
+            if state == "finished"
+        ]
+        missing = [
+            row[0] for row in rows
+            if row[0] not in updated and row[0] not in finished
+        ]
+        return updated, missing, finished
 
     def delete_task(self, task_id):
         """Delete one task by id, returning True when removed."""
-        with self._connect() as conn:
+        removed = 0
+        with self._connection() as conn:
+            with conn.cursor() as cursor:
+                for table in (TABLE_NAME, ARCHIVE_TABLE_NAME):
+                    cursor.execute(
+                        "DELETE FROM {table} WHERE task_id = %s "
+                        "RETURNING user_id".format(table=table),
+                        (str(task_id),),
+                    )
+                    rows = cursor.fetchall()
+                    self._notify(cursor, [
+                        {"task_id": str(task_id), "user_id": row[0]}
+                        for row in rows
+                    ])
+                    removed += len(rows)
+        return removed > 0
+
+    def delete_tasks_by_group(self, cdse_task_group_id, role=None):
+        """Delete the tasks of a CDSE task group, optionally by role.
+
+        Returns the list of removed task ids.
+        """
+        params = [str(cdse_task_group_id)]
+        where = ["cdse_task_group_id = %s"]
+        if role is not None:
+            where.append("cdse_task_role = %s")
+            params.append(role)
+        with self._connection() as conn:
+            with conn.cursor() as cursor:
+                cursor.execute(
+                    "DELETE FROM {table} WHERE {where} "
+                    "RETURNING task_id, user_id".format(
+                        table=TABLE_NAME, where=" AND ".join(where)
+                    ),
+                    tuple(params),
+                )
+                rows = cursor.fetchall()
+                self._notify(cursor, [
+                    {"task_id": task_id, "user_id": user_id}
+                    for task_id, user_id in rows
+                ])
+                return [row[0] for row in rows]
+
+    def purge_tasks(self, status, older_than, batch_size=1000):
+        """Delete at most batch_size tasks registered before a datetime.
+
+        Only tasks in ``status`` are deleted, from the live table first
+        and then from the archive, in one short transaction. Tasks without
+        registration date are deleted when their updated_at is before the
+        datetime. Returns the removed task ids.
+        """
+        # The live table is scanned on the sort key of its finished index,
+        # the plain comparison prunes the archive partitions
+        expired = (
+            (
+                TABLE_NAME,
+                "{sort_key} < %s AND (registration_datetime IS NOT NULL "
+                "OR updated_at < %s)".format(sort_key=SORT_KEY),
+            ),
+            (
+                ARCHIVE_TABLE_NAME,
+                "(registration_datetime < %s OR registration_datetime IS "
+                "NULL AND updated_at < %s)",
+            ),
+        )
+        rows = []
+        with self._connection() as conn:
+            with conn.cursor() as cursor:
+                for table, older in expired:
+                    if len(rows) >= batch_size:
+                        break
+                    # No ORDER BY, the scan stops after enough old tasks
+                    cursor.execute(
+                        """
+                        WITH expired AS (
+                            SELECT task_id FROM {table}
+                            WHERE status = %s AND {older}
+                            LIMIT %s
+                            FOR UPDATE SKIP LOCKED
+                        )
+                        DELETE FROM {table} AS t
+                        USING expired
+                        WHERE t.task_id = expired.task_id
+                        RETURNING t.task_id, t.user_id
+                        """.format(table=table, older=older),
+                        (
+                            status,
+                            older_than,
+                            older_than,
+                            batch_size - len(rows),
+                        ),
+                    )
+                    rows.extend(cursor.fetchall())
+                self._notify(cursor, [
+                    {"task_id": task_id, "user_id": user_id}
+                    for task_id, user_id in rows
+                ])
+        return [row[0] for row in rows]
+
+    def add_outbox_jobs(self, jobs):
+        """Store async jobs in the outbox and return their number.
+
+        See prepare_outbox_jobs, the jobs are committed at once.
+        """
+        prepared = self.prepare_outbox_jobs(jobs)
+        prepared.commit()
+        return prepared.count
+
+    def prepare_outbox_jobs(self, jobs):
+        """Store async jobs in the outbox without committing them.
+
+        ``jobs`` are dicts with the OUTBOX_FIELDS keys and an optional
+        job_key. A job replaces the unpublished one with its job_key.
+        Returns a PreparedOutboxJobs, the connection is held until it is
+        committed or rolled back: commit or roll it back soon. The jobs
+        are not in the transaction of any task write.
+        """
+        jobs = unique_outbox_jobs(jobs)
+        if not jobs:
+            return PreparedOutboxJobs(0)
+        with ExitStack() as stack:
+            conn = stack.enter_context(self._connection())
+            with conn.cursor() as cursor:
+                self.extras.execute_values(
+                    cursor,
+                    """
+                    INSERT INTO {outbox} ({columns}, job_key) VALUES %s
+                    ON CONFLICT (job_key) WHERE job_key IS NOT NULL
+                    DO UPDATE SET
+                        data = EXCLUDED.data,
+                        opts = EXCLUDED.opts,
+                        created_at = now()
+                    """.format(
+                        outbox=OUTBOX_TABLE_NAME,
+                        columns=", ".join(OUTBOX_FIELDS),
+                    ),
+                    [
+                        (
+                            job["queue_name"],
+                            job["job_name"],
+                            self.extras.Json(job["data"]),
+                            self.extras.Json(job["opts"]),
+                            job.get("job_key"),
+                        )
+                        for job in jobs
+                    ],
+                )
+            # Leaving the connection context commits the transaction
+            held = stack.pop_all()
+
+        def rollback():
+            conn.rollback()
+            held.close()
+
+        return PreparedOutboxJobs(len(jobs), held.close, rollback)
+
+    def relay_outbox_jobs(self, publish, batch_size=100):
+        """Publish the oldest outbox jobs and remove them.
+
+        At most ``batch_size`` jobs are passed to ``publish`` as dicts
+        with the OUTBOX_FIELDS keys, then deleted in the same
+        transaction. An error of ``publish`` keeps them for the next
+        call, a failed commit after it publishes them again: delivery
+        is at least once. Jobs locked by another relay are skipped.
+        Returns the number of published jobs.
+        """
+        with self._connection() as conn:
             with conn.cursor() as cursor:
                 cursor.execute(
-                    "DELETE FROM {table} WHERE task_id = %s".format(
-                        table=TABLE_NAME
+                    """
+                    SELECT id, {columns} FROM {outbox}
+                    ORDER BY id
+                    LIMIT %s
+                    FOR UPDATE SKIP LOCKED
+                    """.format(
+                        outbox=OUTBOX_TABLE_NAME,
+                        columns=", ".join(OUTBOX_FIELDS),
                     ),
-                    (str(task_id),),
+                    (batch_size,),
                 )
-                return cursor.rowcount > 0
+                rows = cursor.fetchall()
+                if not rows:
+                    return 0
+                publish([dict(zip(OUTBOX_FIELDS, row[1:])) for row in rows])
+                cursor.execute(
+                    "DELETE FROM {outbox} WHERE id = ANY(%s)".format(
+                        outbox=OUTBOX_TABLE_NAME
+                    ),
+                    ([row[0] for row in rows],),
+                )
+        return len(rows)
 
     def delete_all(self):
         """Delete all task rows and return the number removed."""
-        with self._connect() as conn:
+        removed = 0
+        with self._connection() as conn:
             with conn.cursor() as cursor:
-                cursor.execute("DELETE FROM {table}".format(table=TABLE_NAME))
-                return cursor.rowcount
+                for table in (TABLE_NAME, ARCHIVE_TABLE_NAME):
+                    cursor.execute("DELETE FROM {table}".format(table=table))
+                    removed += cursor.rowcount
+                self._notify(cursor, [ALL_CHANGED])
+        return removed
 
     def has_tasks(self):
-        """Return True when the table has at least one task."""
-        with self._connect() as conn:
+        """Return True when the tables have at least one task."""
+        with self._connection() as conn:
             with conn.cursor() as cursor:
                 cursor.execute(
-                    "SELECT 1 FROM {table} LIMIT 1".format(table=TABLE_NAME)
+                    "SELECT 1 FROM {table} UNION ALL "
+                    "SELECT 1 FROM {archive} LIMIT 1".format(
+                        table=TABLE_NAME, archive=ARCHIVE_TABLE_NAME
+                    )
                 )
                 return cursor.fetchone() is not None
+
+    def task_stats(self, since=None):
+        """Return task counts and the age of the queued tasks.
+
+        Live tasks are counted by status, by role and by hour of
+        registration, the hours only from ``since`` when given. Archived
+        tasks are not counted. See task_stats_result for the returned
+        dict.
+        """
+        hours_where = ""
+        hours_params = []
+        if since is not None:
+            hours_where = "AND registration_datetime >= %s"
+            hours_params.append(since)
+        with self._connection() as conn:
+            with conn.cursor() as cursor:
+                cursor.execute(
+                    "SELECT status, {role}, count(*) FROM {table} "
+                    "GROUP BY 1, 2".format(
+                        role=_stats_role_sql(), table=TABLE_NAME
+                    )
+                )
+                counts = cursor.fetchall()
+                cursor.execute(
+                    "SELECT date_trunc('hour', "
+                    "registration_datetime AT TIME ZONE 'UTC'), count(*) "
+                    "FROM {table} WHERE registration_datetime IS NOT NULL "
+                    "{where} GROUP BY 1".format(
+                        table=TABLE_NAME, where=hours_where
+                    ),
+                    hours_params,
+                )
+                hours = cursor.fetchall()
+                cursor.execute(
+                    """
+                    SELECT count(*),
+                        percentile_cont(%s::float8[])
+                            WITHIN GROUP (ORDER BY age),
+                        max(age)
+                    FROM (
+                        SELECT extract(epoch FROM %s - registration_datetime)
+                            ::float8 AS age
+                        FROM {table}
+                        WHERE status = ANY(%s)
+                        AND registration_datetime IS NOT NULL
+                    ) AS ages
+                    """.format(table=TABLE_NAME),
+                    (
+                        list(QUEUE_AGE_PERCENTILES),
+                        _now_utc(),
+                        list(ACTIVE_STATUSES),
+                    ),
+                )
+                percentiles = cursor.fetchone()
+        return task_stats_result(counts, hours, percentiles=percentiles)
+
+    def archive_finished_tasks(self, older_than, batch_size=1000):
+        """Move finished tasks registered before a datetime to the archive.
+
+        Tasks are moved ``batch_size`` at a time, one transaction each.
+        Missing monthly archive partitions are created on the way.
+        Returns the number of archived tasks.
+        """
+        finished = list(FINISHED_STATUSES)
+        archived = 0
+        while True:
+            with self._connection() as conn:
+                with conn.cursor() as cursor:
+                    cursor.execute(
+                        "SELECT pg_advisory_xact_lock(%s)", (ARCHIVE_LOCK_ID,)
+                    )
+                    cursor.execute(
+                        "SELECT task_id, date_trunc('month', "
+                        "registration_datetime AT TIME ZONE 'UTC') "
+                        "FROM {table} "
+                        "WHERE status = ANY(%s) AND {sort_key} < %s "
+                        "ORDER BY {sort_key}, task_id LIMIT %s "
+                        "FOR UPDATE SKIP LOCKED".format(
+                            table=TABLE_NAME, sort_key=SORT_KEY
+                        ),
+                        (finished, older_than, batch_size),
+                    )
+                    rows = cursor.fetchall()
+                    months = {month for _, month in rows if month is not None}
+                    for month in sorted(months):
+                        self._create_archive_partition(cursor, month)
+                    cursor.execute(
+                        """
+                        WITH moved AS (
+                            DELETE FROM {table}
+                            WHERE task_id = ANY(%s)
+                            RETURNING {columns}
+                        )
+                        INSERT INTO {archive} ({columns})
+                        SELECT {columns} FROM moved
+                        """.format(
+                            table=TABLE_NAME,
+                            archive=ARCHIVE_TABLE_NAME,
+                            columns=", ".join(TASK_COLUMNS),
+                        ),
+                        ([row[0] for row in rows],),
+                    )
+            archived += len(rows)
+            if len(rows) < batch_size:
+                return archived
+
+    @staticmethod
+    def _create_archive_partition(cursor, month):
+        """Create the archive partition of a month when missing."""
+        name, start, end = _month_partition(month)
+        cursor.execute(
+            "CREATE TABLE IF NOT EXISTS {name} PARTITION OF {archive} "
+            "FOR VALUES FROM (%s) TO (%s)".format(
+                name=name, archive=ARCHIVE_TABLE_NAME
+            ),
+            (start, end),
+        )
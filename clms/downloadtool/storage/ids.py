@@ -0,0 +1,165 @@
+"""Task id generators for the download tool storage.
+
+Task ids are numeric strings. A generator owns the insert strategy of
+new tasks, so modes that cannot collide insert each task exactly once.
+Bulk inserts are all or nothing, a collision retries the whole batch.
+"""
+import os
+import random
+import threading
+import time
+from logging import getLogger
+
+log = getLogger(__name__)
+
+# Range of the historical random task ids
+RANDOM_ID_MAX = 99999999999
+
+# 2024-01-01T00:00:00Z in milliseconds, epoch of time ordered ids
+TIME_ID_EPOCH_MS = 1704067200000
+
+# 256 nodes, each one drawing up to 16 ids per millisecond
+TIME_ID_NODE_BITS = 8
+TIME_ID_SEQUENCE_BITS = 4
+
+
+class RandomTaskIdGenerator:
+    """Random ids, retrying the insert until an unused id is drawn."""
+
+    def insert(self, repository, payload):
+        """Insert the task and return its new id."""
+        while True:
+            candidate = str(random.randint(0, RANDOM_ID_MAX))
+            if repository.insert_task(candidate, payload):
+                return candidate
+
+    def insert_bulk(self, repository, payloads):
+        """Insert the tasks in one transaction and return their new ids."""
+        while True:
+            candidates = []
+            while len(candidates) < len(payloads):
+                candidate = str(random.randint(0, RANDOM_ID_MAX))
+                if candidate not in candidates:
+                    candidates.append(candidate)
+            task_ids = repository.insert_tasks_bulk(
+                list(zip(candidates, payloads))
+            )
+            if task_ids is not None:
+                return task_ids
+
+
+class SequenceTaskIdGenerator:
+    """Ids drawn from a DB sequence inside the insert statement."""
+
+    def insert(self, repository, payload):
+        """Insert the task and return its new id."""
+        return repository.insert_task_next_id(payload)
+
+    def insert_bulk(self, repository, payloads):
+        """Insert the tasks in one transaction and return their new ids."""
+        return repository.insert_tasks_bulk(
+            [(None, payload) for payload in payloads]
+        )
+
+
+class TimeOrderedTaskIdGenerator:
+    """Time ordered ids: milliseconds, node number and sequence number.
+
+    Ids stay below 2 ** 53, so they remain exact as JavaScript numbers,
+    and are larger than every historical random id. Every ZEO client
+    and worker process creating tasks needs its own node id, see
+    node_id_from_env, so ids of different nodes never collide.
+    """
+
+    def __init__(self, node_id=None):
+        if node_id is None:
+            node_id = node_id_from_env()
+        if not 0 <= node_id < 1 << TIME_ID_NODE_BITS:
+            raise ValueError(
+                "node id must be between 0 and {0}".format(
+                    (1 << TIME_ID_NODE_BITS) - 1
+                )
+            )
+        self.node_id = node_id
+        self._lock = threading.Lock()
+        self._last_ms = 0
+        self._sequence = 0
+
+    def next_id(self):
+        """Return a new id greater than the previous ones of this node."""
+        with self._lock:
+            now_ms = max(int(time.time() * 1000), self._last_ms)
+            if now_ms == self._last_ms:
+                self._sequence += 1
+                if self._sequence >= 1 << TIME_ID_SEQUENCE_BITS:
+                    while now_ms <= self._last_ms:
+                        time.sleep(0.0001)
+                        now_ms = int(time.time() * 1000)
+                    self._sequence = 0
+            else:
+                self._sequence = 0
+            self._last_ms = now_ms
+            elapsed = now_ms - TIME_ID_EPOCH_MS
+            node = elapsed << TIME_ID_NODE_BITS | self.node_id
+            value = node << TIME_ID_SEQUENCE_BITS | self._sequence
+        return str(value)
+
+    def insert(self, repository, payload):
+        """Insert the task and return its new id."""
+        while True:
+            candidate = self.next_id()
+            if repository.insert_task(candidate, payload):
+                return candidate
+            log.warning("Task id collision on %s, check node ids", candidate)
+
+    def insert_bulk(self, repository, payloads):
+        """Insert the tasks in one transaction and return their new ids."""
+        while True:
+            task_ids = repository.insert_tasks_bulk(
+                [(self.next_id(), payload) for payload in payloads]
+            )
+            if task_ids is not None:
+                return task_ids
+            log.warning("Task id collision in a bulk insert, check node ids")
+
+
+def node_id_from_env():
+    """Return the node id set in DOWNLOADTOOL_NODE_ID.
+
+    It is required by the time ordered ids, a node id derived from the
+    host and process could be shared by two nodes.
+    """
+    value = os.environ.get("DOWNLOADTOOL_NODE_ID", "").strip()
+    if not value:
+        raise RuntimeError(
+            "DOWNLOADTOOL_NODE_ID must be set to a distinct number on "
+            "each node when DOWNLOADTOOL_TASK_ID_MODE is time"
+        )
+    try:
+        node_id = int(value)
+    except ValueError:
+        node_id = -1
+    if not 0 <= node_id < 1 << TIME_ID_NODE_BITS:
+        raise RuntimeError(
+            "DOWNLOADTOOL_NODE_ID must be a number between 0 and {0}".format(
+                (1 << TIME_ID_NODE_BITS) - 1
+            )
+        )
+    return node_id
+
+
+GENERATORS = {
+    "random": RandomTaskIdGenerator,
+    "sequence": SequenceTaskIdGenerator,
+    "time": TimeOrderedTaskIdGenerator,
+}
+
+
+def get_task_id_generator():
+    """Return the generator selected by DOWNLOADTOOL_TASK_ID_MODE."""
+    mode = os.environ.get("DOWNLOADTOOL_TASK_ID_MODE", "").strip() or "random"
+    if mode not in GENERATORS:
+        raise RuntimeError(
+            "Unknown DOWNLOADTOOL_TASK_ID_MODE: {0}".format(mode)
+        )
+    return GENERATORS[mode]()
@@ -1,72 +1,571 @@
 """In-memory storage for download tool tasks (used in tests)."""
+import hashlib
+import json
+import threading
+from contextlib import contextmanager
+from datetime import datetime, timezone
+
+from clms.downloadtool.storage.db import (
+    ACTIVE_STATUSES,
+    FINISHED_STATUSES,
+    OUTBOX_FIELDS,
+    PAYLOAD_COLUMNS,
+    QUERY_COLUMNS,
+    TRANSITION_DONE,
+    TRANSITION_INVALID_STATUS,
+    TRANSITION_NOT_FOUND,
+    TRANSITION_PERMISSION_DENIED,
+    PreparedOutboxJobs,
+    _now_utc,
+    _parse_datetime,
+    _stats_role,
+    task_stats_result,
+    unique_outbox_jobs,
+)
+from clms.downloadtool.storage.notify import ALL_CHANGED, TaskWatchers
+from clms.downloadtool.storage.schema import TASK_ID_SEQUENCE_START
+
+_MIN_DATETIME = datetime.min.replace(tzinfo=timezone.utc)
+
+# Secondary indexes, mirroring the indexed columns of the DB table
+INDEXED_COLUMNS = (
+    ("user_id", "UserID"),
+    ("status", "Status"),
+) + PAYLOAD_COLUMNS
+
+
+def _sort_key(task_id, payload):
+    """Return the (registration_datetime, task_id) pagination key."""
+    registered = _parse_datetime(payload.get("RegistrationDateTime"))
+    if registered is None:
+        registered = _MIN_DATETIME
+    elif registered.tzinfo is None:
+        registered = registered.replace(tzinfo=timezone.utc)
+    return registered, task_id
+
+
+def _moves_finished(payload, updates):
+    """Return True when updates move a finished task to another status."""
+    status = payload.get("Status")
+    if status not in FINISHED_STATUSES:
+        return False
+    return updates.get("Status") not in (None, status)
+
+
+def _fingerprint(dataset):
+    """Return the fingerprint of a dataset, like the DB repository."""
+    encoded = json.dumps(dataset, sort_keys=True).encode("utf-8")
+    return hashlib.sha512(encoded).hexdigest()
+
+
+def _index_values(payload):
+    """Return the indexed column values of a payload as text."""
+    values = {}
+    for column, key in INDEXED_COLUMNS:
+        value = payload.get(key)
+        if value is not None:
+            values[column] = str(value)
+    return values
 
 
 class MemoryDownloadtoolRepository:
-    """In-memory repository compatible with the DB repository interface."""
+    """In-memory repository compatible with the DB repository interface.
+
+    Tasks are indexed by the same columns as the DB table, so searches
+    and inspections by those keys do not scan every task. All methods
+    hold a lock, so the repository can be shared by Zope threads. Reads
+    return copies because callers modify the returned payloads. Like the
+    DB archive table, archived tasks are only read by id and by user.
+    """
 
     def __init__(self):
         self._tasks = {}
+        self._archive = {}
+        self._updated_at = {}
+        self._watchers = TaskWatchers()
+        self._next_id = TASK_ID_SEQUENCE_START
+        self._indexes = {column: {} for column, _ in INDEXED_COLUMNS}
+        self._outbox = []
+        self._lock = threading.RLock()
+
+    def _index_add(self, task_key, payload):
+        """Register a task in the secondary indexes."""
+        for column, value in _index_values(payload).items():
+            self._indexes[column].setdefault(value, {})[task_key] = None
+
+    def _index_remove(self, task_key, payload):
+        """Remove a task from the secondary indexes."""
+        for column, value in _index_values(payload).items():
+            task_keys = self._indexes[column].get(value)
+            if task_keys is None:
+                continue
+            task_keys.pop(task_key, None)
+            if not task_keys:
+                del self._indexes[column][value]
+
+    def _lookup(self, column, value):
+        """Return the task ids indexed under column = value."""
+        return self._indexes[column].get(str(value), {})
+
+    def _changed(self, task_key):
+        """Record the update time of a task and wake its watchers."""
+        self._updated_at[task_key] = _now_utc()
+        self._watchers.changed({"task_id": task_key})
+
+    def _merge(self, task_key, updates):
+        """Merge updates into a stored task keeping indexes in sync."""
+        payload = self._tasks[task_key]
+        self._index_remove(task_key, payload)
+        payload.update(updates)
+        self._index_add(task_key, payload)
+        if updates:
+            self._changed(task_key)
+        return dict(payload)
 
     def insert_task(self, task_id, payload):
         """Insert a task, returning True if inserted."""
         task_key = str(task_id)
-        if task_key in self._tasks:
-            return False
-        self._tasks[task_key] = dict(payload)
-        return True
+        with self._lock:
+            if task_key in self._tasks:
+                return False
+            self._tasks[task_key] = dict(payload)
+            self._index_add(task_key, self._tasks[task_key])
+            self._changed(task_key)
+            return True
+
+    def insert_task_next_id(self, payload):
+        """Insert a task with the next sequence id and return the id."""
+        with self._lock:
+            while str(self._next_id) in self._tasks:
+                self._next_id += 1
+            task_key = str(self._next_id)
+            self._next_id += 1
+            self._tasks[task_key] = dict(payload)
+            self._index_add(task_key, self._tasks[task_key])
+            self._changed(task_key)
+            return task_key
+
+    def insert_tasks_bulk(self, tasks):
+        """Insert several tasks at once.
+
+        Returns the task ids, or None when one of them already exists,
+        like the DB repository.
+        """
+        with self._lock:
+            task_ids = []
+            for task_id, _ in tasks:
+                if task_id is None:
+                    while str(self._next_id) in self._tasks:
+                        self._next_id += 1
+                    task_id = self._next_id
+                    self._next_id += 1
+                task_ids.append(str(task_id))
+            if len(set(task_ids)) < len(task_ids) or any(
+                task_key in self._tasks for task_key in task_ids
+            ):
+                return None
+            for task_key, (_, payload) in zip(task_ids, tasks):
+                self._tasks[task_key] = dict(payload)
+                self._index_add(task_key, self._tasks[task_key])
+                self._changed(task_key)
+            return task_ids
 
     def get_task(self, task_id):
         """Fetch a task payload by task id."""
         task_key = str(task_id)
-        task = self._tasks.get(task_key)
-        return dict(task) if task is not None else None
+        with self._lock:
+            task = self._tasks.get(task_key, self._archive.get(task_key))
+            return dict(task) if task is not None else None
+
+    def get_task_with_version(self, task_id):
+        """Fetch (payload, updated_at) of a task, None when missing."""
+        task_key = str(task_id)
+        with self._lock:
+            task = self.get_task(task_key)
+            if task is None:
+                return None
+            return task, self._updated_at.get(task_key)
+
+    @contextmanager
+    def watch_task(self, task_id):
+        """Yield an event set when the task changes."""
+        with self._watchers.watch(task_id) as event:
+            yield event
+
+    def has_duplicate_datasets(self, user_id, datasets):
+        """Return True when a dataset repeats among the requested ones and
+        those of the user's Queued and In_progress tasks."""
+        fingerprints = [_fingerprint(dataset) for dataset in datasets]
+        with self._lock:
+            for task_key in self._lookup("user_id", user_id):
+                payload = self._tasks[task_key]
+                active_datasets = payload.get("Datasets")
+                if payload.get("Status") not in ACTIVE_STATUSES:
+                    continue
+                if isinstance(active_datasets, list):
+                    fingerprints.extend(
+                        _fingerprint(dataset) for dataset in active_datasets
+                    )
+        return len(set(fingerprints)) < len(fingerprints)
 
     def search_tasks(self, user_id, status=None):
         """Return list of (task_id, payload) for a user and status."""
-        results = []
-        user_key = str(user_id)
-        for task_id, payload in self._tasks.items():
-            if payload.get("UserID") != user_key:
-                continue
-            if status is not None and payload.get("Status") != status:
-                continue
-            results.append((task_id, dict(payload)))
-        return results
+        with self._lock:
+            task_keys = self._lookup("user_id", user_id)
+            if status is not None:
+                status_keys = self._lookup("status", status)
+                task_keys = [
+                    task_key for task_key in task_keys
+                    if task_key in status_keys
+                ]
+            rows = [
+                (task_key, dict(self._tasks[task_key]))
+                for task_key in task_keys
+            ]
+            if status is None or status in FINISHED_STATUSES:
+                rows.extend(
+                    (task_key, dict(payload))
+                    for task_key, payload in self._archive.items()
+                    if str(payload.get("UserID")) == str(user_id) and (
+                        status is None or payload.get("Status") == status
+                    )
+                )
+            return rows
+
+    def search_tasks_page(self, user_id, status=None, limit=None, after=None,
+                          descending=True, fields=None):
+        """Return one keyset page of a user's tasks.
+
+        Returns a tuple (rows, next_after, total), see
+        DownloadtoolRepository.search_tasks_page.
+        """
+        matches = self.search_tasks(user_id, status=status)
+        total = len(matches)
+        keyed = sorted(
+            ((_sort_key(task_id, payload), task_id, payload)
+             for task_id, payload in matches),
+            key=lambda item: item[0],
+            reverse=descending,
+        )
+        if after is not None:
+            after_key = _sort_key(str(after[1]), {
+                "RegistrationDateTime": after[0]
+            })
+            keyed = [
+                item for item in keyed
+                if (item[0] < after_key if descending else item[0] > after_key)
+            ]
+
+        next_after = None
+        if limit is not None and len(keyed) > limit:
+            keyed = keyed[:limit]
+            last_key = keyed[-1][0]
+            registered = last_key[0] if last_key[0] != _MIN_DATETIME else None
+            next_after = (registered, last_key[1])
+
+        rows = []
+        for _, task_id, payload in keyed:
+            if fields is not None:
+                payload = {
+                    key: value for key, value in payload.items()
+                    if key in fields
+                }
+            rows.append((task_id, payload))
+        return rows, next_after, total
 
     def inspect_tasks(self, query=None):
-        """Return list of (task_id, payload) filtered by payload fields."""
-        results = []
-        if not query:
-            for task_id, payload in self._tasks.items():
-                results.append((task_id, dict(payload)))
-            return results
-
-        for task_id, payload in self._tasks.items():
-            for parameter, value in query.items():
-                if payload.get(parameter, "") == value:
-                    results.append((task_id, dict(payload)))
-                    break
-        return results
+        """Return list of (task_id, payload) filtered by payload fields.
+
+        Like the DB repository, results are sorted by task id.
+        """
+        with self._lock:
+            if not query:
+                task_keys = self._tasks
+            elif all(key in QUERY_COLUMNS for key in query):
+                task_keys = set()
+                for key, value in query.items():
+                    task_keys.update(self._lookup(QUERY_COLUMNS[key], value))
+            else:
+                task_keys = [
+                    task_key for task_key, payload in self._tasks.items()
+                    if self._matches(payload, query)
+                ]
+            return [
+                (task_key, dict(self._tasks[task_key]))
+                for task_key in sorted(task_keys)
+            ]
+
+    @staticmethod
+    def _matches(payload, query):
+        """Return True when the payload matches any query field."""
+        values = _index_values(payload)
+        for key, value in query.items():
+            column = QUERY_COLUMNS.get(key)
+            if column is not None:
+                if values.get(column) == str(value):
+                    return True
+            elif key in payload and payload[key] == value:
+                return True
+        return False
+
+    def iter_inspect_tasks(self, query=None, itersize=None):
+        """Yield (task_id, payload) filtered by payload fields."""
+        yield from self.inspect_tasks(query)
 
     def update_task(self, task_id, updates, status=None):
         """Merge updates into the payload and return the new payload."""
         task_key = str(task_id)
-        if task_key not in self._tasks:
-            return None
-        self._tasks[task_key].update(updates)
-        return dict(self._tasks[task_key])
+        with self._lock:
+            if task_key not in self._tasks:
+                return None
+            return self._merge(task_key, updates)
+
+    def transition_task(self, task_id, expected_statuses, updates,
+                        user_id=None, exclude=False):
+        """Merge updates into a task only when its status is expected.
+
+        Returns a tuple (outcome, payload), like the DB repository.
+        """
+        task_key = str(task_id)
+        with self._lock:
+            payload = self._tasks.get(task_key)
+            if payload is None:
+                payload = self._archive.get(task_key)
+                if payload is None:
+                    return TRANSITION_NOT_FOUND, None
+                archived = True
+            else:
+                archived = False
+            if user_id is not None and (
+                str(payload.get("UserID")) != str(user_id)
+            ):
+                return TRANSITION_PERMISSION_DENIED, dict(payload)
+            expected = True
+            if expected_statuses is not None:
+                status = payload.get("Status") or ""
+                expected = (status in expected_statuses) != exclude
+            if archived or not expected:
+                return TRANSITION_INVALID_STATUS, dict(payload)
+            return TRANSITION_DONE, self._merge(task_key, updates)
+
+    def update_tasks_bulk(self, updates):
+        """Merge updates into several payloads.
+
+        See DownloadtoolRepository.update_tasks_bulk.
+        Returns a tuple ({task_id: new_payload}, [missing task ids],
+        [skipped finished task ids]).
+        """
+        updated = {}
+        missing = []
+        finished = []
+        with self._lock:
+            for task_id, task_updates in updates.items():
+                task_key = str(task_id)
+                if task_key not in self._tasks:
+                    missing.append(task_key)
+                    continue
+                payload = self._tasks[task_key]
+                if _moves_finished(payload, task_updates):
+                    finished.append(task_key)
+                    continue
+                if all(
+                    key in payload and payload[key] == value
+                    for key, value in task_updates.items()
+                ):
+                    # Unchanged tasks are not notified
+                    updated[task_key] = dict(payload)
+                    continue
+                updated[task_key] = self._merge(task_key, task_updates)
+        return updated, missing, finished
 
     def delete_task(self, task_id):
         """Delete one task by id, returning True when removed."""
         task_key = str(task_id)
-        return self._tasks.pop(task_key, None) is not None
+        with self._lock:
+            archived = self._archive.pop(task_key, None)
+            payload = self._tasks.pop(task_key, None)
+            if payload is None and archived is None:
+                return False
+            self._updated_at.pop(task_key, None)
+            self._watchers.changed({"task_id": task_key})
+            if payload is not None:
+                self._index_remove(task_key, payload)
+            return True
+
+    def delete_tasks_by_group(self, cdse_task_group_id, role=None):
+        """Delete the tasks of a CDSE task group, optionally by role.
+
+        Returns the list of removed task ids.
+        """
+        with self._lock:
+            task_keys = list(
+                self._lookup("cdse_task_group_id", cdse_task_group_id)
+            )
+            if role is not None:
+                role_keys = self._lookup("cdse_task_role", role)
+                task_keys = [
+                    task_key for task_key in task_keys
+                    if task_key in role_keys
+                ]
+            for task_key in task_keys:
+                self._index_remove(task_key, self._tasks.pop(task_key))
+                self._updated_at.pop(task_key, None)
+                self._watchers.changed({"task_id": task_key})
+            return task_keys
+
+    def purge_tasks(self, status, older_than, batch_size=1000):
+        """Delete at most batch_size tasks registered before a datetime.
+
+        See DownloadtoolRepository.purge_tasks.
+        """
+        if older_than.tzinfo is None:
+            older_than = older_than.replace(tzinfo=timezone.utc)
+        task_keys = []
+        with self._lock:
+            for tasks in (self._tasks, self._archive):
+                for task_key, payload in list(tasks.items()):
+                    if len(task_keys) >= batch_size:
+                        break
+                    if payload.get("Status") != status:
+                        continue
+                    registered = _sort_key(task_key, payload)[0]
+                    if registered == _MIN_DATETIME:
+                        registered = self._updated_at.get(task_key)
+                    if registered is None or registered >= older_than:
+                        continue
+                    del tasks[task_key]
+                    if tasks is self._tasks:
+                        self._index_remove(task_key, payload)
+                    self._updated_at.pop(task_key, None)
+                    self._watchers.changed({"task_id": task_key})
+                    task_keys.append(task_key)
+        return task_keys
+
+    def add_outbox_jobs(self, jobs):
+        """Store async jobs in the outbox and return their number."""
+        prepared = self.prepare_outbox_jobs(jobs)
+        prepared.commit()
+        return prepared.count
+
+    def prepare_outbox_jobs(self, jobs):
+        """Store async jobs in the outbox without committing them.
+
+        See DownloadtoolRepository.prepare_outbox_jobs. The jobs are
+        added to the outbox by the commit.
+        """
+        jobs = [
+            json.loads(json.dumps(dict(
+                {field: job[field] for field in OUTBOX_FIELDS},
+                job_key=job.get("job_key"),
+            )))
+            for job in unique_outbox_jobs(jobs)
+        ]
+
+        def commit():
+            with self._lock:
+                for job in jobs:
+                    replaced = None
+                    if job["job_key"] is not None:
+                        replaced = next((
+                            index
+                            for index, pending in enumerate(self._outbox)
+                            if pending["job_key"] == job["job_key"]
+                        ), None)
+                    if replaced is None:
+                        self._outbox.append(job)
+                    else:
+                        self._outbox[replaced] = job
+
+        return PreparedOutboxJobs(len(jobs), commit)
+
+    def relay_outbox_jobs(self, publish, batch_size=100):
+        """Publish the oldest outbox jobs and remove them.
+
+        See DownloadtoolRepository.relay_outbox_jobs. The jobs are taken
+        out while they are published, and put back when it fails.
+        """
+        with self._lock:
+            jobs = self._outbox[:batch_size]
+            del self._outbox[:batch_size]
+        if not jobs:
+            return 0
+        try:
+            publish([
+                {field: job[field] for field in OUTBOX_FIELDS}
+                for job in jobs
+            ])
+        except BaseException:
+            with self._lock:
+                self._outbox[:0] = jobs
+            raise
+        return len(jobs)
 
     def delete_all(self):
         """Delete all tasks and return the number removed."""
-        count = len(self._tasks)
-        self._tasks.clear()
-        return count
+        with self._lock:
+            count = len(self._tasks) + len(self._archive)
+            self._tasks.clear()
+            self._archive.clear()
+            self._updated_at.clear()
+            self._watchers.changed(ALL_CHANGED)
+            for index in self._indexes.values():
+                index.clear()
+            return count
 
     def has_tasks(self):
         """Return True when the repository has at least one task."""
-        return bool(self._tasks)
+        with self._lock:
+            return bool(self._tasks or self._archive)
+
+    def task_stats(self, since=None):
+        """Return task counts and the age of the queued tasks.
+
+        See DownloadtoolRepository.task_stats.
+        """
+        if since is not None and since.tzinfo is None:
+            since = since.replace(tzinfo=timezone.utc)
+        now = _now_utc()
+        counts = {}
+        hours = []
+        ages = []
+        with self._lock:
+            for payload in self._tasks.values():
+                key = (
+                    payload.get("Status"),
+                    _stats_role(payload.get("cdse_task_role")),
+                )
+                counts[key] = counts.get(key, 0) + 1
+                registered = _parse_datetime(
+                    payload.get("RegistrationDateTime")
+                )
+                if registered is None:
+                    continue
+                if registered.tzinfo is None:
+                    registered = registered.replace(tzinfo=timezone.utc)
+                if since is None or registered >= since:
+                    hours.append((registered, 1))
+                if payload.get("Status") in ACTIVE_STATUSES:
+                    ages.append((now - registered).total_seconds())
+        return task_stats_result(
+            [key + (count,) for key, count in counts.items()], hours, ages
+        )
+
+    def archive_finished_tasks(self, older_than, batch_size=1000):
+        """Move finished tasks registered before a datetime to the archive.
+
+        Returns the number of archived tasks.
+        """
+        if older_than.tzinfo is None:
+            older_than = older_than.replace(tzinfo=timezone.utc)
+        with self._lock:
+            task_keys = [
+                task_key for task_key, payload in self._tasks.items()
+                if payload.get("Status") in FINISHED_STATUSES and (
+                    _sort_key(task_key, payload)[0] < older_than
+                )
+            ]
+            for task_key in task_keys:
+                payload = self._tasks.pop(task_key)
+                self._index_remove(task_key, payload)
+                self._archive[task_key] = payload
+            return len(task_keys)
@@ -0,0 +1,306 @@
+"""Repository instrumentation exported in the Prometheus text format."""
+import functools
+import inspect
+import os
+import threading
+import time
+
+# Upper bounds in seconds of the latency histogram buckets
+DEFAULT_BUCKETS = (
+    0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0,
+    10.0,
+)
+
+# Rows affected or returned by each repository method, from its result.
+# Other methods count one row unless they return None or False.
+ROW_COUNTS = {
+    "search_tasks": len,
+    "search_tasks_page": lambda result: len(result[0]),
+    "inspect_tasks": len,
+    "update_tasks_bulk": lambda result: len(result[0]),
+    "insert_tasks_bulk": lambda result: len(result or ()),
+    "delete_tasks_by_group": len,
+    "purge_tasks": len,
+    "delete_all": int,
+    "archive_finished_tasks": int,
+    "add_outbox_jobs": int,
+    "prepare_outbox_jobs": lambda result: result.count,
+    "relay_outbox_jobs": int,
+    "has_tasks": lambda result: 0,
+    "has_duplicate_datasets": lambda result: 0,
+}
+
+# Results of insert methods meaning a task id was already used
+COLLISIONS = {
+    "insert_task": False,
+    "insert_tasks_bulk": None,
+}
+
+# Methods returning no data, or context managers, are not timed
+UNTIMED = ("watch_task", "pool_stats", "close")
+
+
+def metrics_enabled():
+    """Return True when repository metrics are enabled through env."""
+    return os.environ.get("DOWNLOADTOOL_METRICS", "").strip() == "1"
+
+
+def _count_rows(method, result):
+    """Return the number of rows of a repository method result."""
+    count = ROW_COUNTS.get(method)
+    if count is not None:
+        return count(result)
+    return 0 if result is None or result is False else 1
+
+
+def _format_value(value):
+    """Format a sample value like the Prometheus client does."""
+    if isinstance(value, float):
+        return repr(value)
+    return str(value)
+
+
+def render_families(families):
+    """Return metric families in the Prometheus text exposition format.
+
+    ``families`` are (name, kind, help_text, samples) tuples, samples
+    are (sample_name, labels, value) with labels as (key, value) pairs.
+    """
+    lines = []
+    for name, kind, help_text, samples in families:
+        lines.append("# HELP {0} {1}".format(name, help_text))
+        lines.append("# TYPE {0} {1}".format(name, kind))
+        for sample_name, labels, value in samples:
+            label_text = ""
+            if labels:
+                label_text = "{{{0}}}".format(",".join(
+                    '{0}="{1}"'.format(key, label) for key, label in labels
+                ))
+            lines.append("{0}{1} {2}".format(
+                sample_name, label_text, _format_value(value)
+            ))
+    return "\n".join(lines) + "\n"
+
+
+class Histogram:
+    """Cumulative bucket counts, sum and count of observed values."""
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.total = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        """Add one observed value."""
+        for index, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[index] += 1
+        self.total += value
+        self.count += 1
+
+    def samples(self, name, labels):
+        """Yield the (name, labels, value) samples of the histogram."""
+        for bound, count in zip(self.buckets, self.counts):
+            yield name + "_bucket", labels + (("le", repr(bound)),), count
+        yield name + "_bucket", labels + (("le", "+Inf"),), self.count
+        yield name + "_sum", labels, self.total
+        yield name + "_count", labels, self.count
+
+
+class RepositoryMetrics:
+    """Latency, rows, errors and collisions of repository calls.
+
+    Values are kept per method name for the life of the process, like
+    Prometheus counters, and rendered by ``render``.
+    """
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = buckets
+        self._lock = threading.Lock()
+        self._durations = {}
+        self._rows = {}
+        self._errors = {}
+        self._collisions = {}
+        self._connection = Histogram(buckets)
+
+    def observe_call(self, method, seconds, rows=0, error=False):
+        """Record one call of a repository method."""
+        with self._lock:
+            histogram = self._durations.get(method)
+            if histogram is None:
+                histogram = self._durations[method] = Histogram(self.buckets)
+            histogram.observe(seconds)
+            self._rows[method] = self._rows.get(method, 0) + rows
+            if error:
+                self._errors[method] = self._errors.get(method, 0) + 1
+
+    def observe_collision(self, method):
+        """Record an insert rejected because the task id exists."""
+        with self._lock:
+            self._collisions[method] = self._collisions.get(method, 0) + 1
+
+    def observe_connection(self, seconds):
+        """Record the time taken to get a DB connection."""
+        with self._lock:
+            self._connection.observe(seconds)
+
+    def render(self, pool_stats=None):
+        """Return the metrics in the Prometheus text exposition format.
+
+        ``pool_stats`` are the connection pool metrics of the repository,
+        exported as gauges.
+        """
+        families = []
+
+        def family(name, kind, help_text, samples):
+            families.append((name, kind, help_text, list(samples)))
+
+        def by_method(name, values):
+            return [
+                (name, (("method", method),), value)
+                for method, value in sorted(values.items())
+            ]
+
+        with self._lock:
+            name = "downloadtool_repository_call_duration_seconds"
+            family(name, "histogram", "Duration of repository calls.", [
+                sample
+                for method, histogram in sorted(self._durations.items())
+                for sample in histogram.samples(name, (("method", method),))
+            ])
+            name = "downloadtool_repository_rows_total"
+            family(
+                name, "counter", "Rows returned or changed by repository "
+                "calls.", by_method(name, self._rows),
+            )
+            name = "downloadtool_repository_errors_total"
+            family(
+                name, "counter", "Repository calls that raised an error.",
+                by_method(name, self._errors),
+            )
+            name = "downloadtool_repository_insert_collisions_total"
+            family(
+                name, "counter", "Inserts rejected because the task id "
+                "was already used.", by_method(name, self._collisions),
+            )
+            name = "downloadtool_repository_connection_acquire_seconds"
+            family(
+                name, "histogram", "Time taken to get a DB connection.",
+                self._connection.samples(name, ()),
+            )
+        for key, value in sorted((pool_stats or {}).items()):
+            name = "downloadtool_repository_pool_{0}".format(key)
+            family(name, "gauge", "Connection pool {0}.".format(
+                key.replace("_", " ")
+            ), [(name, (), value)])
+        return render_families(families)
+
+
+class InstrumentedDownloadtoolRepository:
+    """Repository wrapper recording the metrics of each public method.
+
+    Sync, generator and coroutine methods are timed until they return,
+    are exhausted or are awaited. The wrapped DB repository also reports
+    its connection acquisition times.
+    """
+
+    def __init__(self, repository, metrics=None):
+        self.repository = repository
+        self.metrics = metrics or RepositoryMetrics()
+        if hasattr(repository, "metrics"):
+            repository.metrics = self.metrics
+
+    def __getattr__(self, name):
+        attribute = getattr(self.repository, name)
+        if name.startswith("_") or name in UNTIMED:
+            return attribute
+        if not callable(attribute):
+            return attribute
+        if inspect.isgeneratorfunction(attribute):
+            return self._instrument_generator(name, attribute)
+        if inspect.isasyncgenfunction(attribute):
+            return self._instrument_async_generator(name, attribute)
+        if inspect.iscoroutinefunction(attribute):
+            return self._instrument_coroutine(name, attribute)
+        return self._instrument(name, attribute)
+
+    def _record(self, name, started, result=None, error=False):
+        """Record a finished call."""
+        elapsed = time.monotonic() - started
+        if error:
+            self.metrics.observe_call(name, elapsed, error=True)
+            return
+        self.metrics.observe_call(name, elapsed, _count_rows(name, result))
+        if name in COLLISIONS and result is COLLISIONS[name]:
+            self.metrics.observe_collision(name)
+
+    def _record_rows(self, name, started, rows):
+        """Record a finished or closed generator call."""
+        self.metrics.observe_call(name, time.monotonic() - started, rows)
+
+    def _instrument(self, name, method):
+        """Wrap a method returning its result."""
+        @functools.wraps(method)
+        def wrapper(*args, **kwargs):
+            started = time.monotonic()
+            try:
+                result = method(*args, **kwargs)
+            except Exception:
+                self._record(name, started, error=True)
+                raise
+            self._record(name, started, result)
+            return result
+        return wrapper
+
+    def _instrument_generator(self, name, method):
+        """Wrap a generator method, counting the yielded rows."""
+        @functools.wraps(method)
+        def wrapper(*args, **kwargs):
+            started = time.monotonic()
+            rows = 0
+            try:
+                for row in method(*args, **kwargs):
+                    rows += 1
+                    yield row
+            except GeneratorExit:
+                self._record_rows(name, started, rows)
+                raise
+            except Exception:
+                self._record(name, started, error=True)
+                raise
+            self._record_rows(name, started, rows)
+        return wrapper
+
+    def _instrument_async_generator(self, name, method):
+        """Wrap an async generator method, counting the yielded rows."""
+        @functools.wraps(method)
+        async def wrapper(*args, **kwargs):
+            started = time.monotonic()
+            rows = 0
+            try:
+                async for row in method(*args, **kwargs):
+                    rows += 1
+                    yield row
+            except GeneratorExit:
+                self._record_rows(name, started, rows)
+                raise
+            except Exception:
+                self._record(name, started, error=True)
+                raise
+            self._record_rows(name, started, rows)
+        return wrapper
+
+    def _instrument_coroutine(self, name, method):
+        """Wrap a coroutine method of the asyncio repository."""
+        @functools.wraps(method)
+        async def wrapper(*args, **kwargs):
+            started = time.monotonic()
+            try:
+                result = await method(*args, **kwargs)
+            except Exception:
+                self._record(name, started, error=True)
+                raise
+            self._record(name, started, result)
+            return result
+        return wrapper
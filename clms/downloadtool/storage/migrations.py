@@ -0,0 +1,101 @@
+"""Versioned schema migrations for the download tool PostgreSQL storage.
+
+Each migration has a version number, a description and a function
+returning its DDL statements. Applied versions are stored in the
+schema version table, so ``migrate`` only runs the pending ones.
+"""
+from logging import getLogger
+
+from clms.downloadtool.storage.db import TABLE_NAME
+from clms.downloadtool.storage.schema import (
+    archive_table_ddl,
+    dataset_fingerprints_ddl,
+    create_table_ddl,
+    extracted_columns_ddl,
+    job_outbox_ddl,
+    task_id_sequence_ddl,
+    tuned_indexes_ddl,
+)
+
+log = getLogger(__name__)
+
+VERSION_TABLE_NAME = "downloadtool_schema_version"
+
+# Serializes concurrent migrations started by several ZEO clients
+MIGRATION_LOCK_ID = 4733201
+
+MIGRATIONS = (
+    (1, "Create the tasks table", create_table_ddl),
+    (2, "Indexed FME and CDSE lookup columns", extracted_columns_ddl),
+    (3, "Search, active status and payload indexes", tuned_indexes_ddl),
+    (4, "Task id sequence", task_id_sequence_ddl),
+    (5, "Partitioned archive of finished tasks", archive_table_ddl),
+    (6, "Dataset fingerprints of tasks", dataset_fingerprints_ddl),
+    (7, "Outbox of async jobs", job_outbox_ddl),
+)
+
+
+def _ensure_version_table(cursor):
+    """Create the schema version table when missing."""
+    cursor.execute(
+        """
+        CREATE TABLE IF NOT EXISTS {table} (
+            version integer PRIMARY KEY,
+            description text NOT NULL,
+            applied_at timestamptz NOT NULL DEFAULT now()
+        )
+        """.format(table=VERSION_TABLE_NAME)
+    )
+
+
+def schema_version(repository):
+    """Return the latest applied migration version, 0 when none."""
+    with repository._connection() as conn:
+        with conn.cursor() as cursor:
+            cursor.execute(
+                "SELECT to_regclass(%s) IS NOT NULL", (VERSION_TABLE_NAME,)
+            )
+            if not cursor.fetchone()[0]:
+                return 0
+            cursor.execute(
+                "SELECT COALESCE(max(version), 0) FROM {table}".format(
+                    table=VERSION_TABLE_NAME
+                )
+            )
+            return cursor.fetchone()[0]
+
+
+def migrate(repository, migrations=MIGRATIONS):
+    """Apply pending migrations, each in its own transaction.
+
+    Returns the list of applied versions.
+    """
+    applied = []
+    for version, description, statements in migrations:
+        with repository._connection() as conn:
+            with conn.cursor() as cursor:
+                cursor.execute(
+                    "SELECT pg_advisory_xact_lock(%s)", (MIGRATION_LOCK_ID,)
+                )
+                _ensure_version_table(cursor)
+                cursor.execute(
+                    "SELECT 1 FROM {table} WHERE version = %s".format(
+                        table=VERSION_TABLE_NAME
+                    ),
+                    (version,),
+                )
+                if cursor.fetchone() is not None:
+                    continue
+                log.info(
+                    "Migrating %s to version %s: %s",
+                    TABLE_NAME, version, description,
+                )
+                for statement in statements():
+                    cursor.execute(statement)
+                cursor.execute(
+                    "INSERT INTO {table} (version, description) "
+                    "VALUES (%s, %s)".format(table=VERSION_TABLE_NAME),
+                    (version, description),
+                )
+        applied.append(version)
+    return applied
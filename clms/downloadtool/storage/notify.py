@@ -0,0 +1,214 @@
+"""Task change notifications through PostgreSQL LISTEN/NOTIFY.
+
+Repository writes send one notification per changed task on
+NOTIFY_CHANNEL, delivered when the transaction commits. A listener
+thread per process receives them on a dedicated connection and passes
+each change to its subscribers. A change is a dict with ``task_id`` and
+``user_id`` keys, ``{"all": True}`` when every task may have changed.
+"""
+import json
+import os
+import select
+import threading
+from contextlib import contextmanager
+from logging import getLogger
+
+log = getLogger(__name__)
+
+NOTIFY_CHANNEL = "downloadtool_task_changes"
+
+# Change passed to subscribers when notifications may have been missed
+ALL_CHANGED = {"all": True}
+
+# Seconds between reconnection attempts of the listener
+RECONNECT_DELAY = 5.0
+
+# Seconds a new listener may take to start listening
+LISTEN_TIMEOUT = 1.0
+
+
+def notify_enabled():
+    """Return True when repository writes must send notifications.
+
+    Caches rely on the notifications of every writer, so enabling the
+    task cache enables them too.
+    """
+    return any(
+        os.environ.get(name, "").strip() == "1"
+        for name in ("DOWNLOADTOOL_DB_NOTIFY", "DOWNLOADTOOL_CACHE")
+    )
+
+
+def notify_changes(cursor, changes):
+    """Queue notifications of changes in the cursor's transaction."""
+    if not changes:
+        return
+    cursor.execute(
+        "SELECT pg_notify(%s, change) FROM unnest(%s::text[]) AS change",
+        (NOTIFY_CHANNEL, [json.dumps(change) for change in changes]),
+    )
+
+
+class TaskChangeListener:
+    """Background thread dispatching task change notifications.
+
+    ``connect`` opens a new DB connection. Subscribers are called from
+    the listener thread, so they must be quick and thread-safe. After a
+    connection loss they receive ALL_CHANGED, since notifications sent
+    meanwhile are lost.
+    """
+
+    def __init__(self, connect, channel=NOTIFY_CHANNEL):
+        self.connect = connect
+        self.channel = channel
+        self._subscribers = []
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+        self.listening = threading.Event()
+        self._thread = None
+
+    def subscribe(self, callback):
+        """Register a callback receiving each change, start listening."""
+        with self._lock:
+            self._subscribers.append(callback)
+            if self._thread is None:
+                self._thread = threading.Thread(
+                    target=self._run,
+                    name="downloadtool-task-changes",
+                    daemon=True,
+                )
+                self._thread.start()
+
+    def unsubscribe(self, callback):
+        """Remove a callback registered with subscribe."""
+        with self._lock:
+            if callback in self._subscribers:
+                self._subscribers.remove(callback)
+
+    def stop(self):
+        """Stop the listener thread."""
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join()
+
+    def _dispatch(self, change):
+        """Pass one change to every subscriber."""
+        with self._lock:
+            subscribers = list(self._subscribers)
+        for callback in subscribers:
+            try:
+                callback(change)
+            except Exception:
+                log.exception("Task change subscriber failed")
+
+    def _run(self):
+        """Listen until stopped, reconnecting after connection errors."""
+        connected_once = False
+        while not self._stopped.is_set():
+            conn = None
+            try:
+                conn = self.connect()
+                conn.autocommit = True
+                with conn.cursor() as cursor:
+                    cursor.execute("LISTEN {0}".format(self.channel))
+                self.listening.set()
+                if connected_once:
+                    self._dispatch(ALL_CHANGED)
+                connected_once = True
+                self._listen(conn)
+            except Exception:
+                log.exception("Task change listener failed, reconnecting")
+                self.listening.clear()
+                self._stopped.wait(RECONNECT_DELAY)
+            finally:
+                if conn is not None:
+                    try:
+                        conn.close()
+                    except Exception:
+                        pass
+
+    def _listen(self, conn):
+        """Dispatch the notifications received on conn until stopped."""
+        while not self._stopped.is_set():
+            if select.select([conn], [], [], 1.0) == ([], [], []):
+                continue
+            conn.poll()
+            while conn.notifies:
+                notification = conn.notifies.pop(0)
+                try:
+                    change = json.loads(notification.payload)
+                except ValueError:
+                    change = ALL_CHANGED
+                self._dispatch(change)
+
+
+_listeners = {}
+_listeners_lock = threading.Lock()
+
+
+def get_listener(repository):
+    """Return the listener of a repository's database, one per process."""
+    with _listeners_lock:
+        listener = _listeners.get(repository.dsn)
+        if listener is None:
+            listener = TaskChangeListener(repository._connect)
+            _listeners[repository.dsn] = listener
+        return listener
+
+
+class TaskWatchers:
+    """Events set when watched tasks change."""
+
+    def __init__(self):
+        self._events = {}
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def watch(self, task_id):
+        """Yield an event set by the next change of the task."""
+        task_key = str(task_id)
+        event = threading.Event()
+        with self._lock:
+            self._events.setdefault(task_key, set()).add(event)
+        try:
+            yield event
+        finally:
+            with self._lock:
+                events = self._events.get(task_key, set())
+                events.discard(event)
+                if not events:
+                    self._events.pop(task_key, None)
+
+    def changed(self, change):
+        """Set the events of the tasks affected by a change."""
+        with self._lock:
+            if change.get("all"):
+                events = [
+                    event for events in self._events.values()
+                    for event in events
+                ]
+            else:
+                events = list(self._events.get(str(change.get("task_id")), ()))
+        for event in events:
+            event.set()
+
+
+_watchers = {}
+
+
+def get_watchers(repository):
+    """Return the task watchers fed by a repository's listener.
+
+    Returns None when the listener does not listen yet, so callers do not
+    wait for notifications that would not be received.
+    """
+    listener = get_listener(repository)
+    with _listeners_lock:
+        watchers = _watchers.get(repository.dsn)
+        if watchers is None:
+            watchers = TaskWatchers()
+            _watchers[repository.dsn] = watchers
+            listener.subscribe(watchers.changed)
+    if not listener.listening.wait(LISTEN_TIMEOUT):
+        return None
+    return watchers
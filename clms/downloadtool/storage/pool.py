@@ -0,0 +1,232 @@
+"""Thread-safe connection pool for the download tool PostgreSQL storage."""
+import os
+import threading
+import time
+from logging import getLogger
+
+try:
+    from App.config import getConfiguration
+except ImportError:
+    getConfiguration = None
+
+log = getLogger(__name__)
+
+# waitress (the Plone 6 WSGI server) runs 4 worker threads by default,
+# the pool size when the Zope configuration has no thread count
+DEFAULT_POOL_SIZE = 4
+DEFAULT_POOL_TIMEOUT = 30.0
+DEFAULT_POOL_MAX_IDLE = 300.0
+DEFAULT_POOL_HEALTH_CHECK = 30.0
+
+
+class PoolTimeout(RuntimeError):
+    """Raised when no connection becomes available in time."""
+
+
+def env_number(name, default, cast=float):
+    """Read a numeric setting from environment, falling back to default."""
+    value = os.environ.get(name, "").strip()
+    if not value:
+        return default
+    try:
+        return cast(value)
+    except ValueError:
+        log.warning("Invalid value for %s: %r, using %s", name, value, default)
+        return default
+
+
+def default_pool_size():
+    """Return the worker thread count of Zope, one connection each.
+
+    It is read from the zserver-threads setting of zope.conf, the
+    threads of a WSGI server are not known to Zope: DEFAULT_POOL_SIZE
+    is returned then, or outside Zope.
+    """
+    if getConfiguration is None:
+        return DEFAULT_POOL_SIZE
+    threads = getattr(getConfiguration(), "zserver_threads", None)
+    if not isinstance(threads, int) or threads < 1:
+        return DEFAULT_POOL_SIZE
+    return threads
+
+
+def pool_enabled():
+    """Return True when pooled connections are enabled through env."""
+    return os.environ.get("DOWNLOADTOOL_DB_POOL", "").strip() == "1"
+
+
+def pool_settings():
+    """Return the pool keyword arguments configured in environment."""
+    return {
+        "size": env_number(
+            "DOWNLOADTOOL_DB_POOL_SIZE", default_pool_size(), cast=int
+        ),
+        "timeout": env_number(
+            "DOWNLOADTOOL_DB_POOL_TIMEOUT", DEFAULT_POOL_TIMEOUT
+        ),
+        "max_idle": env_number(
+            "DOWNLOADTOOL_DB_POOL_MAX_IDLE", DEFAULT_POOL_MAX_IDLE
+        ),
+        "health_check": env_number(
+            "DOWNLOADTOOL_DB_POOL_HEALTH_CHECK", DEFAULT_POOL_HEALTH_CHECK
+        ),
+    }
+
+
+class ConnectionPool:
+    """Bounded pool of DB connections shared by the Zope threads.
+
+    Connections are created lazily by ``factory`` up to ``size``. A
+    connection that was idle longer than ``max_idle`` seconds is closed
+    instead of reused, and one idle longer than ``health_check`` seconds
+    is pinged with ``SELECT 1`` before it is handed out again.
+    """
+
+    def __init__(self, factory, size=DEFAULT_POOL_SIZE,
+                 timeout=DEFAULT_POOL_TIMEOUT, max_idle=DEFAULT_POOL_MAX_IDLE,
+                 health_check=DEFAULT_POOL_HEALTH_CHECK):
+        self.factory = factory
+        self.size = max(1, int(size))
+        self.timeout = timeout
+        self.max_idle = max_idle
+        self.health_check = health_check
+        self._idle = []
+        self._in_use = 0
+        self._condition = threading.Condition()
+        self._stats = {
+            "created": 0,
+            "discarded": 0,
+            "checkouts": 0,
+            "waits": 0,
+            "wait_seconds": 0.0,
+            "max_wait_seconds": 0.0,
+            "timeouts": 0,
+        }
+
+    def getconn(self):
+        """Check out a connection, waiting up to ``timeout`` seconds."""
+        self._reserve()
+        try:
+            conn = self._take_idle()
+            if conn is None:
+                conn = self._create()
+        except Exception:
+            with self._condition:
+                self._in_use -= 1
+                self._condition.notify()
+            raise
+        return conn
+
+    def putconn(self, conn, discard=False):
+        """Return a connection to the pool, closing it when broken."""
+        if not discard:
+            discard = conn.closed or not self._reset(conn)
+        with self._condition:
+            self._in_use -= 1
+            if discard:
+                self._stats["discarded"] += 1
+            else:
+                self._idle.append((conn, time.monotonic()))
+            self._condition.notify()
+        if discard:
+            self._close(conn)
+
+    def closeall(self):
+        """Close every idle connection."""
+        with self._condition:
+            idle, self._idle = self._idle, []
+        for conn, _ in idle:
+            self._close(conn)
+
+    def stats(self):
+        """Return a snapshot of pool usage and wait metrics."""
+        with self._condition:
+            stats = dict(self._stats)
+            stats.update({
+                "size": self.size,
+                "in_use": self._in_use,
+                "idle": len(self._idle),
+            })
+        return stats
+
+    def _create(self):
+        """Open a new connection through the factory."""
+        conn = self.factory()
+        with self._condition:
+            self._stats["created"] += 1
+        return conn
+
+    def _reserve(self):
+        """Block until fewer than ``size`` connections are checked out."""
+        started = time.monotonic()
+        waited = False
+        with self._condition:
+            while self._in_use >= self.size:
+                waited = True
+                remaining = None
+                if self.timeout is not None:
+                    remaining = self.timeout - (time.monotonic() - started)
+                    if remaining <= 0:
+                        self._stats["timeouts"] += 1
+                        raise PoolTimeout(
+                            "No DB connection available after {0}s".format(
+                                self.timeout
+                            )
+                        )
+                self._condition.wait(remaining)
+            self._in_use += 1
+            self._stats["checkouts"] += 1
+            if waited:
+                elapsed = time.monotonic() - started
+                self._stats["waits"] += 1
+                self._stats["wait_seconds"] += elapsed
+                if elapsed > self._stats["max_wait_seconds"]:
+                    self._stats["max_wait_seconds"] = elapsed
+
+    def _take_idle(self):
+        """Return the most recently used healthy idle connection or None."""
+        while True:
+            with self._condition:
+                if not self._idle:
+                    return None
+                conn, released = self._idle.pop()
+            idle_for = time.monotonic() - released
+            expired = self.max_idle is not None and idle_for > self.max_idle
+            stale = (
+                self.health_check is not None and idle_for > self.health_check
+            )
+            if conn.closed or expired or (stale and not self._ping(conn)):
+                with self._condition:
+                    self._stats["discarded"] += 1
+                self._close(conn)
+                continue
+            return conn
+
+    @staticmethod
+    def _reset(conn):
+        """Roll back any leftover transaction, returning False on error."""
+        try:
+            conn.rollback()
+        except Exception:
+            return False
+        return True
+
+    @staticmethod
+    def _ping(conn):
+        """Return True when the connection still answers queries."""
+        try:
+            with conn.cursor() as cursor:
+                cursor.execute("SELECT 1")
+            conn.rollback()
+        except Exception:
+            log.info("Discarding broken pooled DB connection")
+            return False
+        return True
+
+    @staticmethod
+    def _close(conn):
+        """Close a connection ignoring errors."""
+        try:
+            conn.close()
+        except Exception:
+            pass
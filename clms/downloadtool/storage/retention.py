@@ -0,0 +1,164 @@
+"""Retention of old download tool tasks.
+
+Tasks older than the retention days of their status are deleted in
+chunks of ``batch_size``, each one in its own short transaction, with a
+pause between chunks. Row locks are held briefly and the WAL of the
+deletes is written a chunk at a time, so the purge can run next to the
+live traffic. It is called by the downloadtool-purge worker view, or
+from the command line::
+
+    downloadtool_purge --days Cancelled=30,Rejected=30 --max-seconds 600
+"""
+import argparse
+import json
+import logging
+import os
+import sys
+import time
+from datetime import datetime, timedelta, timezone
+
+from clms.downloadtool.storage import get_repository
+
+log = logging.getLogger(__name__)
+
+# Days tasks are kept after their registration, by status, or after
+# their last update when they have no registration date. Tasks in other
+# statuses are never purged.
+DEFAULT_RETENTION_DAYS = {
+    "Finished_ok": 365,
+    "Finished_nok": 365,
+    "Cancelled": 180,
+    "Rejected": 180,
+}
+
+# Tasks deleted per transaction, and seconds to wait between chunks
+DEFAULT_PURGE_BATCH_SIZE = 500
+DEFAULT_PURGE_PAUSE = 0.5
+
+
+def retention_days(value=None):
+    """Return the retention days by status.
+
+    ``value`` is a dict or a "Status=days,Status=days" text overriding
+    the defaults, by default taken from DOWNLOADTOOL_RETENTION_DAYS.
+    Raises ValueError when it can not be parsed.
+    """
+    if value is None:
+        value = os.environ.get("DOWNLOADTOOL_RETENTION_DAYS", "")
+    if isinstance(value, str):
+        items = []
+        for item in value.split(","):
+            if not item.strip():
+                continue
+            status, separator, days = item.partition("=")
+            if not separator:
+                raise ValueError(
+                    "retention days must be given as Status=days"
+                )
+            items.append((status.strip(), days.strip()))
+    elif isinstance(value, dict):
+        items = value.items()
+    else:
+        raise ValueError("retention days must be given as Status=days")
+
+    policy = dict(DEFAULT_RETENTION_DAYS)
+    for status, days in items:
+        try:
+            days = int(days)
+        except (TypeError, ValueError):
+            raise ValueError(
+                "retention days of {0} must be a number".format(status)
+            ) from None
+        if days < 1:
+            raise ValueError(
+                "retention days of {0} must be at least 1".format(status)
+            )
+        policy[status] = days
+    return policy
+
+
+def purge_expired_tasks(repository, days=None,
+                        batch_size=DEFAULT_PURGE_BATCH_SIZE,
+                        pause=DEFAULT_PURGE_PAUSE, max_seconds=None):
+    """Delete the tasks older than the retention days of their status.
+
+    ``days`` is a retention policy, see retention_days. The purge stops
+    after ``max_seconds`` when given, the next run goes on where it
+    stopped. Returns a dict with the deleted tasks by status, their
+    total and whether every expired task was deleted.
+    """
+    policy = retention_days(days)
+    now = datetime.now(timezone.utc)
+    started = time.monotonic()
+    deleted = {}
+    total = 0
+    complete = True
+    for status, status_days in sorted(policy.items()):
+        older_than = now - timedelta(days=status_days)
+        deleted[status] = 0
+        while True:
+            if max_seconds is not None and (
+                time.monotonic() - started >= max_seconds
+            ):
+                complete = False
+                break
+            task_ids = repository.purge_tasks(
+                status, older_than, batch_size=batch_size
+            )
+            deleted[status] += len(task_ids)
+            total += len(task_ids)
+            log.info(
+                "Purged %s %s tasks older than %s days, %s in total",
+                deleted[status], status, status_days, total,
+            )
+            if len(task_ids) < batch_size:
+                break
+            if pause:
+                time.sleep(pause)
+        if not complete:
+            break
+    return {"deleted": deleted, "total": total, "complete": complete}
+
+
+def main(argv=None):
+    """Run the purge from the command line."""
+    parser = argparse.ArgumentParser(
+        description="Delete download tasks past their retention days."
+    )
+    parser.add_argument(
+        "--days", default=None,
+        help="Status=days,... overriding DOWNLOADTOOL_RETENTION_DAYS",
+    )
+    parser.add_argument(
+        "--batch-size", type=int, default=DEFAULT_PURGE_BATCH_SIZE,
+        help="tasks deleted per transaction",
+    )
+    parser.add_argument(
+        "--pause", type=float, default=DEFAULT_PURGE_PAUSE,
+        help="seconds to wait between chunks",
+    )
+    parser.add_argument(
+        "--max-seconds", type=float, default=None,
+        help="stop after this time, the next run goes on",
+    )
+    args = parser.parse_args(argv)
+    if args.batch_size < 1:
+        parser.error("--batch-size must be at least 1")
+    try:
+        days = retention_days(args.days)
+    except ValueError as e:
+        parser.error(str(e))
+    logging.basicConfig(level=logging.INFO, stream=sys.stderr)
+
+    result = purge_expired_tasks(
+        get_repository(),
+        days,
+        batch_size=args.batch_size,
+        pause=args.pause,
+        max_seconds=args.max_seconds,
+    )
+    sys.stdout.write(json.dumps(result, sort_keys=True) + "\n")
+
+
+if __name__ == "__main__":
+    main()
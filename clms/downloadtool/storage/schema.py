@@ -0,0 +1,236 @@
+"""DDL for the download tool tasks table."""
+from clms.downloadtool.storage.db import (
+    ACTIVE_STATUSES,
+    ARCHIVE_TABLE_NAME,
+    DATASETS_TABLE_NAME,
+    FINISHED_STATUSES,
+    OUTBOX_TABLE_NAME,
+    PAYLOAD_COLUMNS,
+    SORT_KEY,
+    TABLE_NAME,
+    TASK_ID_SEQUENCE,
+    dataset_fingerprints_sql,
+)
+
+# Above every random task id, so sequence ids never collide with them
+TASK_ID_SEQUENCE_START = 100000000000
+
+CREATE_TABLE = """
+CREATE TABLE IF NOT EXISTS {table} (
+    task_id text PRIMARY KEY,
+    payload jsonb NOT NULL,
+    user_id text,
+    status text,
+    cdse_task_group_id text,
+    registration_datetime timestamptz,
+    updated_at timestamptz NOT NULL DEFAULT now()
+)
+"""
+
+TUNED_INDEXES = (
+    "CREATE INDEX IF NOT EXISTS {table}_user_status_idx "
+    "ON {table} (user_id, status)",
+    "CREATE INDEX IF NOT EXISTS {table}_user_registration_idx "
+    "ON {table} (user_id, ({sort_key}), task_id)",
+    "CREATE INDEX IF NOT EXISTS {table}_active_status_idx "
+    "ON {table} (status, registration_datetime) "
+    "WHERE status IN ({active})",
+    "CREATE INDEX IF NOT EXISTS {table}_active_user_idx "
+    "ON {table} (user_id) WHERE status IN ({active})",
+    "CREATE INDEX IF NOT EXISTS {table}_payload_idx "
+    "ON {table} USING GIN (payload jsonb_path_ops)",
+)
+
+# One row per dataset of a task, deleted with the task
+CREATE_DATASETS_TABLE = """
+CREATE TABLE IF NOT EXISTS {datasets} (
+    task_id text NOT NULL REFERENCES {table} (task_id) ON DELETE CASCADE,
+    position integer NOT NULL,
+    fingerprint text NOT NULL,
+    PRIMARY KEY (task_id, position)
+)
+"""
+
+# Async jobs written by the Zope transaction, deleted by the relay once
+# published to Redis. A job with a job_key replaces the unpublished one.
+CREATE_OUTBOX_TABLE = """
+CREATE TABLE IF NOT EXISTS {outbox} (
+    id bigserial PRIMARY KEY,
+    queue_name text NOT NULL,
+    job_name text NOT NULL,
+    data jsonb NOT NULL,
+    opts jsonb NOT NULL,
+    job_key text,
+    created_at timestamptz NOT NULL DEFAULT now()
+)
+"""
+
+CREATE_OUTBOX_KEY_INDEX = (
+    "CREATE UNIQUE INDEX IF NOT EXISTS {outbox}_job_key_idx "
+    "ON {outbox} (job_key) WHERE job_key IS NOT NULL"
+)
+
+ADD_EXTRACTED_COLUMNS = """
+DO $$
+BEGIN
+    IF (
+        SELECT count(*) FROM information_schema.columns
+        WHERE table_schema = current_schema()
+        AND table_name = '{table}'
+        AND column_name IN ({columns})
+    ) < {count} THEN
+        {add}
+        {backfill}
+    END IF;
+END
+$$
+"""
+
+EXTRACTED_COLUMN_INDEXES = (
+    "CREATE INDEX IF NOT EXISTS {table}_fme_task_id_idx "
+    "ON {table} (fme_task_id) WHERE fme_task_id IS NOT NULL",
+    "CREATE INDEX IF NOT EXISTS {table}_cdse_batch_id_idx "
+    "ON {table} (cdse_batch_id) WHERE cdse_batch_id IS NOT NULL",
+    "CREATE INDEX IF NOT EXISTS {table}_cdse_task_role_idx "
+    "ON {table} (cdse_task_role) WHERE cdse_task_role IS NOT NULL",
+    "CREATE INDEX IF NOT EXISTS {table}_cdse_group_role_idx "
+    "ON {table} (cdse_task_group_id, cdse_task_role) "
+    "WHERE cdse_task_group_id IS NOT NULL",
+)
+
+# Monthly partitions are created by archive_finished_tasks, tasks without
+# registration date go to the default partition
+CREATE_ARCHIVE_TABLE = """
+CREATE TABLE IF NOT EXISTS {archive} (
+    LIKE {table} INCLUDING DEFAULTS,
+    archived_at timestamptz NOT NULL DEFAULT now()
+) PARTITION BY RANGE (registration_datetime)
+"""
+
+ARCHIVE_STATEMENTS = (
+    "CREATE TABLE IF NOT EXISTS {archive}_default "
+    "PARTITION OF {archive} DEFAULT",
+    "CREATE INDEX IF NOT EXISTS {archive}_task_id_idx "
+    "ON {archive} (task_id)",
+    "CREATE INDEX IF NOT EXISTS {archive}_user_registration_idx "
+    "ON {archive} (user_id, ({sort_key}), task_id)",
+    "CREATE INDEX IF NOT EXISTS {table}_finished_idx "
+    "ON {table} (({sort_key})) WHERE status IN ({finished})",
+)
+
+
+def _statuses_sql(statuses):
+    """Return statuses as a SQL list of literals."""
+    return ", ".join("'{0}'".format(status) for status in statuses)
+
+
+def _active_statuses_sql():
+    """Return the active statuses as a SQL list of literals."""
+    return _statuses_sql(ACTIVE_STATUSES)
+
+
+def create_table_ddl():
+    """Return the statements creating the tasks table."""
+    return [CREATE_TABLE.format(table=TABLE_NAME)]
+
+
+def tuned_indexes_ddl():
+    """Return the statements creating the search and monitor indexes."""
+    return [
+        statement.format(
+            table=TABLE_NAME,
+            sort_key=SORT_KEY,
+            active=_active_statuses_sql(),
+        )
+        for statement in TUNED_INDEXES
+    ]
+
+
+def extracted_columns_ddl():
+    """Return statements adding, backfilling and indexing key columns.
+
+    The columns are added and backfilled only when one is missing, so
+    tables upgraded by the former 1009 step are not rewritten again.
+    """
+    statements = [
+        ADD_EXTRACTED_COLUMNS.format(
+            table=TABLE_NAME,
+            columns=", ".join(
+                "'{0}'".format(column) for column, _ in PAYLOAD_COLUMNS
+            ),
+            count=len(PAYLOAD_COLUMNS),
+            add="\n".join(
+                "ALTER TABLE {0} ADD COLUMN IF NOT EXISTS {1} text;".format(
+                    TABLE_NAME, column
+                )
+                for column, _ in PAYLOAD_COLUMNS
+            ),
+            backfill="UPDATE {0} SET {1} WHERE payload ?| ARRAY[{2}];".format(
+                TABLE_NAME,
+                ", ".join(
+                    "{0} = payload->>'{1}'".format(column, key)
+                    for column, key in PAYLOAD_COLUMNS
+                ),
+                ", ".join("'{0}'".format(key) for _, key in PAYLOAD_COLUMNS),
+            ),
+        )
+    ]
+    statements.extend(
+        statement.format(table=TABLE_NAME)
+        for statement in EXTRACTED_COLUMN_INDEXES
+    )
+    return statements
+
+
+def task_id_sequence_ddl():
+    """Return the statement creating the task id sequence."""
+    return [
+        "CREATE SEQUENCE IF NOT EXISTS {0} AS bigint START WITH {1}".format(
+            TASK_ID_SEQUENCE, TASK_ID_SEQUENCE_START
+        )
+    ]
+
+
+def archive_table_ddl():
+    """Return the statements creating the partitioned archive table."""
+    statements = [
+        CREATE_ARCHIVE_TABLE.format(
+            archive=ARCHIVE_TABLE_NAME, table=TABLE_NAME
+        )
+    ]
+    statements.extend(
+        statement.format(
+            archive=ARCHIVE_TABLE_NAME,
+            table=TABLE_NAME,
+            sort_key=SORT_KEY,
+            finished=_statuses_sql(FINISHED_STATUSES),
+        )
+        for statement in ARCHIVE_STATEMENTS
+    )
+    return statements
+
+
+def dataset_fingerprints_ddl():
+    """Return the statements creating the dataset fingerprints table."""
+    return [
+        CREATE_DATASETS_TABLE.format(
+            datasets=DATASETS_TABLE_NAME, table=TABLE_NAME
+        ),
+        dataset_fingerprints_sql(),
+    ]
+
+
+def job_outbox_ddl():
+    """Return the statements creating the async jobs outbox table."""
+    return [
+        CREATE_OUTBOX_TABLE.format(outbox=OUTBOX_TABLE_NAME),
+        CREATE_OUTBOX_KEY_INDEX.format(outbox=OUTBOX_TABLE_NAME),
+    ]
+
+
+def apply_ddl(repository, statements):
+    """Run DDL statements in a single transaction."""
+    with repository._connection() as conn:
+        with conn.cursor() as cursor:
+            for statement in statements:
+                cursor.execute(statement)
@@ -0,0 +1,848 @@
+"""SQLite storage for download tool tasks.
+
+A persistent local store for single node installs and CI, selected with
+DOWNLOADTOOL_SQLITE_PATH. Payloads are JSON text, and the indexed
+columns of the PostgreSQL table are generated from them with the JSON1
+functions, so they can not get out of sync. The database runs in WAL
+mode, where readers do not block the writer.
+"""
+import json
+import os
+import sqlite3
+import threading
+from contextlib import contextmanager
+from datetime import datetime, timezone
+
+from clms.downloadtool.storage.db import (
+    ACTIVE_STATUSES,
+    ARCHIVE_TABLE_NAME,
+    DATASETS_TABLE_NAME,
+    FINISHED_STATUSES,
+    OUTBOX_FIELDS,
+    OUTBOX_TABLE_NAME,
+    PAYLOAD_COLUMNS,
+    QUERY_COLUMNS,
+    TABLE_NAME,
+    TASK_ID_SEQUENCE,
+    TRANSITION_DONE,
+    TRANSITION_INVALID_STATUS,
+    TRANSITION_NOT_FOUND,
+    TRANSITION_PERMISSION_DENIED,
+    PreparedOutboxJobs,
+    _get_itersize,
+    _now_utc,
+    _stats_role_sql,
+    task_stats_result,
+    unique_outbox_jobs,
+)
+from clms.downloadtool.storage.memory import _fingerprint, _moves_finished
+from clms.downloadtool.storage.pool import env_number
+from clms.downloadtool.storage.schema import TASK_ID_SEQUENCE_START
+
+# Seconds a connection waits for the write lock of another one
+DEFAULT_BUSY_TIMEOUT = 30.0
+
+# Sortable UTC text of a timestamp, NULL when it can not be parsed
+_SORTABLE = "strftime('%Y-%m-%d %H:%M:%f', {0})"
+
+# Columns generated from the payload, like _task_columns
+GENERATED_COLUMNS = (
+    ("user_id", "CAST(json_extract(payload, '$.UserID') AS TEXT)"),
+    ("status", "json_extract(payload, '$.Status')"),
+    ("registration_datetime", _SORTABLE.format(
+        "json_extract(payload, '$.RegistrationDateTime')"
+    )),
+) + tuple(
+    (column, "CAST(json_extract(payload, '$.{0}') AS TEXT)".format(key))
+    for column, key in PAYLOAD_COLUMNS
+)
+
+# Keyset pagination order, tasks without registration date sort first
+SORT_KEY = "COALESCE(registration_datetime, '')"
+
+SELECTED_COLUMNS = "task_id, payload, updated_at, user_id, status"
+
+
+def _tasks_table_ddl(name, extra_columns=""):
+    """Return the CREATE TABLE of the tasks or the archive table."""
+    return (
+        "CREATE TABLE IF NOT EXISTS {name} ("
+        "task_id TEXT PRIMARY KEY, "
+        "payload TEXT NOT NULL CHECK (json_valid(payload)), "
+        "updated_at TEXT{extra}, {generated})"
+    ).format(
+        name=name,
+        extra=extra_columns,
+        generated=", ".join(
+            "{0} TEXT GENERATED ALWAYS AS ({1}) VIRTUAL".format(
+                column, expression
+            )
+            for column, expression in GENERATED_COLUMNS
+        ),
+    )
+
+
+SCHEMA_STATEMENTS = (
+    _tasks_table_ddl(TABLE_NAME),
+    "CREATE INDEX IF NOT EXISTS {0}_user_status "
+    "ON {0} (user_id, status)".format(TABLE_NAME),
+    "CREATE INDEX IF NOT EXISTS {0}_user_registration "
+    "ON {0} (user_id, registration_datetime, task_id)".format(TABLE_NAME),
+    "CREATE INDEX IF NOT EXISTS {0}_status ON {0} (status)".format(
+        TABLE_NAME
+    ),
+    "CREATE INDEX IF NOT EXISTS {0}_fme_task_id ON {0} (fme_task_id)".format(
+        TABLE_NAME
+    ),
+    "CREATE INDEX IF NOT EXISTS {0}_cdse_batch_id "
+    "ON {0} (cdse_batch_id)".format(TABLE_NAME),
+    "CREATE INDEX IF NOT EXISTS {0}_cdse_task_group "
+    "ON {0} (cdse_task_group_id, cdse_task_role)".format(TABLE_NAME),
+    _tasks_table_ddl(ARCHIVE_TABLE_NAME, ", archived_at TEXT"),
+    "CREATE INDEX IF NOT EXISTS {0}_user_registration "
+    "ON {0} (user_id, registration_datetime, task_id)".format(
+        ARCHIVE_TABLE_NAME
+    ),
+    "CREATE TABLE IF NOT EXISTS {datasets} ("
+    "task_id TEXT NOT NULL REFERENCES {table} (task_id) ON DELETE CASCADE, "
+    "position INTEGER NOT NULL, "
+    "fingerprint TEXT NOT NULL, "
+    "PRIMARY KEY (task_id, position))".format(
+        datasets=DATASETS_TABLE_NAME, table=TABLE_NAME
+    ),
+    "CREATE INDEX IF NOT EXISTS {0}_fingerprint "
+    "ON {0} (fingerprint)".format(DATASETS_TABLE_NAME),
+    "CREATE TABLE IF NOT EXISTS {0} ("
+    "id INTEGER PRIMARY KEY CHECK (id = 1), "
+    "last_value INTEGER NOT NULL)".format(TASK_ID_SEQUENCE),
+    "INSERT OR IGNORE INTO {0} (id, last_value) VALUES (1, {1})".format(
+        TASK_ID_SEQUENCE, TASK_ID_SEQUENCE_START - 1
+    ),
+    "CREATE TABLE IF NOT EXISTS {0} ("
+    "id INTEGER PRIMARY KEY AUTOINCREMENT, "
+    "queue_name TEXT NOT NULL, "
+    "job_name TEXT NOT NULL, "
+    "data TEXT NOT NULL, "
+    "opts TEXT NOT NULL, "
+    "job_key TEXT, "
+    "created_at TEXT NOT NULL)".format(OUTBOX_TABLE_NAME),
+    "CREATE UNIQUE INDEX IF NOT EXISTS {0}_job_key ON {0} (job_key) "
+    "WHERE job_key IS NOT NULL".format(OUTBOX_TABLE_NAME),
+)
+
+
+def sqlite_path():
+    """Return the SQLite database path from environment, if any."""
+    return os.environ.get("DOWNLOADTOOL_SQLITE_PATH", "").strip() or None
+
+
+def _json_path(key):
+    """Return the JSON1 path of a top level payload key."""
+    return '$."{0}"'.format(key)
+
+
+def _merge_sql(updates):
+    """Return the SQL and params merging updates into the payload.
+
+    Top level keys are replaced, like the JSONB || operator.
+    """
+    if not updates:
+        return "payload", []
+    params = []
+    for key, value in updates.items():
+        params.extend([_json_path(key), json.dumps(value)])
+    return "json_set(payload, {0})".format(
+        ", ".join(["?, json(?)"] * len(updates))
+    ), params
+
+
+def _sortable(value):
+    """Return the sortable text of a datetime, like the generated column."""
+    if value is None:
+        return None
+    if value.tzinfo is not None:
+        value = value.astimezone(timezone.utc)
+    return value.strftime("%Y-%m-%d %H:%M:%S.%f")[:-3]
+
+
+def _parse_sortable(value):
+    """Return the UTC datetime of a sortable text."""
+    if value is None:
+        return None
+    return datetime.strptime(value, "%Y-%m-%d %H:%M:%S.%f").replace(
+        tzinfo=timezone.utc
+    )
+
+
+def _parse_updated_at(value):
+    """Return the datetime of a stored updated_at."""
+    return datetime.fromisoformat(value) if value else None
+
+
+class SqliteDownloadtoolRepository:
+    """SQLite repository compatible with the DB repository interface.
+
+    Each thread has its own connection to the database file. Writes run
+    in ``BEGIN IMMEDIATE`` transactions, so a read-modify-write of a task
+    can not interleave with another writer. Task change notifications
+    are not available, so ``watch_task`` yields None and caches only
+    expire after their ttl.
+    """
+
+    def __init__(self, path=None, timeout=None):
+        self.path = path or sqlite_path()
+        if not self.path:
+            raise RuntimeError("DOWNLOADTOOL_SQLITE_PATH is not set")
+        if timeout is None:
+            timeout = env_number(
+                "DOWNLOADTOOL_SQLITE_TIMEOUT", DEFAULT_BUSY_TIMEOUT
+            )
+        self.timeout = timeout
+        self._local = threading.local()
+        with self._transaction() as conn:
+            for statement in SCHEMA_STATEMENTS:
+                conn.execute(statement)
+
+    def _connect(self):
+        """Open a connection in autocommit mode with WAL enabled."""
+        conn = sqlite3.connect(
+            self.path, timeout=self.timeout, isolation_level=None
+        )
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute("PRAGMA foreign_keys=ON")
+        return conn
+
+    def _conn(self):
+        """Return the connection of the current thread."""
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = self._local.conn = self._connect()
+        return conn
+
+    @contextmanager
+    def _transaction(self):
+        """Yield the thread's connection in a write transaction.
+
+        The transaction is committed on success and rolled back on error.
+        """
+        conn = self._conn()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            yield conn
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        conn.execute("COMMIT")
+
+    def close(self):
+        """Close the connection of the current thread."""
+        conn = getattr(self._local, "conn", None)
+        if conn is not None:
+            self._local.conn = None
+            conn.close()
+
+    @staticmethod
+    def _fingerprint(conn, task_id, payload, replace=False):
+        """Store the dataset fingerprints of a task."""
+        if replace:
+            conn.execute(
+                "DELETE FROM {0} WHERE task_id = ?".format(
+                    DATASETS_TABLE_NAME
+                ),
+                (task_id,),
+            )
+        datasets = payload.get("Datasets")
+        if not isinstance(datasets, list):
+            return
+        conn.executemany(
+            "INSERT OR IGNORE INTO {0} (task_id, position, fingerprint) "
+            "VALUES (?, ?, ?)".format(DATASETS_TABLE_NAME),
+            [
+                (task_id, position, _fingerprint(dataset))
+                for position, dataset in enumerate(datasets, 1)
+            ],
+        )
+
+    @staticmethod
+    def _next_ids(conn, count):
+        """Draw count ids from the sequence table."""
+        last_value = conn.execute(
+            "UPDATE {0} SET last_value = last_value + ? WHERE id = 1 "
+            "RETURNING last_value".format(TASK_ID_SEQUENCE),
+            (count,),
+        ).fetchone()[0]
+        return [
+            str(value) for value in range(last_value - count + 1,
+                                          last_value + 1)
+        ]
+
+    def insert_task(self, task_id, payload):
+        """Insert a task row, returning True if inserted."""
+        with self._transaction() as conn:
+            cursor = conn.execute(
+                "INSERT INTO {0} (task_id, payload, updated_at) "
+                "VALUES (?, ?, ?) ON CONFLICT (task_id) DO NOTHING".format(
+                    TABLE_NAME
+                ),
+                (str(task_id), json.dumps(payload), _now_utc().isoformat()),
+            )
+            if cursor.rowcount == 0:
+                return False
+            self._fingerprint(conn, str(task_id), payload)
+            return True
+
+    def insert_task_next_id(self, payload):
+        """Insert a task with the next sequence id and return the id."""
+        return self.insert_tasks_bulk([(None, payload)])[0]
+
+    def insert_tasks_bulk(self, tasks):
+        """Insert several tasks in one transaction.
+
+        Returns the task ids, or None when one of them already exists,
+        like the DB repository.
+        """
+        if not tasks:
+            return []
+        now = _now_utc().isoformat()
+        try:
+            with self._transaction() as conn:
+                missing_ids = sum(1 for task_id, _ in tasks if task_id is None)
+                next_ids = iter(self._next_ids(conn, missing_ids))
+                task_ids = [
+                    next(next_ids) if task_id is None else str(task_id)
+                    for task_id, _ in tasks
+                ]
+                conn.executemany(
+                    "INSERT INTO {0} (task_id, payload, updated_at) "
+                    "VALUES (?, ?, ?)".format(TABLE_NAME),
+                    [
+                        (task_id, json.dumps(payload), now)
+                        for task_id, (_, payload) in zip(task_ids, tasks)
+                    ],
+                )
+                for task_id, (_, payload) in zip(task_ids, tasks):
+                    self._fingerprint(conn, task_id, payload)
+        except sqlite3.IntegrityError:
+            return None
+        return task_ids
+
+    def _get_row(self, conn, task_id):
+        """Return the row of a live or archived task, None when missing."""
+        return conn.execute(
+            "SELECT {columns}, 0 FROM {table} WHERE task_id = ? "
+            "UNION ALL "
+            "SELECT {columns}, 1 FROM {archive} WHERE task_id = ? "
+            "LIMIT 1".format(
+                columns=SELECTED_COLUMNS,
+                table=TABLE_NAME,
+                archive=ARCHIVE_TABLE_NAME,
+            ),
+            (str(task_id), str(task_id)),
+        ).fetchone()
+
+    def get_task(self, task_id):
+        """Fetch a task payload by task id."""
+        row = self._get_row(self._conn(), task_id)
+        return json.loads(row[1]) if row else None
+
+    def get_task_with_version(self, task_id):
+        """Fetch (payload, updated_at) of a task, None when missing."""
+        row = self._get_row(self._conn(), task_id)
+        if row is None:
+            return None
+        return json.loads(row[1]), _parse_updated_at(row[2])
+
+    @contextmanager
+    def watch_task(self, task_id):
+        """Yield None, changes of other processes are not notified."""
+        yield None
+
+    def has_duplicate_datasets(self, user_id, datasets):
+        """Return True when a dataset repeats among the requested ones and
+        those of the user's Queued and In_progress tasks."""
+        requested = [_fingerprint(dataset) for dataset in datasets]
+        row = self._conn().execute(
+            "SELECT EXISTS (SELECT 1 FROM ("
+            "SELECT value AS fingerprint FROM json_each(?) "
+            "UNION ALL "
+            "SELECT d.fingerprint FROM {table} AS t "
+            "JOIN {datasets} AS d ON d.task_id = t.task_id "
+            "WHERE t.user_id = ? AND t.status IN ({active})"
+            ") GROUP BY fingerprint HAVING count(*) > 1)".format(
+                table=TABLE_NAME,
+                datasets=DATASETS_TABLE_NAME,
+                active=", ".join("?" * len(ACTIVE_STATUSES)),
+            ),
+            (json.dumps(requested), str(user_id)) + ACTIVE_STATUSES,
+        ).fetchone()
+        return bool(row[0])
+
+    @staticmethod
+    def _search_source(status):
+        """Return the FROM item of user searches.
+
+        Searches for an unfinished status never need the archive.
+        """
+        if status is not None and status not in FINISHED_STATUSES:
+            return TABLE_NAME
+        return (
+            "(SELECT {columns} FROM {table} "
+            "UNION ALL SELECT {columns} FROM {archive})"
+        ).format(
+            columns="task_id, payload, user_id, status, "
+            "registration_datetime",
+            table=TABLE_NAME,
+            archive=ARCHIVE_TABLE_NAME,
+        )
+
+    def search_tasks(self, user_id, status=None):
+        """Return list of (task_id, payload) for a user and status."""
+        params = [str(user_id)]
+        where = ["user_id = ?"]
+        if status is not None:
+            where.append("status = ?")
+            params.append(status)
+        rows = self._conn().execute(
+            "SELECT task_id, payload FROM {source} WHERE {where}".format(
+                source=self._search_source(status), where=" AND ".join(where)
+            ),
+            params,
+        ).fetchall()
+        return [(task_id, json.loads(payload)) for task_id, payload in rows]
+
+    def search_tasks_page(self, user_id, status=None, limit=None, after=None,
+                          descending=True, fields=None):
+        """Return one keyset page of a user's tasks.
+
+        Returns a tuple (rows, next_after, total), see
+        DownloadtoolRepository.search_tasks_page.
+        """
+        params = [str(user_id)]
+        where = ["user_id = ?"]
+        if status is not None:
+            where.append("status = ?")
+            params.append(status)
+        source = self._search_source(status)
+        conn = self._conn()
+        total = conn.execute(
+            "SELECT count(*) FROM {source} WHERE {where}".format(
+                source=source, where=" AND ".join(where)
+            ),
+            params,
+        ).fetchone()[0]
+
+        direction = "DESC" if descending else "ASC"
+        if after is not None:
+            where.append("({sort_key}, task_id) {op} (?, ?)".format(
+                sort_key=SORT_KEY, op="<" if descending else ">"
+            ))
+            params.extend([_sortable(after[0]) or "", str(after[1])])
+        query = (
+            "SELECT task_id, payload, registration_datetime "
+            "FROM {source} WHERE {where} "
+            "ORDER BY {sort_key} {direction}, task_id {direction}"
+        ).format(
+            source=source,
+            where=" AND ".join(where),
+            sort_key=SORT_KEY,
+            direction=direction,
+        )
+        if limit is not None:
+            query += " LIMIT ?"
+            params.append(limit + 1)
+        rows = conn.execute(query, params).fetchall()
+
+        next_after = None
+        if limit is not None and len(rows) > limit:
+            rows = rows[:limit]
+            next_after = (_parse_sortable(rows[-1][2]), rows[-1][0])
+        page = []
+        for task_id, payload, _ in rows:
+            payload = json.loads(payload)
+            if fields is not None:
+                payload = {
+                    key: value for key, value in payload.items()
+                    if key in fields
+                }
+            page.append((task_id, payload))
+        return page, next_after, total
+
+    @staticmethod
+    def _inspect_query(query=None):
+        """Return the SQL and params selecting tasks by payload fields."""
+        params = []
+        where = ""
+        if query:
+            conditions = []
+            for key, value in query.items():
+                column = QUERY_COLUMNS.get(key)
+                if column is not None:
+                    conditions.append("{0} = ?".format(column))
+                    params.append(str(value))
+                else:
+                    conditions.append(
+                        "json_extract(payload, ?) = json_extract(?, '$')"
+                    )
+                    params.extend([_json_path(key), json.dumps(value)])
+            where = " WHERE {0}".format(" OR ".join(conditions))
+        sql = "SELECT task_id, payload FROM {table}{where} ORDER BY task_id"
+        return sql.format(table=TABLE_NAME, where=where), params
+
+    def inspect_tasks(self, query=None):
+        """Return list of (task_id, payload) filtered by payload fields."""
+        return list(self.iter_inspect_tasks(query))
+
+    def iter_inspect_tasks(self, query=None, itersize=None):
+        """Yield (task_id, payload) filtered by payload fields.
+
+        Rows are fetched ``itersize`` at a time on a connection of their
+        own, so other calls can run while the caller iterates.
+        """
+        sql, params = self._inspect_query(query)
+        conn = self._connect()
+        try:
+            cursor = conn.execute(sql, params)
+            itersize = itersize or _get_itersize()
+            while True:
+                rows = cursor.fetchmany(itersize)
+                if not rows:
+                    return
+                for task_id, payload in rows:
+                    yield task_id, json.loads(payload)
+        finally:
+            conn.close()
+
+    def _merge(self, conn, task_id, updates):
+        """Merge updates into a live task, returning the new payload."""
+        merge, params = _merge_sql(updates)
+        row = conn.execute(
+            "UPDATE {table} SET payload = {merge}, updated_at = ? "
+            "WHERE task_id = ? RETURNING payload".format(
+                table=TABLE_NAME, merge=merge
+            ),
+            params + [_now_utc().isoformat(), str(task_id)],
+        ).fetchone()
+        if row is None:
+            return None
+        if "Datasets" in updates:
+            payload = json.loads(row[0])
+            self._fingerprint(conn, str(task_id), payload, replace=True)
+            return payload
+        return json.loads(row[0])
+
+    def update_task(self, task_id, updates, status=None):
+        """Merge updates into the payload and return the new payload.
+
+        ``status`` is accepted for compatibility, the status column
+        follows the payload.
+        """
+        with self._transaction() as conn:
+            return self._merge(conn, task_id, updates)
+
+    def transition_task(self, task_id, expected_statuses, updates,
+                        user_id=None, exclude=False):
+        """Merge updates into a task only when its status is expected.
+
+        The check and the update run under the write lock. Returns a
+        tuple (outcome, payload), like the DB repository.
+        """
+        with self._transaction() as conn:
+            row = self._get_row(conn, task_id)
+            if row is None:
+                return TRANSITION_NOT_FOUND, None
+            payload = json.loads(row[1])
+            if user_id is not None and row[3] != str(user_id):
+                return TRANSITION_PERMISSION_DENIED, payload
+            expected = True
+            if expected_statuses is not None:
+                expected = ((row[4] or "") in expected_statuses) != exclude
+            if row[5] or not expected:
+                return TRANSITION_INVALID_STATUS, payload
+            return TRANSITION_DONE, self._merge(conn, task_id, updates)
+
+    def update_tasks_bulk(self, updates):
+        """Merge updates into several payloads in one transaction.
+
+        Empty update dicts only return the current payload, finished
+        tasks keep their status.
+        Returns a tuple ({task_id: new_payload}, [missing task ids],
+        [skipped finished task ids]).
+        """
+        updated = {}
+        missing = []
+        finished = []
+        with self._transaction() as conn:
+            for task_id, task_updates in updates.items():
+                task_key = str(task_id)
+                row = conn.execute(
+                    "SELECT payload FROM {0} WHERE task_id = ?".format(
+                        TABLE_NAME
+                    ),
+                    (task_key,),
+                ).fetchone()
+                if row is None:
+                    missing.append(task_key)
+                    continue
+                payload = json.loads(row[0])
+                if _moves_finished(payload, task_updates):
+                    finished.append(task_key)
+                    continue
+                if task_updates:
+                    payload = self._merge(conn, task_key, task_updates)
+                updated[task_key] = payload
+        return updated, missing, finished
+
+    def delete_task(self, task_id):
+        """Delete one task by id, returning True when removed."""
+        removed = 0
+        with self._transaction() as conn:
+            for table in (TABLE_NAME, ARCHIVE_TABLE_NAME):
+                removed += conn.execute(
+                    "DELETE FROM {0} WHERE task_id = ?".format(table),
+                    (str(task_id),),
+                ).rowcount
+        return removed > 0
+
+    def delete_tasks_by_group(self, cdse_task_group_id, role=None):
+        """Delete the tasks of a CDSE task group, optionally by role.
+
+        Returns the list of removed task ids.
+        """
+        params = [str(cdse_task_group_id)]
+        where = ["cdse_task_group_id = ?"]
+        if role is not None:
+            where.append("cdse_task_role = ?")
+            params.append(role)
+        with self._transaction() as conn:
+            rows = conn.execute(
+                "DELETE FROM {table} WHERE {where} RETURNING task_id".format(
+                    table=TABLE_NAME, where=" AND ".join(where)
+                ),
+                params,
+            ).fetchall()
+        return [row[0] for row in rows]
+
+    def purge_tasks(self, status, older_than, batch_size=1000):
+        """Delete at most batch_size tasks registered before a datetime.
+
+        See DownloadtoolRepository.purge_tasks.
+        """
+        if older_than.tzinfo is None:
+            older_than = older_than.replace(tzinfo=timezone.utc)
+        task_ids = []
+        with self._transaction() as conn:
+            for table in (TABLE_NAME, ARCHIVE_TABLE_NAME):
+                if len(task_ids) >= batch_size:
+                    break
+                task_ids.extend(row[0] for row in conn.execute(
+                    "DELETE FROM {table} WHERE task_id IN ("
+                    "SELECT task_id FROM {table} WHERE status = ? AND ("
+                    "registration_datetime < ? "
+                    "OR registration_datetime IS NULL AND updated_at < ?) "
+                    "LIMIT ?) RETURNING task_id".format(table=table),
+                    (
+                        status,
+                        _sortable(older_than),
+                        older_than.astimezone(timezone.utc).isoformat(),
+                        batch_size - len(task_ids),
+                    ),
+                ).fetchall())
+        return task_ids
+
+    def add_outbox_jobs(self, jobs):
+        """Store async jobs in the outbox and return their number."""
+        prepared = self.prepare_outbox_jobs(jobs)
+        prepared.commit()
+        return prepared.count
+
+    def prepare_outbox_jobs(self, jobs):
+        """Store async jobs in the outbox without committing them.
+
+        See DownloadtoolRepository.prepare_outbox_jobs. The jobs are
+        written on a connection of their own, whose write lock blocks
+        the other writers until it is committed or rolled back.
+        """
+        jobs = unique_outbox_jobs(jobs)
+        if not jobs:
+            return PreparedOutboxJobs(0)
+        created_at = _sortable(_now_utc())
+        conn = self._connect()
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            conn.executemany(
+                "INSERT INTO {outbox} ({columns}, job_key, created_at) "
+                "VALUES (?, ?, ?, ?, ?, ?) "
+                "ON CONFLICT (job_key) WHERE job_key IS NOT NULL "
+                "DO UPDATE SET data = excluded.data, opts = excluded.opts, "
+                "created_at = excluded.created_at".format(
+                    outbox=OUTBOX_TABLE_NAME,
+                    columns=", ".join(OUTBOX_FIELDS),
+                ),
+                [
+                    (
+                        job["queue_name"],
+                        job["job_name"],
+                        json.dumps(job["data"]),
+                        json.dumps(job["opts"]),
+                        job.get("job_key"),
+                        created_at,
+                    )
+                    for job in jobs
+                ],
+            )
+        except BaseException:
+            conn.close()
+            raise
+
+        def finish(statement):
+            try:
+                conn.execute(statement)
+            finally:
+                conn.close()
+
+        return PreparedOutboxJobs(
+            len(jobs),
+            lambda: finish("COMMIT"),
+            lambda: finish("ROLLBACK"),
+        )
+
+    def relay_outbox_jobs(self, publish, batch_size=100):
+        """Publish the oldest outbox jobs and remove them.
+
+        See DownloadtoolRepository.relay_outbox_jobs. The write lock is
+        held while the jobs are published, so relays do not overlap.
+        """
+        with self._transaction() as conn:
+            rows = conn.execute(
+                "SELECT id, {columns} FROM {outbox} "
+                "ORDER BY id LIMIT ?".format(
+                    outbox=OUTBOX_TABLE_NAME,
+                    columns=", ".join(OUTBOX_FIELDS),
+                ),
+                (batch_size,),
+            ).fetchall()
+            if not rows:
+                return 0
+            publish([
+                {
+                    "queue_name": queue_name,
+                    "job_name": job_name,
+                    "data": json.loads(data),
+                    "opts": json.loads(opts),
+                }
+                for _, queue_name, job_name, data, opts in rows
+            ])
+            conn.execute(
+                "DELETE FROM {outbox} WHERE id <= ?".format(
+                    outbox=OUTBOX_TABLE_NAME
+                ),
+                (rows[-1][0],),
+            )
+        return len(rows)
+
+    def delete_all(self):
+        """Delete all tasks and return the number removed."""
+        removed = 0
+        with self._transaction() as conn:
+            for table in (TABLE_NAME, ARCHIVE_TABLE_NAME):
+                removed += conn.execute(
+                    "DELETE FROM {0}".format(table)
+                ).rowcount
+        return removed
+
+    def has_tasks(self):
+        """Return True when the tables have at least one task."""
+        row = self._conn().execute(
+            "SELECT 1 FROM {table} UNION ALL "
+            "SELECT 1 FROM {archive} LIMIT 1".format(
+                table=TABLE_NAME, archive=ARCHIVE_TABLE_NAME
+            )
+        ).fetchone()
+        return row is not None
+
+    def task_stats(self, since=None):
+        """Return task counts and the age of the queued tasks.
+
+        See DownloadtoolRepository.task_stats.
+        """
+        conn = self._conn()
+        counts = conn.execute(
+            "SELECT status, {role}, count(*) FROM {table} "
+            "GROUP BY 1, 2".format(role=_stats_role_sql(), table=TABLE_NAME)
+        ).fetchall()
+        where = ""
+        params = []
+        if since is not None:
+            if since.tzinfo is None:
+                since = since.replace(tzinfo=timezone.utc)
+            where = " AND registration_datetime >= ?"
+            params.append(_sortable(since))
+        hours = [
+            (datetime.strptime(hour, "%Y-%m-%d %H").replace(
+                tzinfo=timezone.utc
+            ), count)
+            for hour, count in conn.execute(
+                "SELECT substr(registration_datetime, 1, 13), count(*) "
+                "FROM {table} WHERE registration_datetime IS NOT NULL{where} "
+                "GROUP BY 1".format(table=TABLE_NAME, where=where),
+                params,
+            )
+        ]
+        now = _now_utc()
+        ages = [
+            (now - _parse_sortable(registered)).total_seconds()
+            for registered, in conn.execute(
+                "SELECT registration_datetime FROM {table} "
+                "WHERE status IN ({active}) "
+                "AND registration_datetime IS NOT NULL".format(
+                    table=TABLE_NAME,
+                    active=", ".join("?" * len(ACTIVE_STATUSES)),
+                ),
+                ACTIVE_STATUSES,
+            )
+        ]
+        return task_stats_result(counts, hours, ages)
+
+    def archive_finished_tasks(self, older_than, batch_size=1000):
+        """Move finished tasks registered before a datetime to the archive.
+
+        Tasks are moved ``batch_size`` at a time, one transaction each.
+        Returns the number of archived tasks.
+        """
+        if older_than.tzinfo is None:
+            older_than = older_than.replace(tzinfo=timezone.utc)
+        archived = 0
+        while True:
+            with self._transaction() as conn:
+                task_ids = [row[0] for row in conn.execute(
+                    "SELECT task_id FROM {table} "
+                    "WHERE status IN ({finished}) AND {sort_key} < ? "
+                    "ORDER BY {sort_key}, task_id LIMIT ?".format(
+                        table=TABLE_NAME,
+                        finished=", ".join("?" * len(FINISHED_STATUSES)),
+                        sort_key=SORT_KEY,
+                    ),
+                    FINISHED_STATUSES + (_sortable(older_than), batch_size),
+                ).fetchall()]
+                selected = "(SELECT value FROM json_each(?))"
+                conn.execute(
+                    "INSERT INTO {archive} "
+                    "(task_id, payload, updated_at, archived_at) "
+                    "SELECT task_id, payload, updated_at, ? FROM {table} "
+                    "WHERE task_id IN {selected}".format(
+                        archive=ARCHIVE_TABLE_NAME,
+                        table=TABLE_NAME,
+                        selected=selected,
+                    ),
+                    (_now_utc().isoformat(), json.dumps(task_ids)),
+                )
+                conn.execute(
+                    "DELETE FROM {table} WHERE task_id IN {selected}".format(
+                        table=TABLE_NAME, selected=selected
+                    ),
+                    (json.dumps(task_ids),),
+                )
+            archived += len(task_ids)
+            if len(task_ids) < batch_size:
+                return archived
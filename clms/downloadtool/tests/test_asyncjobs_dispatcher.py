@@ -0,0 +1,121 @@
+"""
+Test the background job dispatcher
+"""
+# -*- coding: utf-8 -*-
+import os
+import threading
+import unittest
+from unittest import mock
+
+import transaction
+
+from clms.downloadtool.asyncjobs import dispatcher, queues
+from clms.downloadtool.asyncjobs.dispatcher import JobDispatcher
+
+
+class TestJobDispatcher(unittest.TestCase):
+    """ base class for testing """
+
+    def setUp(self):
+        """ setup """
+        self.sent = []
+        self.errors = 0
+
+    def send(self, jobs):
+        """ record the sent jobs, failing the first self.errors calls """
+        if self.errors:
+            self.errors -= 1
+            raise ConnectionError()
+        self.sent.append(jobs)
+
+    def test_jobs_are_sent_in_background(self):
+        """ submit returns at once, close sends the waiting jobs """
+        release = threading.Event()
+
+        def send(jobs):
+            release.wait(5)
+            self.send(jobs)
+
+        job_dispatcher = JobDispatcher(send)
+        job_dispatcher.submit(["a"])
+        job_dispatcher.submit(["b", "c"])
+        self.assertEqual(self.sent, [])
+        release.set()
+        self.assertTrue(job_dispatcher.close())
+        self.assertEqual(
+            [job for jobs in self.sent for job in jobs], ["a", "b", "c"]
+        )
+        stats = job_dispatcher.stats()
+        self.assertEqual(stats["dispatched"], 3)
+        self.assertEqual(stats["queue_depth"], 0)
+        self.assertIn(
+            "downloadtool_jobs_dispatch_latency_seconds_count 3",
+            job_dispatcher.render().splitlines(),
+        )
+
+    def test_failures_are_retried(self):
+        """ a failed send is retried, then counted as failed """
+        self.errors = 2
+        job_dispatcher = JobDispatcher(self.send, retries=2, retry_delay=0)
+        job_dispatcher.submit(["a"])
+        job_dispatcher.close()
+        self.assertEqual(self.sent, [["a"]])
+        self.assertEqual(job_dispatcher.stats()["retried"], 2)
+
+        self.errors = 3
+        job_dispatcher = JobDispatcher(self.send, retries=2, retry_delay=0)
+        with self.assertLogs("clms.async", "ERROR"):
+            job_dispatcher.submit(["b"])
+            job_dispatcher.close()
+        stats = job_dispatcher.stats()
+        self.assertEqual(stats["failed"], 1)
+        self.assertEqual(stats["dispatched"], 0)
+
+    def test_full_queue_sends_in_the_caller(self):
+        """ when the queue is full the jobs are not dropped """
+        release = threading.Event()
+        started = threading.Event()
+
+        def send(jobs):
+            started.set()
+            release.wait(5)
+            self.send(jobs)
+
+        job_dispatcher = JobDispatcher(send, maxsize=1)
+        job_dispatcher.submit(["a"])
+        started.wait(5)
+        job_dispatcher.submit(["b"])
+        release.set()
+        with self.assertLogs("clms.async", "WARNING"):
+            job_dispatcher.submit(["c"])
+        job_dispatcher.close()
+        self.assertEqual(
+            sorted(job for jobs in self.sent for job in jobs),
+            ["a", "b", "c"],
+        )
+        self.assertEqual(job_dispatcher.stats()["overflow"], 1)
+
+    def test_commit_hands_jobs_to_the_dispatcher(self):
+        """ in background mode the commit does not connect to Redis """
+        job_dispatcher = mock.Mock()
+        transaction.begin()
+        with mock.patch.dict(
+            os.environ, {"DOWNLOADTOOL_JOBS_DISPATCH": "background"}
+        ), mock.patch.object(
+            queues, "get_dispatcher", return_value=job_dispatcher
+        ), mock.patch.object(queues, "enqueue_jobs") as enqueue_jobs:
+            queues.queue_job("cdse_jobs", "create_cdse_batches", {})
+            transaction.commit()
+        enqueue_jobs.assert_not_called()
+        jobs = job_dispatcher.submit.call_args.args[0]
+        self.assertEqual([job.job_name for job in jobs],
+                         ["create_cdse_batches"])
+
+    def test_dispatch_mode(self):
+        """ the background mode is enabled through env """
+        with mock.patch.dict(os.environ, {"DOWNLOADTOOL_JOBS_DISPATCH": ""}):
+            self.assertFalse(dispatcher.background_dispatch_enabled())
+        with mock.patch.dict(
+            os.environ, {"DOWNLOADTOOL_JOBS_DISPATCH": "background"}
+        ):
+            self.assertTrue(dispatcher.background_dispatch_enabled())
@@ -0,0 +1,98 @@
+"""
+Test the transaction aware callbacks data manager
+"""
+# -*- coding: utf-8 -*-
+import unittest
+from unittest import mock
+
+import transaction
+
+from clms.downloadtool.asyncjobs.manager import (
+    get_data_manager,
+    queue_callback,
+)
+
+
+class TestCallbacksDataManager(unittest.TestCase):
+    """ base class for testing """
+
+    def setUp(self):
+        """ setup """
+        transaction.begin()
+        self.calls = []
+
+    def tearDown(self):
+        """ tear down cleanup """
+        transaction.abort()
+
+    def callback(self, name):
+        """ return a callback recording its call """
+        return lambda: self.calls.append(name)
+
+    def test_one_manager_per_transaction(self):
+        """ every callback of a transaction runs at commit """
+        queue_callback(self.callback("first"))
+        queue_callback(self.callback("second"))
+        manager = get_data_manager()
+        self.assertEqual(transaction.get()._resources, [manager])
+        self.assertEqual(self.calls, [])
+        transaction.commit()
+        self.assertEqual(self.calls, ["first", "second"])
+        self.assertIsNot(get_data_manager(), manager)
+
+    def test_same_key_keeps_the_last_callback(self):
+        """ a callback replaces the pending one with the same key """
+        queue_callback(self.callback("patch 1"), key=("patch", "1"))
+        queue_callback(self.callback("other"))
+        queue_callback(self.callback("patch 2"), key=("patch", "1"))
+        transaction.commit()
+        self.assertEqual(self.calls, ["other", "patch 2"])
+
+    def test_abort_and_savepoint(self):
+        """ aborted and rolled back callbacks do not run """
+        queue_callback(self.callback("kept"))
+        savepoint = transaction.savepoint()
+        queue_callback(self.callback("rolled back"))
+        savepoint.rollback()
+        transaction.commit()
+        queue_callback(self.callback("aborted"))
+        transaction.abort()
+        self.assertEqual(self.calls, ["kept"])
+
+    def test_voted_callbacks_finish_with_the_transaction(self):
+        """ the result of a vote is committed or rolled back with it """
+        prepared = mock.Mock()
+
+        def vote(callbacks):
+            self.calls.extend(callback.label for callback in callbacks)
+            return prepared
+
+        for label in ("first", "second"):
+            queue_callback(mock.Mock(vote=vote, label=label))
+        transaction.commit()
+        self.assertEqual(self.calls, ["first", "second"])
+        prepared.commit.assert_called_once_with()
+        prepared.rollback.assert_not_called()
+
+        prepared.reset_mock()
+        queue_callback(mock.Mock(vote=vote, label="aborted"))
+        # Votes after the callbacks data manager
+        transaction.get().join(mock.Mock(
+            sortKey=lambda: "~~", tpc_vote=mock.Mock(side_effect=OSError())
+        ))
+        with self.assertRaises(OSError):
+            transaction.commit()
+        prepared.rollback.assert_called_once_with()
+        prepared.commit.assert_not_called()
+
+    def test_votes_after_the_other_managers(self):
+        """ the vote holding the outbox transaction is the last one """
+        votes = []
+        queue_callback(mock.Mock(vote=lambda callbacks: votes.append("jobs")))
+        for key in ("RelStorage:zodb", "zz"):
+            transaction.get().join(mock.Mock(
+                sortKey=lambda key=key: key,
+                tpc_vote=lambda txn, key=key: votes.append(key),
+            ))
+        transaction.commit()
+        self.assertEqual(votes, ["RelStorage:zodb", "zz", "jobs"])
@@ -0,0 +1,118 @@
+"""
+Test the transactional outbox of async jobs
+"""
+# -*- coding: utf-8 -*-
+import os
+import unittest
+from unittest import mock
+
+import transaction
+
+from clms.downloadtool.asyncjobs import outbox, queues
+from clms.downloadtool.storage.memory import MemoryDownloadtoolRepository
+
+
+class TestOutbox(unittest.TestCase):
+    """ base class for testing """
+
+    def setUp(self):
+        """ setup """
+        transaction.begin()
+        patcher = mock.patch.dict(
+            os.environ, {"DOWNLOADTOOL_JOBS_DISPATCH": "outbox"}
+        )
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        patcher = mock.patch.object(queues, "enqueue_jobs")
+        self.enqueue_jobs = patcher.start()
+        self.addCleanup(patcher.stop)
+        self.repository = MemoryDownloadtoolRepository()
+        patcher = mock.patch.object(
+            queues, "store_jobs",
+            side_effect=lambda jobs: self.repository.prepare_outbox_jobs(
+                outbox._outbox_jobs(jobs)
+            ),
+        )
+        self.store_jobs = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def tearDown(self):
+        """ tear down cleanup """
+        transaction.abort()
+
+    def relay(self):
+        """ publish the outbox and return the data of the jobs """
+        outbox.relay_jobs(self.repository, queues.publish_jobs)
+        return [
+            job.data
+            for call in self.enqueue_jobs.call_args_list
+            for job in call.args[0]
+        ]
+
+    def test_jobs_are_stored_when_the_transaction_votes(self):
+        """ the commit stores the jobs instead of adding them to Redis """
+        queues.queue_job("cdse_jobs", "create_cdse_batches", {"id": 1})
+        queues.queue_job("cdse_jobs", "create_cdse_batches", {"id": 2})
+        transaction.commit()
+        self.store_jobs.assert_called_once()
+        self.enqueue_jobs.assert_not_called()
+
+        result = outbox.relay_jobs(
+            self.repository, queues.publish_jobs, batch_size=1
+        )
+        self.assertEqual(result, {"published": 2, "complete": True})
+        self.assertEqual(
+            [
+                [job.data for job in call.args[0]]
+                for call in self.enqueue_jobs.call_args_list
+            ],
+            [[{"id": 1}], [{"id": 2}]],
+        )
+
+    def test_aborted_transaction_drops_the_jobs(self):
+        """ jobs stored by the vote are rolled back when it aborts """
+        queues.queue_job("cdse_jobs", "create_cdse_batches", {"id": 1})
+        # Votes after the callbacks data manager
+        transaction.get().join(mock.Mock(
+            sortKey=lambda: "~~", tpc_vote=mock.Mock(side_effect=OSError())
+        ))
+        with self.assertRaises(OSError):
+            transaction.commit()
+        transaction.abort()
+        self.store_jobs.assert_called_once()
+        self.assertEqual(self.relay(), [])
+
+    def test_coalesced_jobs_replace_unpublished_ones(self):
+        """ only the last patch of a task waits in the outbox """
+        for status in ("In_progress", "Finished_ok"):
+            queues.queue_job("downloadtool_jobs", "downloadtool_updates", {
+                "operation": "datarequest_status_patch",
+                "updates": {"utility_task_id": "1", "Status": status},
+            })
+            transaction.commit()
+        self.assertEqual(self.relay(), [{
+            "operation": "datarequest_status_patch",
+            "updates": {"utility_task_id": "1", "Status": "Finished_ok"},
+        }])
+
+    def test_store_errors_abort_the_transaction(self):
+        """ jobs are never lost silently """
+        self.store_jobs.side_effect = ConnectionError()
+        queues.queue_job("cdse_jobs", "create_cdse_batches", {})
+        with self.assertRaises(ConnectionError):
+            transaction.commit()
+        self.enqueue_jobs.assert_not_called()
+
+    def test_relay_stops_after_max_seconds(self):
+        """ the relay returns before publishing when out of time """
+        self.repository.add_outbox_jobs([{
+            "queue_name": "cdse_jobs",
+            "job_name": "create_cdse_batches",
+            "data": {},
+            "opts": {},
+        }])
+        result = outbox.relay_jobs(
+            self.repository, queues.publish_jobs, max_seconds=0
+        )
+        self.assertEqual(result, {"published": 0, "complete": False})
+        self.enqueue_jobs.assert_not_called()
@@ -0,0 +1,81 @@
+"""
+Test the batched enqueue of async jobs
+"""
+# -*- coding: utf-8 -*-
+import unittest
+from unittest import mock
+
+import transaction
+
+from clms.downloadtool.asyncjobs import queues
+
+
+class TestQueueJob(unittest.TestCase):
+    """ base class for testing """
+
+    def setUp(self):
+        """ setup """
+        transaction.begin()
+        patcher = mock.patch.object(queues, "Redis")
+        self.redis = patcher.start()
+        self.redis.return_value.aclose = mock.AsyncMock()
+        self.addCleanup(patcher.stop)
+        patcher = mock.patch.object(queues, "Queue")
+        self.queue = patcher.start()
+        self.queue.return_value.addBulk = mock.AsyncMock()
+        self.addCleanup(patcher.stop)
+
+    def tearDown(self):
+        """ tear down cleanup """
+        transaction.abort()
+
+    def patch(self, task_id, status):
+        """ queue a datarequest_status_patch job """
+        queues.queue_job("downloadtool_jobs", "downloadtool_updates", {
+            "operation": "datarequest_status_patch",
+            "updates": {
+                "data_object": {"Status": status},
+                "utility_task_id": task_id,
+            },
+        })
+
+    def test_jobs_of_a_transaction_are_sent_together(self):
+        """ one connection, and one addBulk per queue, at commit """
+        queues.queue_job("cdse_jobs", "create_cdse_batches", {"user_id": 1})
+        self.patch("1", "Queued")
+        self.patch("2", "Queued")
+        self.patch("1", "In_progress")
+        self.queue.assert_not_called()
+        transaction.commit()
+
+        self.redis.assert_called_once()
+        self.redis.return_value.aclose.assert_awaited_once()
+        self.assertEqual(
+            [call.args[0] for call in self.queue.call_args_list],
+            ["cdse_jobs", "downloadtool_jobs"],
+        )
+        bulks = [
+            call.args[0]
+            for call in self.queue.return_value.addBulk.await_args_list
+        ]
+        self.assertEqual(len(bulks[0]), 1)
+        self.assertEqual(
+            [
+                job["data"]["updates"]["data_object"]["Status"]
+                for job in bulks[1]
+            ],
+            ["Queued", "In_progress"],
+        )
+
+    def test_unknown_queue(self):
+        """ jobs can only be queued in the known queues """
+        with self.assertRaises(KeyError):
+            queues.queue_job("other", "job", {})
+
+    def test_errors_are_logged(self):
+        """ a Redis error does not fail the commit """
+        self.queue.return_value.addBulk.side_effect = ConnectionError()
+        self.patch("1", "Queued")
+        with self.assertLogs("clms.downloadtool.asyncjobs.manager"):
+            transaction.commit()
+        self.redis.return_value.aclose.assert_awaited_once()
@@ -93,6 +93,43 @@ class TestDatarequestDelete(unittest.TestCase):
         self.assertIn("status", result)
         self.assertIn("msg", result)
 
+    def test_delete_method_owner_must_match_exactly(self):
+        """ a user id containing the current one is another user """
+        utility = getUtility(IDownloadToolUtility)
+        result = utility.datarequest_post({
+            "Status": "In_progress",
+            "UserID": SITE_OWNER_NAME + "-other",
+        })
+        key_1 = list(result.keys())[0]
+
+        transaction.commit()
+
+        data = {"TaskID": key_1}
+        response = self.api_session.delete("@datarequest_delete", json=data)
+        self.assertEqual(response.status_code, 404)
+        self.assertEqual(response.json()["msg"], "Error, permission denied")
+
+    def test_delete_method_finished_task(self):
+        """ a finished task can not be cancelled """
+        utility = getUtility(IDownloadToolUtility)
+        result = utility.datarequest_post({
+            "Status": "Finished_ok",
+            "UserID": SITE_OWNER_NAME,
+        })
+        key_1 = list(result.keys())[0]
+
+        transaction.commit()
+
+        data = {"TaskID": key_1}
+        response = self.api_session.delete("@datarequest_delete", json=data)
+        self.assertEqual(response.status_code, 409)
+        self.assertEqual(
+            response.json()["msg"], "Error, task already finished"
+        )
+        self.assertEqual(
+            utility.datarequest_status_get(key_1)["Status"], "Finished_ok"
+        )
+
     def test_delete_method_with_valid_task_id_and_user(self):
         """ test delete method with a valid task_id and user """
         data_dict_1 = {
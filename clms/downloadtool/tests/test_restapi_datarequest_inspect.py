@@ -17,6 +17,10 @@ from plone.app.testing import (
     setRoles,
 )
 from plone.restapi.testing import RelativeSession
+from zope.component import getUtility
+
+from clms.downloadtool.api.services.datarequest_inspect.get import CHUNK_SIZE
+from clms.downloadtool.utility import IDownloadToolUtility
 
 FME_TASK_ID = 123456
 
@@ -222,3 +226,30 @@ class TestDatarequestPost(unittest.TestCase):
             response.headers.get("Content-Type"), "application/json"
         )
         self.assertEqual(response.status_code, 400)
+
+    def test_status_method_streams_all_results(self):
+        """results spanning several stream chunks form one JSON array"""
+        utility = getUtility(IDownloadToolUtility)
+        total = CHUNK_SIZE * 2 + 1
+        for _ in range(total):
+            utility.datarequest_post(
+                {"Status": "Queued", "UserID": TEST_USER_ID}
+            )
+        utility.datarequest_post({"Status": "Cancelled", "UserID": "other"})
+        transaction.commit()
+
+        response = self.api_session.get(
+            "@datarequest_inspect?Status=Queued",
+        )
+        self.assertEqual(response.status_code, 200)
+        result = response.json()
+        self.assertEqual(len(result), total)
+        self.assertEqual(len(set(item["TaskId"] for item in result)), total)
+
+    def test_status_method_streams_empty_result(self):
+        """an empty result is streamed as an empty JSON array"""
+        response = self.api_session.get(
+            "@datarequest_inspect?TaskID=unexisting",
+        )
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json(), [])
@@ -141,6 +141,27 @@ class TestDatarequestPatch(unittest.TestCase):
         self.assertEqual(response.status_code, 200)
         self.assertEqual(response.json()["Status"], "Finished_ok")
 
+    def test_update_status_of_finished_task(self):
+        """a finished task keeps its status"""
+        data = {"TaskID": self.task_id, "Status": "Finished_ok"}
+        response = self.manager_api_session.patch(
+            "@datarequest_status_patch", json=data
+        )
+        self.assertEqual(response.status_code, 200)
+
+        data = {"TaskID": self.task_id, "Status": "In_progress"}
+        response = self.manager_api_session.patch(
+            "@datarequest_status_patch", json=data
+        )
+        self.assertEqual(response.status_code, 409)
+        self.assertEqual(
+            response.json()["msg"], "Error, task already finished"
+        )
+        self.assertEqual(
+            self.utility.datarequest_status_get(self.task_id)["Status"],
+            "Finished_ok",
+        )
+
     def test_update_status_provide_filesize(self):
         """when FileSize parameter is provided, its value
         should be included"""
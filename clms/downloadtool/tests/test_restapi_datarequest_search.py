@@ -85,6 +85,7 @@ class TestDatarequestStatusGet(unittest.TestCase):
 
         result = response.json()
         self.assertEqual(len(result.keys()), 2)
+        self.assertNotIn("X-Total-Count", response.headers)
 
         response = self.api_session.get(
             "@datarequest_search", params={"status": "Cancelled"}
@@ -99,3 +100,82 @@ class TestDatarequestStatusGet(unittest.TestCase):
         self.assertEqual(response.status_code, 200)
         result = response.json()
         self.assertEqual(len(result.keys()), 0)
+
+    def test_status_method_paginated(self):
+        """ results can be paginated with limit and cursor """
+        utility = getUtility(IDownloadToolUtility)
+        for day in range(1, 6):
+            utility.datarequest_post({
+                "Status": "Queued",
+                "UserID": SITE_OWNER_NAME,
+                "RegistrationDateTime": "2024-01-0{0}T00:00:00".format(day),
+                "Datasets": [{"DatasetID": str(day)}],
+            })
+
+        transaction.commit()
+
+        response = self.api_session.get(
+            "@datarequest_search", params={"limit": 2, "fields": "Status"}
+        )
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.headers.get("X-Total-Count"), "5")
+        first_page = response.json()
+        self.assertEqual(len(first_page), 2)
+        for item in first_page:
+            self.assertEqual(sorted(item), ["Status", "TaskId"])
+            self.assertEqual(item["Status"], "Queued")
+
+        seen = {item["TaskId"] for item in first_page}
+        cursor = response.headers.get("X-Next-Cursor")
+        while cursor:
+            response = self.api_session.get(
+                "@datarequest_search", params={"limit": 2, "cursor": cursor}
+            )
+            self.assertEqual(response.status_code, 200)
+            task_ids = {item["TaskId"] for item in response.json()}
+            self.assertFalse(seen.intersection(task_ids))
+            seen.update(task_ids)
+            cursor = response.headers.get("X-Next-Cursor")
+
+        self.assertEqual(len(seen), 5)
+
+    def test_status_method_sort_order(self):
+        """ results are sorted by registration date """
+        utility = getUtility(IDownloadToolUtility)
+        for day in range(1, 4):
+            utility.datarequest_post({
+                "Status": "Queued",
+                "UserID": SITE_OWNER_NAME,
+                "RegistrationDateTime": "2024-01-0{0}T00:00:00".format(day),
+            })
+
+        transaction.commit()
+
+        response = self.api_session.get(
+            "@datarequest_search",
+            params={"limit": 10, "sort_order": "ascending"},
+        )
+        self.assertEqual(response.status_code, 200)
+        dates = [item["RegistrationDateTime"] for item in response.json()]
+        self.assertEqual(dates, sorted(dates))
+
+        response = self.api_session.get(
+            "@datarequest_search", params={"limit": 10}
+        )
+        self.assertEqual(response.status_code, 200)
+        dates = [item["RegistrationDateTime"] for item in response.json()]
+        self.assertEqual(len(dates), 3)
+        self.assertEqual(dates, sorted(dates, reverse=True))
+
+    def test_status_method_invalid_pagination(self):
+        """ invalid limit, cursor and sort_order values are rejected """
+        for params in [
+            {"limit": "0"},
+            {"limit": "abc"},
+            {"cursor": "not-a-cursor"},
+            {"sort_order": "random"},
+        ]:
+            response = self.api_session.get(
+                "@datarequest_search", params=params
+            )
+            self.assertEqual(response.status_code, 400)
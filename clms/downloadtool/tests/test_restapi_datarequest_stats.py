@@ -0,0 +1,66 @@
+"""
+Test the @datarequest_stats endpoint
+"""
+# -*- coding: utf-8 -*-
+import unittest
+
+import transaction
+from clms.downloadtool.testing import CLMS_DOWNLOADTOOL_RESTAPI_TESTING
+from clms.downloadtool.utility import IDownloadToolUtility
+from plone.app.testing import (SITE_OWNER_NAME, SITE_OWNER_PASSWORD,
+                               TEST_USER_ID, setRoles)
+from plone.restapi.testing import RelativeSession
+from zope.component import getUtility
+
+
+class TestDatarequestStats(unittest.TestCase):
+    """ base class"""
+
+    layer = CLMS_DOWNLOADTOOL_RESTAPI_TESTING
+
+    def setUp(self):
+        """Set up the test."""
+        self.portal = self.layer["portal"]
+        self.portal_url = self.portal.absolute_url()
+        setRoles(self.portal, TEST_USER_ID, ["Manager"])
+        self.api_session = RelativeSession(self.portal_url)
+        self.api_session.headers.update({"Accept": "application/json"})
+        self.api_session.auth = (SITE_OWNER_NAME, SITE_OWNER_PASSWORD)
+
+        self.anonymous_session = RelativeSession(self.portal_url)
+        self.anonymous_session.headers.update({"Accept": "application/json"})
+
+    def tearDown(self):
+        """ tear down cleanup"""
+        self.api_session.close()
+        self.anonymous_session.close()
+
+    def test_stats_as_anonymous(self):
+        """ anonymous users can not read the statistics """
+        response = self.anonymous_session.get("@datarequest_stats")
+        self.assertEqual(response.status_code, 401)
+
+    def test_stats_invalid_hours(self):
+        """ hours must be a positive number """
+        response = self.api_session.get("@datarequest_stats?hours=0")
+        self.assertEqual(response.status_code, 400)
+
+    def test_stats(self):
+        """ tasks are counted by status and role """
+        utility = getUtility(IDownloadToolUtility)
+        utility.datarequest_post({"UserID": "john", "Status": "Queued"})
+        utility.datarequest_post({
+            "UserID": "john",
+            "Status": "Queued",
+            "cdse_task_role": "parent",
+        })
+        transaction.commit()
+
+        response = self.api_session.get("@datarequest_stats")
+        self.assertEqual(response.status_code, 200)
+        stats = response.json()
+        self.assertEqual(stats["by_status"], {"Queued": 2})
+        self.assertEqual(
+            stats["by_role"], {"fme": 1, "cdse_parent": 1, "cdse_child": 0}
+        )
+        self.assertEqual(stats["queue_age"]["count"], 2)
@@ -2,9 +2,12 @@
 Test the datarequest_status_get endpoint
 """
 # -*- coding: utf-8 -*-
+import threading
 import unittest
+from unittest import mock
 
 import transaction
+from clms.downloadtool import utility as utility_module
 from clms.downloadtool.testing import CLMS_DOWNLOADTOOL_RESTAPI_TESTING
 from clms.downloadtool.utility import IDownloadToolUtility
 from plone.app.testing import (SITE_OWNER_NAME, SITE_OWNER_PASSWORD,
@@ -78,3 +81,71 @@ class TestDatarequestStatusGet(unittest.TestCase):
         )
         self.assertEqual(response.status_code, 200)
         self.assertEqual(response.json()["My"], "Data")
+
+    def test_status_method_with_wait(self):
+        """ long polling returns the task and its version """
+        utility = getUtility(IDownloadToolUtility)
+        result = utility.datarequest_post({"Status": "Finished_ok"})
+        key = list(result.keys())[0]
+
+        transaction.commit()
+        response = self.api_session.get(
+            "@datarequest_status_get", params={"TaskID": key, "wait": "30"}
+        )
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()["Status"], "Finished_ok")
+        self.assertIn("X-Task-Updated-At", response.headers)
+
+    def test_status_method_with_wait_since(self):
+        """ since takes the URL-encoded version of the previous reply """
+        utility = getUtility(IDownloadToolUtility)
+        result = utility.datarequest_post({"Status": "Finished_ok"})
+        key = list(result.keys())[0]
+
+        transaction.commit()
+        response = self.api_session.get(
+            "@datarequest_status_get", params={"TaskID": key, "wait": "0"}
+        )
+        since = response.headers["X-Task-Updated-At"]
+        response = self.api_session.get(
+            "@datarequest_status_get",
+            params={"TaskID": key, "wait": "1", "since": since},
+        )
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.headers["X-Task-Updated-At"], since)
+
+    def test_status_method_with_wait_unexisting_task(self):
+        """ waiting for an unknown task answers 404 """
+        response = self.api_session.get(
+            "@datarequest_status_get", params={"TaskID": "XXX", "wait": "0"}
+        )
+        self.assertEqual(response.status_code, 404)
+        self.assertEqual(response.json()["msg"], "Error, task not found")
+
+    def test_status_method_with_busy_waiters(self):
+        """ waiting requests beyond the limit are told to retry later """
+        utility = getUtility(IDownloadToolUtility)
+        result = utility.datarequest_post({"Status": "Queued"})
+        key = list(result.keys())[0]
+
+        transaction.commit()
+        with mock.patch.object(
+            utility_module, "STATUS_WAITERS", threading.BoundedSemaphore(1)
+        ) as waiters:
+            waiters.acquire()
+            response = self.api_session.get(
+                "@datarequest_status_get",
+                params={"TaskID": key, "wait": "30"},
+            )
+        self.assertEqual(response.status_code, 429)
+        self.assertIn("Retry-After", response.headers)
+
+    def test_status_method_with_invalid_wait(self):
+        """ wait must be a number of seconds up to the maximum """
+        for params in [{"wait": "soon"}, {"wait": "3600"},
+                       {"wait": "1", "since": "yesterday"}]:
+            params["TaskID"] = "1"
+            response = self.api_session.get(
+                "@datarequest_status_get", params=params
+            )
+            self.assertEqual(response.status_code, 400)
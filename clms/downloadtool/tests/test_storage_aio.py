@@ -0,0 +1,239 @@
+"""
+Test the SQL sent by the asyncio PostgreSQL repository
+"""
+# -*- coding: utf-8 -*-
+import asyncio
+import re
+import unittest
+from contextlib import asynccontextmanager
+from unittest import mock
+
+from clms.downloadtool.storage import aio
+from clms.downloadtool.storage.db import (
+    TRANSITION_DONE,
+    TRANSITION_INVALID_STATUS,
+)
+
+
+class FakeConnection:
+    """ asyncpg connection stub recording the queries """
+
+    def __init__(self):
+        self.queries = []
+        self.results = []
+
+    @asynccontextmanager
+    async def transaction(self):
+        """ transaction """
+        yield
+
+    async def _run(self, method, sql, args):
+        self.queries.append((method, sql, args))
+        return self.results.pop(0) if self.results else None
+
+    async def fetch(self, sql, *args):
+        """ fetch """
+        return await self._run("fetch", sql, args) or []
+
+    async def fetchrow(self, sql, *args):
+        """ fetchrow """
+        return await self._run("fetchrow", sql, args)
+
+    async def fetchval(self, sql, *args):
+        """ fetchval """
+        return await self._run("fetchval", sql, args)
+
+    async def execute(self, sql, *args):
+        """ execute """
+        return await self._run("execute", sql, args) or "DELETE 0"
+
+
+class FakePool:
+    """ asyncpg pool stub """
+
+    def __init__(self, conn):
+        self.conn = conn
+
+    @asynccontextmanager
+    async def acquire(self):
+        """ acquire """
+        yield self.conn
+
+
+def placeholders(sql):
+    """ return the sorted distinct $n numbers of a query """
+    return sorted({int(number) for number in re.findall(r"\$(\d+)", sql)})
+
+
+class TestAsyncRepository(unittest.TestCase):
+    """ test the queries of AsyncDownloadtoolRepository """
+
+    def setUp(self):
+        """ repository on a fake pool """
+        with mock.patch.object(aio, "_get_asyncpg", return_value=None):
+            self.repository = aio.AsyncDownloadtoolRepository(
+                dsn="postgresql://", notify=False
+            )
+        self.conn = FakeConnection()
+        self.repository.pool = FakePool(self.conn)
+
+    def run_query(self, coroutine, *results):
+        """ run a repository coroutine with queued query results """
+        self.conn.results.extend(results)
+        return asyncio.run(coroutine)
+
+    def assertNumbered(self, sql, args):
+        """ the placeholders are $1 to $n, one for each argument """
+        self.assertEqual(placeholders(sql), list(range(1, len(args) + 1)))
+
+    def test_insert_task(self):
+        """ inserted columns follow the task id and payload """
+        payload = {"UserID": "john", "Status": "Queued"}
+        self.assertTrue(self.run_query(
+            self.repository.insert_task(7, payload), "7"
+        ))
+        method, sql, args = self.conn.queries[0]
+        self.assertEqual(method, "fetchval")
+        self.assertNumbered(sql, args)
+        self.assertEqual(args[:2], ("7", payload))
+        self.assertEqual(len(self.conn.queries), 1)
+
+    def test_insert_existing_task(self):
+        """ a conflicting insert is not notified """
+        self.repository.notify = True
+        self.assertFalse(self.run_query(
+            self.repository.insert_task("7", {"UserID": "john"}), None
+        ))
+        self.assertEqual(len(self.conn.queries), 1)
+
+    def test_insert_task_notifies(self):
+        """ the change is notified in the same transaction """
+        self.repository.notify = True
+        self.run_query(
+            self.repository.insert_task("7", {"UserID": "john"}), "7"
+        )
+        method, sql, args = self.conn.queries[-1]
+        self.assertIn("pg_notify($1", sql)
+        self.assertNumbered(sql, args)
+        self.assertEqual(
+            args[1], ['{"task_id": "7", "user_id": "john"}']
+        )
+
+    def test_search_tasks(self):
+        """ the status is the second placeholder """
+        rows = self.run_query(
+            self.repository.search_tasks("john", "Queued"),
+            [("1", {"Status": "Queued"})],
+        )
+        self.assertEqual(rows, [("1", {"Status": "Queued"})])
+        _, sql, args = self.conn.queries[0]
+        self.assertIn("user_id = $1 AND status = $2", sql)
+        self.assertEqual(args, ("john", "Queued"))
+
+    def test_inspect_query(self):
+        """ indexed keys and payload keys are numbered in order """
+        sql, params = self.repository._inspect_query(
+            {"Status": "Queued", "Other": 1, "UserID": "john"}
+        )
+        self.assertIn(
+            "status = $1 OR payload @> $2::jsonb OR user_id = $3", sql
+        )
+        self.assertEqual(params, ["Queued", {"Other": 1}, "john"])
+        self.assertEqual(
+            self.repository._inspect_query(),
+            ("SELECT task_id, payload FROM downloadtool_tasks "
+             "ORDER BY task_id", []),
+        )
+
+    def test_update_task(self):
+        """ a missing task returns None """
+        self.assertIsNone(self.run_query(
+            self.repository.update_task("7", {"Status": "Queued"})
+        ))
+        _, sql, args = self.conn.queries[0]
+        self.assertNumbered(sql, args)
+        self.assertEqual(args[-1], "7")
+
+    def test_transition_task(self):
+        """ the user and the statuses follow the four fixed params """
+        outcome, payload = self.run_query(
+            self.repository.transition_task(
+                "7", ["Queued"], {"Status": "Cancelled"}, user_id="john"
+            ),
+            ({"Status": "Cancelled"}, "john", None, None),
+        )
+        self.assertEqual(outcome, TRANSITION_DONE)
+        self.assertEqual(payload, {"Status": "Cancelled"})
+        _, sql, args = self.conn.queries[0]
+        self.assertNumbered(sql, args)
+        self.assertIn("t.user_id = $5", sql)
+        self.assertIn("t.status = ANY($6)", sql)
+        self.assertEqual(args[4:], ("john", ["Queued"]))
+
+    def test_transition_task_excluded_status(self):
+        """ excluded statuses keep the tasks without status """
+        outcome, payload = self.run_query(
+            self.repository.transition_task(
+                "7", ["Cancelled"], {"Status": "Cancelled"}, exclude=True
+            ),
+            (None, None, {"Status": "Cancelled"}, "john"),
+        )
+        self.assertEqual(outcome, TRANSITION_INVALID_STATUS)
+        self.assertEqual(payload, {"Status": "Cancelled"})
+        _, sql, args = self.conn.queries[0]
+        self.assertNumbered(sql, args)
+        self.assertIn("NOT (COALESCE(t.status, '') = ANY($5))", sql)
+
+    def test_update_tasks_bulk(self):
+        """ the updates are unnested arrays after the date """
+        updated, missing, finished = self.run_query(
+            self.repository.update_tasks_bulk({
+                "1": {"Status": "Queued"},
+                "2": {},
+                "3": {"Status": "Queued"},
+                "9": {},
+            }),
+            [
+                ("1", {"Status": "Queued"}, "john", "changed"),
+                ("2", {"Status": "Queued"}, "john", "unchanged"),
+                ("3", {"Status": "Cancelled"}, "john", "finished"),
+            ],
+        )
+        self.assertEqual(sorted(updated), ["1", "2"])
+        self.assertEqual(missing, ["9"])
+        self.assertEqual(finished, ["3"])
+        _, sql, args = self.conn.queries[0]
+        self.assertNumbered(sql, args)
+        self.assertIn("unnest($2::text[], $3::text[], $4::text[])", sql)
+        self.assertIn("= ANY($5::text[])", sql)
+        self.assertEqual(args[1], ["1", "2", "3", "9"])
+        self.assertEqual(args[3], ["Queued", None, "Queued", None])
+
+    def test_update_tasks_bulk_empty(self):
+        """ no query without updates """
+        self.assertEqual(
+            self.run_query(self.repository.update_tasks_bulk({})),
+            ({}, [], []),
+        )
+        self.assertEqual(self.conn.queries, [])
+
+    def test_insert_tasks_bulk(self):
+        """ one array placeholder per task column """
+        task_ids = self.run_query(
+            self.repository.insert_tasks_bulk([
+                ("7", {"UserID": "john"}), (None, {"UserID": "mike"}),
+            ]),
+            ["8"],
+        )
+        self.assertEqual(task_ids, ["7", "8"])
+        _, sql, args = self.conn.queries[0]
+        self.assertNumbered(sql, args)
+        _, sql, args = self.conn.queries[1]
+        self.assertNumbered(sql, args)
+        self.assertEqual(len(args), len(aio.TASK_COLUMNS))
+
+    def test_delete_all(self):
+        """ removed rows are read from the command status """
+        self.assertEqual(self.run_query(
+            self.repository.delete_all(), "DELETE 2", "DELETE 1"
+        ), 3)
@@ -0,0 +1,43 @@
+"""
+Test the task repository benchmark
+"""
+# -*- coding: utf-8 -*-
+import io
+import json
+import unittest
+from contextlib import redirect_stdout
+
+from clms.downloadtool.storage.benchmark import TaskGenerator, main
+
+
+class TestBenchmark(unittest.TestCase):
+    """ base class for testing """
+
+    def test_generated_tasks(self):
+        """ the generator is deterministic and yields size tasks """
+        tasks = list(TaskGenerator(300, seed=1))
+        self.assertEqual(len(tasks), 300)
+        self.assertEqual(tasks, list(TaskGenerator(300, seed=1)))
+        self.assertEqual(len({task_id for task_id, _ in tasks}), 300)
+        roles = {payload.get("cdse_task_role") for _, payload in tasks}
+        self.assertEqual(roles, {None, "child", "parent"})
+
+    def test_json_lines_output(self):
+        """ one JSON record is written per backend and operation """
+        output = io.StringIO()
+        with redirect_stdout(output):
+            main([
+                "--sizes", "200", "--backends", "memory,sqlite",
+                "--samples", "5",
+            ])
+        results = [json.loads(line) for line in output.getvalue().split(
+            "\n") if line]
+        self.assertEqual(len(results), 14)
+        self.assertEqual(
+            [result["operation"] for result in results[:7]],
+            ["bulk_insert", "insert", "get", "search", "inspect",
+             "bulk_patch", "group_delete"],
+        )
+        self.assertEqual(results[0]["rows"], 200)
+        self.assertEqual(results[2]["rows"], 5)
+        self.assertEqual(results[7]["backend"], "sqlite")
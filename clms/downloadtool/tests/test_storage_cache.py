@@ -0,0 +1,130 @@
+"""
+Test the read-through task cache
+"""
+# -*- coding: utf-8 -*-
+import unittest
+from unittest import mock
+
+from clms.downloadtool.storage.cache import CachedDownloadtoolRepository
+from clms.downloadtool.storage.memory import MemoryDownloadtoolRepository
+from clms.downloadtool.storage.notify import ALL_CHANGED
+
+
+class TestCachedRepository(unittest.TestCase):
+    """ base class for testing """
+
+    def setUp(self):
+        """ setup """
+        self.repository = MemoryDownloadtoolRepository()
+        self.repository.insert_task(
+            "1", {"UserID": "john", "Status": "Queued"}
+        )
+        self.cache = CachedDownloadtoolRepository(
+            self.repository, maxsize=2, ttl=60
+        )
+
+    def test_reads_are_cached(self):
+        """ repeated reads are answered by the cache """
+        self.cache.get_task("1")
+        self.cache.search_tasks("john")
+        # changes not made through the cache are not seen
+        self.repository.update_task("1", {"Status": "Cancelled"})
+        self.assertEqual(self.cache.get_task("1")["Status"], "Queued")
+        self.assertEqual(
+            self.cache.search_tasks("john")[0][1]["Status"], "Queued"
+        )
+        self.assertEqual(self.cache.cache_stats()["hits"], 2)
+
+    def test_writes_invalidate(self):
+        """ writes through the cache drop the changed entries """
+        self.cache.get_task("1")
+        self.cache.search_tasks("john")
+        self.cache.update_task("1", {"Status": "Cancelled"})
+        self.assertEqual(self.cache.get_task("1")["Status"], "Cancelled")
+        self.cache.insert_task("2", {"UserID": "john", "Status": "Queued"})
+        self.assertEqual(len(self.cache.search_tasks("john")), 2)
+        self.cache.delete_task("2")
+        self.assertEqual(len(self.cache.search_tasks("john")), 1)
+
+    def test_search_pages_are_cached(self):
+        """ repeated page reads do not hit the wrapped repository """
+        backend = mock.Mock(wraps=self.repository)
+        self.cache = CachedDownloadtoolRepository(backend, maxsize=10, ttl=60)
+        first = self.cache.search_tasks_page("john", limit=10)
+        self.assertEqual(self.cache.search_tasks_page("john", limit=10), first)
+        self.assertEqual(backend.search_tasks_page.call_count, 1)
+        self.cache.search_tasks_page("john", limit=10, fields=["Status"])
+        self.assertEqual(backend.search_tasks_page.call_count, 2)
+
+        self.cache.search_tasks_page("mike", limit=10)
+        self.cache.insert_task("2", {"UserID": "john", "Status": "Queued"})
+        rows, _, total = self.cache.search_tasks_page("john", limit=10)
+        self.assertEqual((len(rows), total), (2, 2))
+        self.cache.search_tasks_page("mike", limit=10)
+        self.assertEqual(backend.search_tasks_page.call_count, 4)
+
+        self.cache.delete_task("2")
+        self.assertEqual(self.cache.search_tasks_page("john", limit=10)[2], 1)
+        self.cache.invalidate({"task_id": "1", "user_id": None})
+        self.cache.search_tasks_page("mike", limit=10)
+        self.assertEqual(backend.search_tasks_page.call_count, 6)
+
+    def test_notifications_invalidate(self):
+        """ change notifications drop entries by task and by user """
+        self.cache.get_task("1")
+        self.repository.update_task("1", {"Status": "Cancelled"})
+        self.cache.invalidate({"task_id": "1", "user_id": None})
+        self.assertEqual(self.cache.get_task("1")["Status"], "Cancelled")
+        self.cache.search_tasks("john")
+        self.repository.delete_task("1")
+        self.cache.invalidate(ALL_CHANGED)
+        self.assertEqual(self.cache.search_tasks("john"), [])
+
+    def test_expiry_and_eviction(self):
+        """ entries expire after ttl and the least recently used go """
+        self.repository.insert_task("2", {"UserID": "mike"})
+        with mock.patch(
+            "clms.downloadtool.storage.cache.time.monotonic",
+            return_value=0,
+        ):
+            self.cache.get_task("1")
+            self.cache.get_task("2")
+            self.cache.get_task("1")
+            self.cache.search_tasks("john")
+        self.assertEqual(self.cache.cache_stats()["size"], 2)
+        self.assertEqual(self.cache.cache_stats()["hits"], 1)
+        with mock.patch(
+            "clms.downloadtool.storage.cache.time.monotonic",
+            return_value=61,
+        ):
+            self.cache.get_task("1")
+        self.assertEqual(self.cache.cache_stats()["misses"], 4)
+
+    def test_invalidation_visits_the_user_keys(self):
+        """ searches are indexed by user, evicted ones leave the index """
+        self.cache = CachedDownloadtoolRepository(
+            self.repository, maxsize=3, ttl=60
+        )
+        self.cache.search_tasks("john")
+        self.cache.search_tasks("mike")
+        self.cache.search_tasks_page("john", limit=10)
+        self.assertEqual(sorted(self.cache._user_keys), ["john", "mike"])
+        self.assertEqual(len(self.cache._user_keys["john"]), 2)
+
+        self.cache.invalidate({"task_id": "2", "user_id": "john"})
+        self.assertEqual(list(self.cache._user_keys), ["mike"])
+        self.cache.search_tasks("mike")
+        self.assertEqual(self.cache.cache_stats()["hits"], 1)
+
+        for user_id in ("anna", "bob", "carl"):
+            self.cache.search_tasks(user_id)
+        self.assertEqual(
+            sorted(self.cache._user_keys), ["anna", "bob", "carl"]
+        )
+        self.cache.clear()
+        self.assertEqual(self.cache._user_keys, {})
+
+    def test_returned_values_are_copies(self):
+        """ modifying a returned payload does not change the cache """
+        self.cache.get_task("1")["Status"] = "Cancelled"
+        self.assertEqual(self.cache.get_task("1")["Status"], "Queued")
@@ -0,0 +1,145 @@
+"""
+Test the task id generators
+"""
+# -*- coding: utf-8 -*-
+import os
+import threading
+import unittest
+from unittest import mock
+
+from clms.downloadtool.storage.ids import (
+    RANDOM_ID_MAX,
+    RandomTaskIdGenerator,
+    SequenceTaskIdGenerator,
+    TimeOrderedTaskIdGenerator,
+    get_task_id_generator,
+)
+from clms.downloadtool.storage.memory import MemoryDownloadtoolRepository
+from clms.downloadtool.storage.schema import TASK_ID_SEQUENCE_START
+
+
+class TestTaskIdGenerators(unittest.TestCase):
+    """ base class for testing """
+
+    def setUp(self):
+        """ setup """
+        self.repository = MemoryDownloadtoolRepository()
+
+    def test_random_ids_retry_on_collision(self):
+        """ a drawn id that is already used is drawn again """
+        self.repository.insert_task("7", {"UserID": "john"})
+        with mock.patch(
+            "clms.downloadtool.storage.ids.random.randint",
+            side_effect=[7, 8],
+        ):
+            task_id = RandomTaskIdGenerator().insert(
+                self.repository, {"UserID": "john"}
+            )
+        self.assertEqual(task_id, "8")
+
+    def test_bulk_insert_retries_the_whole_batch(self):
+        """ a collision in a bulk insert inserts nothing and retries """
+        self.repository.insert_task("7", {"UserID": "john"})
+        with mock.patch(
+            "clms.downloadtool.storage.ids.random.randint",
+            side_effect=[5, 7, 5, 6, 5, 6, 8],
+        ):
+            task_ids = RandomTaskIdGenerator().insert_bulk(
+                self.repository,
+                [{"UserID": "john"}, {"UserID": "john"}, {"UserID": "mike"}],
+            )
+        self.assertEqual(task_ids, ["5", "6", "8"])
+        self.assertEqual(self.repository.get_task("8")["UserID"], "mike")
+        self.assertEqual(
+            SequenceTaskIdGenerator().insert_bulk(
+                self.repository, [{"UserID": "john"}]
+            ),
+            [str(TASK_ID_SEQUENCE_START)],
+        )
+
+    def test_sequence_ids_are_above_random_ids(self):
+        """ sequence ids never collide with random ids """
+        generator = SequenceTaskIdGenerator()
+        first = generator.insert(self.repository, {"UserID": "john"})
+        second = generator.insert(self.repository, {"UserID": "john"})
+        self.assertGreater(int(first), RANDOM_ID_MAX)
+        self.assertEqual(int(second), int(first) + 1)
+        self.assertEqual(self.repository.get_task(second)["UserID"], "john")
+
+    def test_time_ids_are_unique_and_ordered(self):
+        """ time ordered ids increase, also from several threads """
+        generator = TimeOrderedTaskIdGenerator(node_id=3)
+        ids = []
+
+        def worker():
+            for _ in range(500):
+                ids.append(int(generator.next_id()))
+
+        threads = [threading.Thread(target=worker) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(len(set(ids)), 2000)
+        self.assertGreater(min(ids), RANDOM_ID_MAX)
+        self.assertLess(max(ids), 2 ** 53)
+        sequential = [int(generator.next_id()) for _ in range(200)]
+        self.assertEqual(sequential, sorted(sequential))
+
+    def test_time_ids_of_nodes_never_collide(self):
+        """ nodes drawing ids in the same millisecond get distinct ids """
+        generators = [
+            TimeOrderedTaskIdGenerator(node_id=node_id)
+            for node_id in (0, 1, 255)
+        ]
+        with mock.patch(
+            "clms.downloadtool.storage.ids.time.time",
+            return_value=1800000000.0,
+        ):
+            ids = [
+                generator.next_id()
+                for generator in generators
+                for _ in range(16)
+            ]
+        self.assertEqual(len(set(ids)), 48)
+        self.assertRaises(ValueError, TimeOrderedTaskIdGenerator, 256)
+
+    def test_time_ids_require_a_node_id(self):
+        """ time ordered ids need an explicit DOWNLOADTOOL_NODE_ID """
+        environ = {"DOWNLOADTOOL_TASK_ID_MODE": "time"}
+        for node_id in ("", "abc", "256"):
+            environ["DOWNLOADTOOL_NODE_ID"] = node_id
+            with mock.patch.dict(os.environ, environ):
+                self.assertRaises(RuntimeError, get_task_id_generator)
+        environ["DOWNLOADTOOL_NODE_ID"] = "7"
+        with mock.patch.dict(os.environ, environ):
+            self.assertEqual(get_task_id_generator().node_id, 7)
+
+    def test_time_ids_tolerate_clock_going_back(self):
+        """ ids keep increasing when the clock goes backwards """
+        generator = TimeOrderedTaskIdGenerator(node_id=1)
+        with mock.patch(
+            "clms.downloadtool.storage.ids.time.time",
+            side_effect=[1800000000.0, 1799999999.0],
+        ):
+            first = int(generator.next_id())
+            second = int(generator.next_id())
+        self.assertGreater(second, first)
+
+    def test_mode_from_environment(self):
+        """ the generator is selected by DOWNLOADTOOL_TASK_ID_MODE """
+        with mock.patch.dict(os.environ, {"DOWNLOADTOOL_TASK_ID_MODE": ""}):
+            self.assertIsInstance(
+                get_task_id_generator(), RandomTaskIdGenerator
+            )
+        with mock.patch.dict(
+            os.environ, {"DOWNLOADTOOL_TASK_ID_MODE": "sequence"}
+        ):
+            self.assertIsInstance(
+                get_task_id_generator(), SequenceTaskIdGenerator
+            )
+        with mock.patch.dict(
+            os.environ, {"DOWNLOADTOOL_TASK_ID_MODE": "uuid"}
+        ):
+            self.assertRaises(RuntimeError, get_task_id_generator)
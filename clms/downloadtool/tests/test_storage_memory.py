@@ -0,0 +1,339 @@
+"""
+Test the in-memory task repository
+"""
+# -*- coding: utf-8 -*-
+import threading
+from datetime import datetime, timedelta, timezone
+import unittest
+
+from clms.downloadtool.storage.db import (
+    FINISHED_STATUSES,
+    TRANSITION_DONE,
+    TRANSITION_INVALID_STATUS,
+    TRANSITION_NOT_FOUND,
+    TRANSITION_PERMISSION_DENIED,
+)
+from clms.downloadtool.storage.memory import MemoryDownloadtoolRepository
+
+
+class TestMemoryRepository(unittest.TestCase):
+    """ base class for testing """
+
+    def make_repository(self):
+        """ return the repository under test """
+        return MemoryDownloadtoolRepository()
+
+    def setUp(self):
+        """ setup """
+        self.repository = self.make_repository()
+        self.repository.insert_task(
+            "1", {"UserID": "john", "Status": "Queued"}
+        )
+        self.repository.insert_task(
+            "2", {"UserID": "john", "Status": "In_progress"}
+        )
+        self.repository.insert_task("3", {
+            "UserID": "mike",
+            "Status": "Queued",
+            "cdse_task_role": "child",
+            "cdse_task_group_id": "group-1",
+        })
+
+    def search_ids(self, user_id, status=None):
+        """ return the task ids found by search_tasks """
+        return sorted(
+            task_id for task_id, _ in self.repository.search_tasks(
+                user_id, status=status)
+        )
+
+    def inspect_ids(self, **query):
+        """ return the task ids found by inspect_tasks """
+        return [
+            task_id for task_id, _ in self.repository.inspect_tasks(query)
+        ]
+
+    def test_search_uses_user_and_status(self):
+        """ search by user and status """
+        self.assertEqual(self.search_ids("john"), ["1", "2"])
+        self.assertEqual(self.search_ids("john", "Queued"), ["1"])
+        self.assertEqual(self.search_ids("mike", "In_progress"), [])
+
+    def test_indexes_follow_updates(self):
+        """ updated keys move the task between index entries """
+        self.repository.update_task("1", {"Status": "Finished_ok"})
+        self.repository.update_tasks_bulk({"3": {"Status": "Cancelled"}})
+        self.assertEqual(self.search_ids("john", "Queued"), [])
+        self.assertEqual(self.search_ids("john", "Finished_ok"), ["1"])
+        self.assertEqual(self.inspect_ids(Status="Cancelled"), ["3"])
+
+    def test_bulk_update_notifies_changed_tasks(self):
+        """ tasks left unchanged by a bulk update are not notified """
+        with self.repository.watch_task("1") as changed:
+            if changed is None:
+                self.skipTest("task changes are not notified")
+            updated, missing, _ = self.repository.update_tasks_bulk({
+                "1": {"Status": "Queued"}, "2": {}, "9": {},
+            })
+            self.assertEqual(sorted(updated), ["1", "2"])
+            self.assertEqual(missing, ["9"])
+            self.assertFalse(changed.is_set())
+            self.repository.update_tasks_bulk({"1": {"Status": "Rejected"}})
+            self.assertTrue(changed.is_set())
+
+    def test_bulk_update_skips_finished_tasks(self):
+        """ a bulk update does not move a finished task """
+        self.repository.update_task("1", {"Status": "Cancelled"})
+        updated, missing, finished = self.repository.update_tasks_bulk({
+            "1": {"Status": "Finished_ok"},
+            "2": {"Status": "Finished_ok"},
+        })
+        self.assertEqual(sorted(updated), ["2"])
+        self.assertEqual(missing, [])
+        self.assertEqual(finished, ["1"])
+        self.assertEqual(self.repository.get_task("1")["Status"], "Cancelled")
+
+    def test_indexes_follow_deletes(self):
+        """ deleted tasks are removed from the indexes """
+        self.repository.delete_task("3")
+        self.assertEqual(self.inspect_ids(cdse_task_group_id="group-1"), [])
+        self.repository.delete_all()
+        self.assertEqual(self.search_ids("john"), [])
+
+    def test_inspect_is_an_or_query(self):
+        """ inspect returns tasks matching any of the filters """
+        self.assertEqual(
+            self.inspect_ids(Status="In_progress", cdse_task_role="child"),
+            ["2", "3"],
+        )
+        self.assertEqual(
+            self.inspect_ids(Status="In_progress", UnknownKey="x"), ["2"]
+        )
+
+    def test_reads_return_copies(self):
+        """ modifying a returned payload does not change the stored one """
+        self.repository.get_task("1")["Status"] = "Cancelled"
+        self.assertEqual(self.search_ids("john", "Queued"), ["1"])
+
+    def test_concurrent_writes(self):
+        """ concurrent inserts and updates keep the indexes consistent """
+        def worker(offset):
+            for number in range(200):
+                task_id = "t{0}-{1}".format(offset, number)
+                self.repository.insert_task(
+                    task_id, {"UserID": "load", "Status": "Queued"}
+                )
+                self.repository.update_task(task_id, {"Status": "Rejected"})
+
+        threads = [
+            threading.Thread(target=worker, args=(offset,))
+            for offset in range(4)
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(len(self.search_ids("load", "Rejected")), 800)
+        self.assertEqual(self.search_ids("load", "Queued"), [])
+
+    def test_transition_task(self):
+        """ updates apply only to tasks in the expected statuses """
+        self.assertEqual(
+            self.repository.transition_task(
+                "1", ["In_progress"], {"Status": "Finished_ok"}
+            ),
+            (TRANSITION_INVALID_STATUS, {"UserID": "john",
+                                         "Status": "Queued"}),
+        )
+        self.assertEqual(
+            self.repository.transition_task(
+                "1", ["Queued"], {"Status": "In_progress"}, user_id="mike"
+            )[0],
+            TRANSITION_PERMISSION_DENIED,
+        )
+        self.assertEqual(
+            self.repository.transition_task(
+                "9", None, {"Status": "In_progress"}
+            ),
+            (TRANSITION_NOT_FOUND, None),
+        )
+        outcome, payload = self.repository.transition_task(
+            "1", FINISHED_STATUSES, {"Status": "Cancelled"},
+            user_id="john", exclude=True,
+        )
+        self.assertEqual(outcome, TRANSITION_DONE)
+        self.assertEqual(payload["Status"], "Cancelled")
+        self.assertEqual(self.search_ids("john", "Cancelled"), ["1"])
+        self.assertEqual(
+            self.repository.transition_task(
+                "1", FINISHED_STATUSES, {"Status": "Cancelled"},
+                exclude=True,
+            )[0],
+            TRANSITION_INVALID_STATUS,
+        )
+
+    def test_archive_finished_tasks(self):
+        """ archived tasks are still read by id and by user """
+        self.repository.insert_task("4", {
+            "UserID": "john",
+            "Status": "Finished_ok",
+            "RegistrationDateTime": "2020-01-01T00:00:00+00:00",
+        })
+        self.repository.update_task("2", {"Status": "Cancelled"})
+        archived = self.repository.archive_finished_tasks(
+            datetime(2021, 1, 1, tzinfo=timezone.utc)
+        )
+        # task 2 has no registration date, so it is always old enough
+        self.assertEqual(archived, 2)
+        self.assertEqual(self.inspect_ids(UserID="john"), ["1"])
+        self.assertEqual(self.search_ids("john"), ["1", "2", "4"])
+        self.assertEqual(self.search_ids("john", "Queued"), ["1"])
+        self.assertEqual(self.repository.get_task("4")["Status"],
+                         "Finished_ok")
+        self.assertTrue(self.repository.delete_task("4"))
+        self.assertIsNone(self.repository.get_task("4"))
+
+    def test_task_stats(self):
+        """ tasks are counted by status, role and hour of registration """
+        self.repository.update_task(
+            "1", {"RegistrationDateTime": "2024-01-01T10:15:00+00:00"}
+        )
+        self.repository.update_task(
+            "2", {"RegistrationDateTime": "2024-01-01T12:30:00+02:00"}
+        )
+        self.repository.update_task(
+            "3", {"RegistrationDateTime": "2024-01-01T11:00:00Z"}
+        )
+        self.repository.insert_task("4", {"UserID": "mike"})
+        stats = self.repository.task_stats()
+        self.assertEqual(stats["total"], 4)
+        self.assertEqual(
+            stats["by_status"], {"Queued": 2, "In_progress": 1, "": 1}
+        )
+        self.assertEqual(
+            stats["by_role"], {"fme": 3, "cdse_parent": 0, "cdse_child": 1}
+        )
+        self.assertEqual(
+            stats["by_hour"],
+            {
+                "2024-01-01T10:00:00+00:00": 2,
+                "2024-01-01T11:00:00+00:00": 1,
+            },
+        )
+        self.assertEqual(stats["queue_age"]["count"], 3)
+        age = stats["queue_age"]
+        self.assertTrue(age["p50"] <= age["p90"] <= age["p99"] <= age["max"])
+        self.assertAlmostEqual(age["max"] - age["p50"], 15 * 60, places=0)
+        self.assertEqual(
+            self.repository.task_stats(
+                since=datetime(2024, 1, 1, 11, tzinfo=timezone.utc)
+            )["by_hour"],
+            {"2024-01-01T11:00:00+00:00": 1},
+        )
+
+    def test_outbox_jobs(self):
+        """ outbox jobs are published oldest first, kept on errors """
+        jobs = [
+            {
+                "queue_name": "downloadtool_jobs",
+                "job_name": "downloadtool_updates",
+                "data": {"number": number},
+                "opts": {"attempts": 1},
+            }
+            for number in range(3)
+        ]
+        self.assertEqual(self.repository.add_outbox_jobs(jobs), 3)
+
+        def fail(batch):
+            raise ConnectionError()
+
+        with self.assertRaises(ConnectionError):
+            self.repository.relay_outbox_jobs(fail, batch_size=2)
+
+        published = []
+        self.assertEqual(
+            self.repository.relay_outbox_jobs(
+                published.append, batch_size=2
+            ),
+            2,
+        )
+        self.assertEqual(
+            self.repository.relay_outbox_jobs(published.append), 1
+        )
+        self.assertEqual(self.repository.relay_outbox_jobs(fail), 0)
+        self.assertEqual(published, [jobs[:2], jobs[2:]])
+
+    def test_prepared_outbox_jobs(self):
+        """ prepared jobs are published once committed, last of a key """
+        def job(number, job_key=None):
+            return {
+                "queue_name": "downloadtool_jobs",
+                "job_name": "downloadtool_updates",
+                "data": {"number": number},
+                "opts": {},
+                "job_key": job_key,
+            }
+
+        prepared = self.repository.prepare_outbox_jobs([job(0, "a")])
+        self.assertEqual(prepared.count, 1)
+        prepared.rollback()
+        prepared = self.repository.prepare_outbox_jobs(
+            [job(1, "a"), job(2), job(3, "a")]
+        )
+        self.assertEqual(prepared.count, 2)
+        prepared.commit()
+        self.repository.prepare_outbox_jobs([job(4, "a")]).commit()
+        published = []
+        self.repository.relay_outbox_jobs(published.extend)
+        self.assertEqual(
+            [row["data"]["number"] for row in published], [4, 2]
+        )
+        self.assertNotIn("job_key", published[0])
+
+    def test_purge_tasks(self):
+        """ old tasks of a status are purged from both tables in chunks """
+        for number in range(4):
+            self.repository.insert_task("old{0}".format(number), {
+                "UserID": "john",
+                "Status": "Cancelled",
+                "RegistrationDateTime": "2020-01-01T00:00:00+00:00",
+            })
+        self.repository.insert_task("new", {
+            "UserID": "john",
+            "Status": "Cancelled",
+            "RegistrationDateTime": "2024-01-01T00:00:00+00:00",
+        })
+        self.repository.archive_finished_tasks(
+            datetime(2021, 1, 1, tzinfo=timezone.utc)
+        )
+        self.repository.insert_task("old4", {
+            "UserID": "john",
+            "Status": "Cancelled",
+            "RegistrationDateTime": "2020-01-01T00:00:00+00:00",
+        })
+        older_than = datetime(2023, 1, 1, tzinfo=timezone.utc)
+        first = self.repository.purge_tasks(
+            "Cancelled", older_than, batch_size=3
+        )
+        self.assertEqual(len(first), 3)
+        self.assertIn("old4", first)
+        second = self.repository.purge_tasks(
+            "Cancelled", older_than, batch_size=3
+        )
+        self.assertEqual(
+            sorted(first + second), ["old0", "old1", "old2", "old3", "old4"]
+        )
+        self.assertEqual(self.search_ids("john", "Cancelled"), ["new"])
+        self.assertEqual(self.search_ids("john"), ["1", "2", "new"])
+
+    def test_purge_tasks_without_registration_date(self):
+        """ tasks without registration date expire on their updated_at """
+        older_than = datetime(2023, 1, 1, tzinfo=timezone.utc)
+        self.assertEqual(
+            self.repository.purge_tasks("Queued", older_than), []
+        )
+        older_than = datetime.now(timezone.utc) + timedelta(days=1)
+        self.assertEqual(
+            sorted(self.repository.purge_tasks("Queued", older_than)),
+            ["1", "3"],
+        )
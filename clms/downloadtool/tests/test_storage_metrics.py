@@ -0,0 +1,92 @@
+"""
+Test the repository instrumentation
+"""
+# -*- coding: utf-8 -*-
+import unittest
+
+from clms.downloadtool.storage.cache import unwrap_repository
+from clms.downloadtool.storage.memory import MemoryDownloadtoolRepository
+from clms.downloadtool.storage.metrics import (
+    InstrumentedDownloadtoolRepository,
+    render_families,
+)
+
+
+class TestRepositoryMetrics(unittest.TestCase):
+    """ base class for testing """
+
+    def setUp(self):
+        """ setup """
+        self.repository = InstrumentedDownloadtoolRepository(
+            MemoryDownloadtoolRepository()
+        )
+        self.repository.insert_task("1", {"UserID": "john"})
+        self.repository.insert_task("2", {"UserID": "john"})
+
+    def render(self):
+        """ return the rendered metrics lines """
+        return self.repository.metrics.render().splitlines()
+
+    def test_calls_and_rows(self):
+        """ calls are timed and their rows counted per method """
+        self.repository.search_tasks("john")
+        self.assertEqual(len(list(self.repository.iter_inspect_tasks())), 2)
+        lines = self.render()
+        self.assertIn(
+            'downloadtool_repository_call_duration_seconds_count'
+            '{method="insert_task"} 2',
+            lines,
+        )
+        self.assertIn(
+            'downloadtool_repository_call_duration_seconds_bucket'
+            '{method="search_tasks",le="+Inf"} 1',
+            lines,
+        )
+        self.assertIn(
+            'downloadtool_repository_rows_total{method="search_tasks"} 2',
+            lines,
+        )
+        self.assertIn(
+            'downloadtool_repository_rows_total'
+            '{method="iter_inspect_tasks"} 2',
+            lines,
+        )
+
+    def test_collisions_and_errors(self):
+        """ rejected inserts and raised errors are counted """
+        self.assertFalse(self.repository.insert_task("1", {}))
+        with self.assertRaises(TypeError):
+            self.repository.get_task()
+        lines = self.render()
+        self.assertIn(
+            'downloadtool_repository_insert_collisions_total'
+            '{method="insert_task"} 1',
+            lines,
+        )
+        self.assertIn(
+            'downloadtool_repository_errors_total{method="get_task"} 1',
+            lines,
+        )
+
+    def test_pool_stats_and_unwrap(self):
+        """ pool metrics are gauges and the wrapper can be removed """
+        lines = self.repository.metrics.render({"in_use": 1})
+        self.assertIn("downloadtool_repository_pool_in_use 1", lines)
+        self.assertIsInstance(
+            unwrap_repository(self.repository), MemoryDownloadtoolRepository
+        )
+
+    def test_render_families(self):
+        """ families are rendered with their help, type and samples """
+        self.assertEqual(
+            render_families([
+                ("jobs_total", "counter", "Jobs.", [
+                    ("jobs_total", (("queue", "a"),), 2),
+                    ("jobs_total", (), 0.5),
+                ]),
+            ]),
+            "# HELP jobs_total Jobs.\n"
+            "# TYPE jobs_total counter\n"
+            'jobs_total{queue="a"} 2\n'
+            "jobs_total 0.5\n",
+        )
@@ -0,0 +1,131 @@
+"""
+Test the connection pool used by the PostgreSQL repository
+"""
+# -*- coding: utf-8 -*-
+import os
+import threading
+import unittest
+from types import SimpleNamespace
+from unittest import mock
+
+from clms.downloadtool.storage import pool as pool_module
+from clms.downloadtool.storage.pool import ConnectionPool, PoolTimeout
+
+
+class FakeCursor:
+    """ cursor stub """
+
+    def __init__(self, conn):
+        self.conn = conn
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        return False
+
+    def execute(self, query, params=None):
+        """ fail when the connection is broken """
+        if self.conn.broken:
+            raise RuntimeError("server closed the connection")
+
+
+class FakeConnection:
+    """ connection stub """
+
+    def __init__(self):
+        self.closed = 0
+        self.broken = False
+
+    def cursor(self):
+        """ cursor """
+        return FakeCursor(self)
+
+    def rollback(self):
+        """ rollback """
+        if self.broken:
+            raise RuntimeError("server closed the connection")
+
+    def close(self):
+        """ close """
+        self.closed = 1
+
+
+class TestConnectionPool(unittest.TestCase):
+    """ base class for testing """
+
+    def test_connections_are_reused(self):
+        """ a returned connection is handed out again """
+        pool = ConnectionPool(FakeConnection, size=2)
+        conn = pool.getconn()
+        pool.putconn(conn)
+        self.assertIs(pool.getconn(), conn)
+        self.assertEqual(pool.stats()["created"], 1)
+
+    def test_pool_is_bounded(self):
+        """ getconn waits and then times out when the pool is exhausted """
+        pool = ConnectionPool(FakeConnection, size=1, timeout=0.05)
+        pool.getconn()
+        with self.assertRaises(PoolTimeout):
+            pool.getconn()
+        stats = pool.stats()
+        self.assertEqual(stats["timeouts"], 1)
+        self.assertEqual(stats["in_use"], 1)
+
+    def test_waiting_thread_gets_released_connection(self):
+        """ a blocked checkout succeeds once a connection is returned """
+        pool = ConnectionPool(FakeConnection, size=1, timeout=5)
+        conn = pool.getconn()
+        result = []
+        waiter = threading.Thread(target=lambda: result.append(pool.getconn()))
+        waiter.start()
+        pool.putconn(conn)
+        waiter.join(5)
+        self.assertEqual(result, [conn])
+        self.assertEqual(pool.stats()["waits"], 1)
+
+    def test_broken_connections_are_discarded(self):
+        """ connections failing the health check are replaced """
+        pool = ConnectionPool(FakeConnection, size=1, health_check=0)
+        conn = pool.getconn()
+        pool.putconn(conn)
+        conn.broken = True
+        new_conn = pool.getconn()
+        self.assertIsNot(new_conn, conn)
+        self.assertTrue(conn.closed)
+        self.assertEqual(pool.stats()["discarded"], 1)
+
+    def test_idle_connections_are_recycled(self):
+        """ connections idle for longer than max_idle are closed """
+        pool = ConnectionPool(FakeConnection, size=1, max_idle=0)
+        conn = pool.getconn()
+        pool.putconn(conn)
+        self.assertIsNot(pool.getconn(), conn)
+        self.assertTrue(conn.closed)
+
+    def test_discard_on_putconn(self):
+        """ explicitly discarded connections are closed """
+        pool = ConnectionPool(FakeConnection, size=1)
+        conn = pool.getconn()
+        pool.putconn(conn, discard=True)
+        self.assertTrue(conn.closed)
+        self.assertEqual(pool.stats()["idle"], 0)
+
+    def test_size_follows_the_zope_threads(self):
+        """ the default size is the zserver-threads setting """
+        def configuration(**settings):
+            return mock.patch.object(
+                pool_module, "getConfiguration",
+                lambda: SimpleNamespace(**settings),
+            )
+
+        with mock.patch.dict(os.environ, {"DOWNLOADTOOL_DB_POOL_SIZE": ""}):
+            with configuration(zserver_threads=8):
+                self.assertEqual(pool_module.pool_settings()["size"], 8)
+            with configuration():
+                self.assertEqual(pool_module.pool_settings()["size"], 4)
+            with mock.patch.object(pool_module, "getConfiguration", None):
+                self.assertEqual(pool_module.default_pool_size(), 4)
+        with mock.patch.dict(os.environ, {"DOWNLOADTOOL_DB_POOL_SIZE": "2"}):
+            with configuration(zserver_threads=8):
+                self.assertEqual(pool_module.pool_settings()["size"], 2)
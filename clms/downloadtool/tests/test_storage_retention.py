@@ -0,0 +1,64 @@
+"""
+Test the retention purge of old tasks
+"""
+# -*- coding: utf-8 -*-
+import unittest
+from unittest import mock
+
+from clms.downloadtool.storage.memory import MemoryDownloadtoolRepository
+from clms.downloadtool.storage.retention import (
+    DEFAULT_RETENTION_DAYS,
+    purge_expired_tasks,
+    retention_days,
+)
+
+
+class TestRetention(unittest.TestCase):
+    """ base class for testing """
+
+    def setUp(self):
+        """ setup """
+        self.repository = MemoryDownloadtoolRepository()
+        for number in range(5):
+            self.repository.insert_task(str(number), {
+                "Status": "Rejected",
+                "RegistrationDateTime": "2020-01-01T00:00:00+00:00",
+            })
+        self.repository.insert_task("queued", {
+            "Status": "Queued",
+            "RegistrationDateTime": "2020-01-01T00:00:00+00:00",
+        })
+
+    def test_retention_days(self):
+        """ the policy overrides the default days by status """
+        self.assertEqual(retention_days(""), DEFAULT_RETENTION_DAYS)
+        policy = retention_days("Rejected=30, Queued=400")
+        self.assertEqual(policy["Rejected"], 30)
+        self.assertEqual(policy["Queued"], 400)
+        self.assertEqual(retention_days({"Cancelled": "5"})["Cancelled"], 5)
+        for value in ("Rejected", "Rejected=x", "Rejected=0", 3):
+            with self.assertRaises(ValueError):
+                retention_days(value)
+
+    @mock.patch("clms.downloadtool.storage.retention.time.sleep")
+    def test_purge_in_chunks(self, sleep):
+        """ expired tasks are deleted in chunks with a pause between """
+        result = purge_expired_tasks(
+            self.repository, "", batch_size=2, pause=0.1
+        )
+        self.assertEqual(result["deleted"]["Rejected"], 5)
+        self.assertEqual(result["total"], 5)
+        self.assertTrue(result["complete"])
+        self.assertEqual(sleep.call_count, 2)
+        self.assertEqual(
+            [task_id for task_id, _ in self.repository.inspect_tasks()],
+            ["queued"],
+        )
+
+    def test_purge_time_budget(self):
+        """ the purge stops once max_seconds are spent """
+        result = purge_expired_tasks(
+            self.repository, "", batch_size=2, max_seconds=0
+        )
+        self.assertEqual(result["total"], 0)
+        self.assertFalse(result["complete"])
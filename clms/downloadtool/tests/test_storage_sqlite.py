@@ -0,0 +1,89 @@
+"""
+Test the SQLite task repository
+"""
+# -*- coding: utf-8 -*-
+import os
+import shutil
+import tempfile
+from datetime import datetime, timezone
+
+from clms.downloadtool.storage.sqlite import SqliteDownloadtoolRepository
+from clms.downloadtool.tests import test_storage_memory
+
+
+class TestSqliteRepository(test_storage_memory.TestMemoryRepository):
+    """ run the in-memory repository tests against SQLite """
+
+    def make_repository(self):
+        """ return a repository on a temporary database file """
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        repository = SqliteDownloadtoolRepository(
+            os.path.join(directory, "tasks.db")
+        )
+        self.addCleanup(repository.close)
+        return repository
+
+    def test_wal_mode(self):
+        """ the database is opened in WAL mode """
+        row = self.repository._conn().execute(
+            "PRAGMA journal_mode").fetchone()
+        self.assertEqual(row[0], "wal")
+
+    def test_payload_types_round_trip(self):
+        """ payloads keep their JSON types and merge top level keys """
+        self.repository.update_task("1", {
+            "Datasets": [{"DatasetID": "a"}], "Count": 2, "Flag": None,
+        })
+        self.assertEqual(self.repository.get_task("1"), {
+            "UserID": "john", "Status": "Queued",
+            "Datasets": [{"DatasetID": "a"}], "Count": 2, "Flag": None,
+        })
+        self.assertEqual(
+            [task_id for task_id, _ in self.repository.inspect_tasks(
+                {"Count": 2})],
+            ["1"],
+        )
+
+    def test_sequence_and_bulk_insert(self):
+        """ sequence ids are unique and bulk inserts are all or nothing """
+        first = self.repository.insert_task_next_id({"UserID": "john"})
+        task_ids = self.repository.insert_tasks_bulk(
+            [(None, {"UserID": "john"}), ("x", {"UserID": "john"})]
+        )
+        self.assertEqual(task_ids, [str(int(first) + 1), "x"])
+        self.assertIsNone(self.repository.insert_tasks_bulk(
+            [("y", {"UserID": "john"}), ("1", {"UserID": "john"})]
+        ))
+        self.assertIsNone(self.repository.get_task("y"))
+
+    def test_duplicate_datasets(self):
+        """ datasets of active tasks are found by fingerprint """
+        self.repository.update_task("1", {"Datasets": [{"DatasetID": "a"}]})
+        self.assertTrue(self.repository.has_duplicate_datasets(
+            "john", [{"DatasetID": "a"}]))
+        self.assertFalse(self.repository.has_duplicate_datasets(
+            "mike", [{"DatasetID": "a"}]))
+
+    def test_search_tasks_page(self):
+        """ pages follow the registration date and task id """
+        for number in range(5):
+            self.repository.insert_task("p{0}".format(number), {
+                "UserID": "page",
+                "RegistrationDateTime": "2024-01-0{0}T00:00:00Z".format(
+                    number + 1),
+            })
+        rows, after, total = self.repository.search_tasks_page(
+            "page", limit=2)
+        self.assertEqual([task_id for task_id, _ in rows], ["p4", "p3"])
+        self.assertEqual(total, 5)
+        self.assertEqual(
+            after, (datetime(2024, 1, 4, tzinfo=timezone.utc), "p3"))
+        rows, after, _ = self.repository.search_tasks_page(
+            "page", limit=3, after=after, fields=["UserID"])
+        self.assertEqual(rows, [
+            ("p2", {"UserID": "page"}),
+            ("p1", {"UserID": "page"}),
+            ("p0", {"UserID": "page"}),
+        ])
+        self.assertIsNone(after)
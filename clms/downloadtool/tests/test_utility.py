@@ -2,8 +2,12 @@
 The utility holds all operations of the download tool
 """
 # -*- coding: utf-8 -*-
+import threading
 import unittest
+from contextlib import contextmanager
+from unittest import mock
 
+from clms.downloadtool import utility as utility_module
 from clms.downloadtool.testing import CLMS_DOWNLOADTOOL_INTEGRATION_TESTING
 from clms.downloadtool.utility import IDownloadToolUtility
 from zope.component import getUtility
@@ -27,6 +31,21 @@ class TestUtility(unittest.TestCase):
         key = list(result.keys())[0]
         self.assertEqual(self.utility.datarequest_status_get(key), data_dict)
 
+    def test_datarequest_post_bulk(self):
+        """ test datarequest_post_bulk method """
+        data_dicts = [
+            {"UserID": "john", "cdse_task_role": "child"},
+            {"UserID": "john", "cdse_task_role": "child"},
+            {"UserID": "john", "cdse_task_role": "parent"},
+        ]
+        result = self.utility.datarequest_post_bulk(data_dicts)
+        self.assertEqual(list(result.values()), data_dicts)
+        for key, data_dict in result.items():
+            self.assertIn("RegistrationDateTime", data_dict)
+            self.assertEqual(
+                self.utility.datarequest_status_get(key), data_dict
+            )
+
     def test_datarequest_delete(self):
         """ test datarequest_delete method """
         data_dict_1 = {"key1": "value1", "key2": "value2", "UserID": "john"}
@@ -45,6 +64,19 @@ class TestUtility(unittest.TestCase):
         result_3 = self.utility.datarequest_delete("XXXXX", "john")
         self.assertEqual(result_3, "Error, TaskID not registered")
 
+    def test_datarequest_delete_finished_task(self):
+        """ finished tasks can not be cancelled """
+        data_dict_1 = {"UserID": "john", "Status": "Finished_ok"}
+        result_1 = self.utility.datarequest_post(data_dict_1)
+        key_1 = list(result_1.keys())[0]
+
+        result = self.utility.datarequest_delete(key_1, "john")
+        self.assertEqual(result, "Error, task already finished")
+        self.assertEqual(
+            self.utility.datarequest_status_get(key_1)["Status"],
+            "Finished_ok",
+        )
+
     def test_datarequest_delete_other_user_entry(self):
         """ test datarequest_delete method """
         data_dict_1 = {"key1": "value1", "key2": "value2", "UserID": "john"}
@@ -191,6 +223,23 @@ class TestUtility(unittest.TestCase):
         data_dict_1.update(data_dict_2)
         self.assertEqual(result, data_dict_1)
 
+    def test_datarequest_status_patch_finished_task(self):
+        """ a finished task keeps its status """
+        data_dict_1 = {"UserID": "john", "Status": "In_progress"}
+        result_1 = self.utility.datarequest_post(data_dict_1)
+        key_1 = list(result_1.keys())[0]
+        self.utility.datarequest_delete(key_1, "john")
+
+        result = self.utility.datarequest_status_patch(
+            {"Status": "Finished_ok"}, key_1
+        )
+        self.assertEqual(result, "Error, task already finished")
+
+        result = self.utility.datarequest_status_patch(
+            {"Status": "Cancelled", "Message": "cancelled by user"}, key_1
+        )
+        self.assertEqual(result["Message"], "cancelled by user")
+
     def test_datarequest_status_patch_invalid_key(self):
         """ test datarequest_status_patch method with an invalid key """
         data_dict_1 = {
@@ -321,3 +370,374 @@ class TestUtility(unittest.TestCase):
         """ test removing an unexisting"""
         result = self.utility.datarequest_remove_task("unexisting-key")
         self.assertEqual(result, "Error, TaskID not registered")
+
+    def test_datarequest_status_patch_multiple(self):
+        """ test patching several tasks at once """
+        data_dict = {"UserID": "john", "Status": "In_progress"}
+        key_1 = list(self.utility.datarequest_post(dict(data_dict)).keys())[0]
+        key_2 = list(self.utility.datarequest_post(dict(data_dict)).keys())[0]
+
+        result = self.utility.datarequest_status_patch_multiple({
+            key_1: {"Status": "Finished_ok", "OtherKey": "Other Value"},
+            key_2: {"FileSize": 20000},
+        })
+
+        self.assertEqual(result[key_1]["Status"], "Finished_ok")
+        self.assertNotIn("OtherKey", result[key_1])
+        self.assertEqual(result[key_2]["Status"], "In_progress")
+        self.assertEqual(result[key_2]["FileSize"], 20000)
+        self.assertEqual(
+            self.utility.datarequest_status_get(key_1)["Status"],
+            "Finished_ok",
+        )
+
+    def test_datarequest_status_patch_multiple_errors(self):
+        """ test patching several tasks with unknown ids and bad data """
+        data_dict = {"UserID": "john", "Status": "In_progress"}
+        key_1 = list(self.utility.datarequest_post(dict(data_dict)).keys())[0]
+        key_2 = list(self.utility.datarequest_post(dict(data_dict)).keys())[0]
+
+        result = self.utility.datarequest_status_patch_multiple({
+            key_1: {"Status": "Finished_ok"},
+            key_2: "not a dict",
+            "XXXX": {"Status": "Finished_ok"},
+        })
+
+        self.assertEqual(list(result["updated"].keys()), [key_1])
+        self.assertEqual(
+            result["errors"],
+            {
+                key_2: "Error, invalid data_object",
+                "XXXX": "Error, task_id not registered",
+            },
+        )
+
+    def test_datarequest_status_patch_multiple_finished_task(self):
+        """ a bulk patch keeps the status of finished tasks """
+        data_dict = {"UserID": "john", "Status": "In_progress"}
+        key_1 = list(self.utility.datarequest_post(dict(data_dict)).keys())[0]
+        key_2 = list(self.utility.datarequest_post(dict(data_dict)).keys())[0]
+        self.utility.datarequest_delete(key_1, "john")
+
+        result = self.utility.datarequest_status_patch_multiple({
+            key_1: {"Status": "Finished_ok"},
+            key_2: {"Status": "Finished_ok"},
+        })
+
+        self.assertEqual(list(result["updated"].keys()), [key_2])
+        self.assertEqual(
+            result["errors"], {key_1: "Error, task already finished"}
+        )
+        self.assertEqual(
+            self.utility.datarequest_status_get(key_1)["Status"],
+            "Cancelled",
+        )
+
+    def test_datarequest_status_patch_multiple_invalid_payload(self):
+        """ test patching several tasks with a non dict payload """
+        result = self.utility.datarequest_status_patch_multiple(["XXXX"])
+        self.assertEqual(result, "Error, invalid payload")
+
+    def test_datarequest_search_page(self):
+        """ test keyset pagination of datarequest_search_page """
+        for day in range(1, 6):
+            self.utility.datarequest_post({
+                "UserID": "john",
+                "Status": "Queued",
+                "RegistrationDateTime": "2024-01-0{0}T00:00:00".format(day),
+            })
+        self.utility.datarequest_post({"UserID": "mike", "Status": "Queued"})
+
+        pages = []
+        cursor = None
+        while True:
+            result = self.utility.datarequest_search_page(
+                "john", "Queued", limit=2, cursor=cursor,
+                sort_order="ascending", fields=["RegistrationDateTime"],
+            )
+            self.assertEqual(result["total"], 5)
+            pages.append(result["items"])
+            cursor = result["next_cursor"]
+            if cursor is None:
+                break
+
+        self.assertEqual([len(page) for page in pages], [2, 2, 1])
+        dates = [item["RegistrationDateTime"] for page in pages
+                 for item in page]
+        self.assertEqual(dates, sorted(dates))
+        self.assertEqual(
+            sorted(pages[0][0].keys()), ["RegistrationDateTime", "TaskId"]
+        )
+
+        result = self.utility.datarequest_search_page("john", "Queued")
+        dates = [item["RegistrationDateTime"] for item in result["items"]]
+        self.assertEqual(dates, sorted(dates, reverse=True))
+
+    def test_datarequest_search_page_errors(self):
+        """ test datarequest_search_page with invalid parameters """
+        self.assertEqual(
+            self.utility.datarequest_search_page("", None),
+            "Error, UserID not defined",
+        )
+        self.assertEqual(
+            self.utility.datarequest_search_page("john", "INVALID"),
+            "Error, status not recognized",
+        )
+        self.assertEqual(
+            self.utility.datarequest_search_page(
+                "john", None, sort_order="random"),
+            "Error, sort_order not recognized",
+        )
+        self.assertEqual(
+            self.utility.datarequest_search_page(
+                "john", None, cursor="not-a-cursor"),
+            "Error, invalid cursor",
+        )
+
+    def test_datarequest_inspect_by_indexed_keys(self):
+        """ test inspecting tasks by FME and CDSE identifiers """
+        result = self.utility.datarequest_post(
+            {"UserID": "john", "Status": "Queued"}
+        )
+        fme_key = list(result.keys())[0]
+        self.utility.datarequest_status_patch({"FMETaskId": 123}, fme_key)
+        result = self.utility.datarequest_post({
+            "UserID": "john",
+            "Status": "Queued",
+            "CDSEBatchID": "batch-1",
+            "cdse_task_role": "child",
+            "cdse_task_group_id": "group-1",
+        })
+        cdse_key = list(result.keys())[0]
+
+        tasks = self.utility.datarequest_inspect(FMETaskID="123")
+        self.assertEqual([task["TaskId"] for task in tasks], [fme_key])
+        tasks = self.utility.datarequest_inspect(CDSEBatchID="batch-1")
+        self.assertEqual([task["TaskId"] for task in tasks], [cdse_key])
+        tasks = self.utility.datarequest_inspect(cdse_task_role="child")
+        self.assertEqual([task["TaskId"] for task in tasks], [cdse_key])
+        self.assertEqual(self.utility.datarequest_inspect(FMETaskID="1"), [])
+
+    def test_datarequest_delete_cdse_parent_removes_children(self):
+        """ cancelling a CDSE parent task removes its child tasks """
+        parent = {
+            "UserID": "john",
+            "Status": "Queued",
+            "cdse_task_role": "parent",
+            "cdse_task_group_id": "group-1",
+        }
+        parent_key = list(self.utility.datarequest_post(parent).keys())[0]
+        child_keys = []
+        for group_id in ["group-1", "group-1", "group-2"]:
+            result = self.utility.datarequest_post({
+                "UserID": "john",
+                "Status": "QUEUED",
+                "cdse_task_role": "child",
+                "cdse_task_group_id": group_id,
+            })
+            child_keys.append(list(result.keys())[0])
+
+        result = self.utility.datarequest_delete(parent_key, "john")
+
+        self.assertEqual(result["Status"], "Cancelled")
+        self.assertEqual(
+            self.utility.datarequest_status_get(child_keys[0]),
+            "Error, task not found",
+        )
+        self.assertEqual(
+            self.utility.datarequest_status_get(child_keys[1]),
+            "Error, task not found",
+        )
+        self.assertIsInstance(
+            self.utility.datarequest_status_get(child_keys[2]), dict
+        )
+        self.assertEqual(
+            self.utility.datarequest_status_get(parent_key)["Status"],
+            "Cancelled",
+        )
+
+    def test_archive_finished_tasks(self):
+        """ old finished tasks are archived and still found """
+        old_finished = {
+            "UserID": "john",
+            "Status": "Finished_ok",
+            "RegistrationDateTime": "2020-01-01T00:00:00+00:00",
+        }
+        old_key = list(self.utility.datarequest_post(old_finished).keys())[0]
+        old_queued = dict(old_finished, Status="Queued")
+        queued_key = list(self.utility.datarequest_post(old_queued).keys())[0]
+        recent = dict(old_finished)
+        del recent["RegistrationDateTime"]
+        recent_key = list(self.utility.datarequest_post(recent).keys())[0]
+
+        self.assertEqual(
+            self.utility.archive_finished_tasks(days=0),
+            "Error, days must be at least 1",
+        )
+        self.assertEqual(
+            self.utility.archive_finished_tasks(days=30), {"archived": 1}
+        )
+        tasks = self.utility.datarequest_inspect(UserID="john")
+        self.assertEqual(
+            [task["TaskId"] for task in tasks],
+            sorted([queued_key, recent_key]),
+        )
+        self.assertEqual(
+            self.utility.datarequest_status_get(old_key)["Status"],
+            "Finished_ok",
+        )
+        self.assertEqual(
+            sorted(self.utility.datarequest_search("john", "")),
+            sorted([old_key, queued_key, recent_key]),
+        )
+
+    def test_datarequest_status_wait(self):
+        """ waiting returns once the task changed """
+        result = self.utility.datarequest_post({"Status": "Queued"})
+        key = list(result.keys())[0]
+        _, version = self.utility.datarequest_status_wait(key, 0)
+
+        timer = threading.Timer(
+            0.1,
+            self.utility.datarequest_status_patch,
+            ({"Status": "In_progress"}, key),
+        )
+        timer.start()
+        task, updated_at = self.utility.datarequest_status_wait(key, 10)
+        timer.join()
+        self.assertEqual(task["Status"], "In_progress")
+        self.assertGreater(updated_at, version)
+
+        # a change after since is returned without waiting
+        task, _ = self.utility.datarequest_status_wait(key, 10, version)
+        self.assertEqual(task["Status"], "In_progress")
+        self.assertEqual(
+            self.utility.datarequest_status_wait("missing", 1),
+            "Error, task not found",
+        )
+
+    def test_datarequest_status_wait_refused(self):
+        """ requests that can not wait are told so """
+        result = self.utility.datarequest_post({"Status": "Queued"})
+        key = list(result.keys())[0]
+        with mock.patch.object(
+            utility_module, "STATUS_WAITERS", threading.BoundedSemaphore(1)
+        ) as waiters:
+            waiters.acquire()
+            self.assertEqual(
+                self.utility.datarequest_status_wait(key, 10),
+                "Error, too many waiting requests",
+            )
+
+        @contextmanager
+        def no_notifications(task_id):
+            yield None
+
+        with mock.patch.object(
+            self.utility._get_repository(), "watch_task", no_notifications
+        ):
+            self.assertEqual(
+                self.utility.datarequest_status_wait(key, 10),
+                "Error, waiting for changes is not enabled",
+            )
+            task, _ = self.utility.datarequest_status_wait(key, 0)
+        self.assertEqual(task["Status"], "Queued")
+
+    def test_datarequest_duplicated_datasets(self):
+        """ requested datasets are compared with the active ones """
+        dataset = {"DatasetID": "1", "OutputFormat": "Netcdf"}
+        other = {"DatasetID": "2", "OutputFormat": "Netcdf"}
+        self.utility.datarequest_post({
+            "UserID": "john", "Status": "Queued", "Datasets": [dataset],
+        })
+        self.utility.datarequest_post({
+            "UserID": "john", "Status": "Finished_ok", "Datasets": [other],
+        })
+        self.utility.datarequest_post({
+            "UserID": "mike", "Status": "In_progress", "Datasets": [other],
+        })
+
+        self.assertTrue(self.utility.datarequest_duplicated_datasets(
+            "john", [{"OutputFormat": "Netcdf", "DatasetID": "1"}]
+        ))
+        self.assertFalse(
+            self.utility.datarequest_duplicated_datasets("john", [other])
+        )
+        self.assertTrue(self.utility.datarequest_duplicated_datasets(
+            "john", [other, other]
+        ))
+
+    def test_datarequest_stats(self):
+        """ tasks are counted and queued tasks aged """
+        self.utility.datarequest_post({"UserID": "john", "Status": "Queued"})
+        self.utility.datarequest_post({
+            "UserID": "john",
+            "Status": "Finished_ok",
+            "RegistrationDateTime": "2020-01-01T00:00:00+00:00",
+        })
+        self.assertEqual(
+            self.utility.datarequest_stats(hours="x"),
+            "Error, hours must be a number",
+        )
+        self.assertEqual(
+            self.utility.datarequest_stats(hours=0),
+            "Error, hours must be at least 1",
+        )
+        stats = self.utility.datarequest_stats()
+        self.assertEqual(stats["by_status"], {"Queued": 1, "Finished_ok": 1})
+        self.assertEqual(stats["by_role"]["fme"], 2)
+        self.assertEqual(list(stats["by_hour"].values()), [1])
+        self.assertEqual(stats["queue_age"]["count"], 1)
+
+    def test_purge_expired_tasks(self):
+        """ tasks past the retention days of their status are deleted """
+        self.utility.datarequest_post({
+            "UserID": "john",
+            "Status": "Cancelled",
+            "RegistrationDateTime": "2020-01-01T00:00:00+00:00",
+        })
+        queued = self.utility.datarequest_post({
+            "UserID": "john",
+            "Status": "Queued",
+            "RegistrationDateTime": "2020-01-01T00:00:00+00:00",
+        })
+        self.assertEqual(
+            self.utility.purge_expired_tasks(days="Cancelled=0"),
+            "Error, retention days of Cancelled must be at least 1",
+        )
+        self.assertEqual(
+            self.utility.purge_expired_tasks(batch_size=0),
+            "Error, batch_size must be at least 1",
+        )
+        result = self.utility.purge_expired_tasks(pause=0)
+        self.assertEqual(result["deleted"]["Cancelled"], 1)
+        self.assertTrue(result["complete"])
+        self.assertEqual(
+            [task["TaskId"] for task in self.utility.datarequest_inspect(
+                UserID="john")],
+            list(queued.keys()),
+        )
+
+    def test_relay_outbox_jobs(self):
+        """ outbox jobs are published in batches """
+        job = {
+            "queue_name": "cdse_jobs",
+            "job_name": "create_cdse_batches",
+            "data": {"user_id": "john"},
+            "opts": {},
+        }
+        prepared = self.utility.outbox_prepare_jobs([job, job, job])
+        self.assertEqual(self.utility.relay_outbox_jobs(list), {
+            "published": 0, "complete": True,
+        })
+        prepared.commit()
+        self.assertEqual(
+            self.utility.relay_outbox_jobs(list, batch_size=0),
+            "Error, batch_size must be at least 1",
+        )
+        published = []
+        result = self.utility.relay_outbox_jobs(
+            published.append, batch_size=2
+        )
+        self.assertEqual(result, {"published": 3, "complete": True})
+        self.assertEqual(published, [[job, job], [job]])
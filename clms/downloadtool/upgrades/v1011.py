@@ -0,0 +1,14 @@
+""" upgrade step implementation """
+# -*- coding: utf-8 -*-
+
+from logging import getLogger
+
+from clms.downloadtool.setuphandlers import migrate_task_storage
+
+logger = getLogger(__name__)
+
+
+def upgrade(setup_tool=None):
+    """upgrade function"""
+    logger.info("Running upgrade (Python): v1011")
+    migrate_task_storage()
@@ -1,22 +1,112 @@
 # -*- coding: utf-8 -*-
 """Download tool utility with PostgreSQL-backed storage."""
-import random
-from datetime import datetime, timezone
+import base64
+import json
+from datetime import datetime, timedelta, timezone
 import os
+import threading
+import time
 from logging import getLogger
 
 from clms.downloadtool.api.services.cdse.cdse_integration import (
     clean_s3_bucket_files,
     stop_batch_ids_and_remove_s3_directory,
 )
-from clms.downloadtool.storage.db import DownloadtoolRepository
+from clms.downloadtool.asyncjobs.outbox import (
+    DEFAULT_RELAY_BATCH_SIZE,
+    relay_jobs,
+)
+from clms.downloadtool.storage import get_repository
+from clms.downloadtool.storage.cache import (
+    CachedDownloadtoolRepository,
+    cache_enabled,
+    cache_settings,
+    unwrap_repository,
+)
+from clms.downloadtool.storage.db import (
+    FINISHED_STATUSES,
+    TRANSITION_INVALID_STATUS,
+    TRANSITION_NOT_FOUND,
+    TRANSITION_PERMISSION_DENIED,
+)
+from clms.downloadtool.storage.ids import get_task_id_generator
 from clms.downloadtool.storage.memory import MemoryDownloadtoolRepository
+from clms.downloadtool.storage.metrics import (
+    InstrumentedDownloadtoolRepository,
+    metrics_enabled,
+)
+from clms.downloadtool.storage.pool import env_number
+from clms.downloadtool.storage.retention import (
+    DEFAULT_PURGE_BATCH_SIZE,
+    DEFAULT_PURGE_PAUSE,
+    purge_expired_tasks,
+    retention_days,
+)
 from clms.downloadtool.utils import STATUS_LIST
 from plone import api
 from zope.interface import Interface, implementer
 
 log = getLogger(__name__)
 
+PATCHABLE_FIELDS = (
+    "Status",
+    "DownloadURL",
+    "FileSize",
+    "FinalizationDateTime",
+    "FMETaskId",
+    "Message",
+    "cdse_errors",
+)
+
+
+SORT_ORDERS = ("ascending", "descending")
+
+# Finished tasks registered longer ago are moved to the archive
+DEFAULT_ARCHIVE_AFTER_DAYS = 90
+
+# Hours of registration counted by datarequest_stats
+DEFAULT_STATS_HOURS = 24
+
+# Each waiting status request holds a Zope worker thread, so only a few
+# may wait at once, others are told to retry later. Keep it at most half
+# of the worker threads of each instance (4 by default).
+DEFAULT_STATUS_MAX_WAITERS = 2
+STATUS_WAITERS = threading.BoundedSemaphore(
+    env_number(
+        "DOWNLOADTOOL_STATUS_MAX_WAITERS", DEFAULT_STATUS_MAX_WAITERS, int
+    )
+)
+
+
+def _encode_cursor(after):
+    """Encode a (registration_datetime, task_id) key as an opaque cursor"""
+    registered, task_id = after
+    if registered is not None:
+        registered = registered.isoformat()
+    raw = json.dumps([registered, task_id]).encode("utf-8")
+    return base64.urlsafe_b64encode(raw).decode("ascii")
+
+
+def _decode_cursor(cursor):
+    """Decode a cursor created by _encode_cursor, None when invalid"""
+    try:
+        registered, task_id = json.loads(
+            base64.urlsafe_b64decode(cursor.encode("ascii"))
+        )
+        if registered is not None:
+            registered = datetime.fromisoformat(registered)
+    except (TypeError, ValueError):
+        return None
+    return registered, str(task_id)
+
+
+def _patch_updates(data_object):
+    """Return the subset of data_object that can be patched into a task"""
+    return {
+        key: data_object[key] for key in PATCHABLE_FIELDS
+        if key in data_object
+    }
+
 
 class IDownloadToolUtility(Interface):
     """Downloadtool utility interface"""
@@ -27,6 +117,8 @@ class DownloadToolUtility:
     """Downloadtool request methods"""
 
     _repository = None
+    _task_id_generator = None
+    _metrics = None
 
     def _get_repository(self):
         """Lazy-load the database repository."""
@@ -34,32 +126,36 @@ class DownloadToolUtility:
             if os.environ.get("CLMS_DOWNLOADTOOL_TESTING") == "1":
                 self._repository = MemoryDownloadtoolRepository()
             else:
-                self._repository = DownloadtoolRepository()
+                self._repository = get_repository()
+            if metrics_enabled():
+                self._repository = InstrumentedDownloadtoolRepository(
+                    self._repository
+                )
+                self._metrics = self._repository.metrics
+            if cache_enabled():
+                self._repository = CachedDownloadtoolRepository(
+                    self._repository, **cache_settings()
+                )
         return self._repository
 
+    def _get_task_id_generator(self):
+        """Lazy-load the task id generator."""
+        if self._task_id_generator is None:
+            self._task_id_generator = get_task_id_generator()
+        return self._task_id_generator
+
     def remove_cdse_child_tasks(self, cdse_task_group_id):
         """Remove child tasks from DownloadTool"""
-        tasks = self.datarequest_inspect()
-
-        cdse_tasks = [
-            task for task in tasks if task.get(
-                'cdse_task_role', None) is not None]
-
-        child_tasks = [task for task in cdse_tasks if task.get(
-            'cdse_task_role', '') == 'child']
-        child_tasks_group = [
-            t for t in child_tasks if t[
-                'cdse_task_group_id'] == cdse_task_group_id
-        ]
-        task_ids = [t["TaskId"] for t in child_tasks_group]
-
+        if cdse_task_group_id is None:
+            return []
+        repository = self._get_repository()
         log.info("Remove child tasks for %s", cdse_task_group_id)
-        for task_id in task_ids:
-            self.datarequest_remove_task(task_id)
+        return repository.delete_tasks_by_group(
+            cdse_task_group_id, role="child"
+        )
 
-    def datarequest_post(self, data_request):
-        """register new download request"""
-        repository = self._get_repository()
+    def _prepare_request(self, data_request):
+        """Fill in the UserID and RegistrationDateTime of a new request"""
         if not data_request.get("UserID"):
             user = api.user.get_current()
             if user is not None:
@@ -68,12 +164,15 @@ class DownloadToolUtility:
             data_request["RegistrationDateTime"] = datetime.now(
                 timezone.utc
             ).isoformat()
-        task_id = None
+        return data_request
 
-        while task_id is None:
-            candidate = str(random.randint(0, 99999999999))
-            if repository.insert_task(candidate, data_request):
-                task_id = candidate
+    def datarequest_post(self, data_request):
+        """register new download request"""
+        repository = self._get_repository()
+        self._prepare_request(data_request)
+        task_id = self._get_task_id_generator().insert(
+            repository, data_request
+        )
 
         log.info("DownloadToolUtility: TASK SAVED.")
 
@@ -81,19 +180,38 @@ class DownloadToolUtility:
             log.info(data_request['cdse_task_role'])
         return {task_id: data_request}
 
+    def datarequest_post_bulk(self, data_requests):
+        """register several download requests in one transaction"""
+        repository = self._get_repository()
+        for data_request in data_requests:
+            self._prepare_request(data_request)
+        task_ids = self._get_task_id_generator().insert_bulk(
+            repository, data_requests
+        )
+
+        log.info("DownloadToolUtility: %s TASKS SAVED.", len(task_ids))
+
+        return dict(zip(task_ids, data_requests))
+
     def datarequest_delete(self, task_id, user_id):
         """cancel the download request"""
         repository = self._get_repository()
-        data_object = repository.get_task(task_id)
-        if data_object is None:
+        now_datetime = datetime.now(timezone.utc).isoformat()
+        outcome, data_object = repository.transition_task(
+            task_id,
+            FINISHED_STATUSES,
+            {"Status": "Cancelled", "FinalizationDateTime": now_datetime},
+            user_id=user_id,
+            exclude=True,
+        )
+        if outcome == TRANSITION_NOT_FOUND:
             return "Error, TaskID not registered"
 
-        if user_id not in data_object["UserID"]:
+        if outcome == TRANSITION_PERMISSION_DENIED:
             return "Error, permission denied"
 
-        data_object["Status"] = "Cancelled"
-        now_datetime = datetime.now(timezone.utc).isoformat()
-        data_object["FinalizationDateTime"] = now_datetime
+        if outcome == TRANSITION_INVALID_STATUS:
+            return "Error, task already finished"
 
         is_cdse_task = False
         already_sent = data_object.get("FMETaskId", None) is not None
@@ -114,15 +232,6 @@ class DownloadToolUtility:
             # Also remove all child tasks for this parent task
             self.remove_cdse_child_tasks(cdse_task_group_id)
 
-        repository.update_task(
-            task_id,
-            {
-                "Status": data_object["Status"],
-                "FinalizationDateTime": data_object["FinalizationDateTime"],
-            },
-            status=data_object["Status"],
-        )
-
         return data_object
 
     def datarequest_search(self, user_id, status):
@@ -148,6 +257,52 @@ class DownloadToolUtility:
 
         return data_object
 
+    def datarequest_search_page(self, user_id, status, limit=None,
+                                cursor=None, sort_order="descending",
+                                fields=None):
+        """search for download requests one page at a time
+
+        items is a list of the tasks, each one with its TaskId, in the
+        sort_order of their registration date.
+        """
+        if not user_id:
+            return "Error, UserID not defined"
+
+        if status and status not in STATUS_LIST:
+            return "Error, status not recognized"
+
+        if sort_order not in SORT_ORDERS:
+            return "Error, sort_order not recognized"
+
+        after = None
+        if cursor:
+            after = _decode_cursor(cursor)
+            if after is None:
+                return "Error, invalid cursor"
+
+        repository = self._get_repository()
+        rows, next_after, total = repository.search_tasks_page(
+            user_id,
+            status=status or None,
+            limit=limit,
+            after=after,
+            descending=sort_order == "descending",
+            fields=fields,
+        )
+        return {
+            "items": [
+                dict(values, TaskId=task_id) for task_id, values in rows
+            ],
+            "total": total,
+            "next_cursor": _encode_cursor(next_after) if next_after else None,
+        }
+
+    def datarequest_duplicated_datasets(self, user_id, datasets):
+        """check if the datasets repeat any dataset of the user's queued
+        and in progress requests, or one another"""
+        repository = self._get_repository()
+        return repository.has_duplicate_datasets(user_id, datasets)
+
     def datarequest_status_get(self, task_id):
         """get a given download task's information"""
         repository = self._get_repository()
@@ -156,88 +311,108 @@ class DownloadToolUtility:
             return "Error, task not found"
         return task
 
+    def datarequest_status_wait(self, task_id, timeout, since=None):
+        """get a given download task's information, waiting up to timeout
+        seconds for a change after since (by default, the current version).
+        Returns a (task, updated_at) tuple, or an error when every waiter
+        is busy or task changes are not notified"""
+        repository = self._get_repository()
+        if timeout <= 0:
+            row = repository.get_task_with_version(task_id)
+            return row if row is not None else "Error, task not found"
+
+        deadline = time.monotonic() + timeout
+        if not STATUS_WAITERS.acquire(blocking=False):
+            return "Error, too many waiting requests"
+        try:
+            with repository.watch_task(task_id) as changed:
+                if changed is None:
+                    return "Error, waiting for changes is not enabled"
+                row = repository.get_task_with_version(task_id)
+                if row is None:
+                    return "Error, task not found"
+                task, updated_at = row
+                if since is None:
+                    since = updated_at
+                while True:
+                    if task.get("Status") in FINISHED_STATUSES:
+                        break
+                    if updated_at is not None and updated_at > since:
+                        break
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0 or not changed.wait(remaining):
+                        break
+                    changed.clear()
+                    row = repository.get_task_with_version(task_id)
+                    if row is None:
+                        return "Error, task not found"
+                    task, updated_at = row
+                return task, updated_at
+        finally:
+            STATUS_WAITERS.release()
+
     def datarequest_status_patch(self, data_object, task_id):
         """modify a given download task's information"""
         repository = self._get_repository()
-        registry_item = repository.get_task(task_id)
-        if registry_item is None:
-            return "Error, task_id not registered"
-
-        updates = {}
-
-        if "Status" in data_object:
-            updates["Status"] = data_object["Status"]
-        if "DownloadURL" in data_object:
-            updates["DownloadURL"] = data_object["DownloadURL"]
-        if "FileSize" in data_object:
-            updates["FileSize"] = data_object["FileSize"]
-        if "FinalizationDateTime" in data_object:
-            updates["FinalizationDateTime"] = data_object[
-                "FinalizationDateTime"
-            ]
-        if "FMETaskId" in data_object:
-            updates["FMETaskId"] = data_object["FMETaskId"]
-        if "Message" in data_object:
-            updates["Message"] = data_object["Message"]
-        if "cdse_errors" in data_object:
-            updates["cdse_errors"] = data_object["cdse_errors"]
+        updates = _patch_updates(data_object)
 
         if not updates:
+            registry_item = repository.get_task(task_id)
+            if registry_item is None:
+                return "Error, task_id not registered"
             return registry_item
 
-        updated_item = repository.update_task(
-            task_id, updates, status=updates.get("Status")
+        # A finished task keeps its status, late callbacks can not move it
+        expected_statuses = None
+        if "Status" in updates:
+            expected_statuses = [
+                status for status in FINISHED_STATUSES
+                if status != updates["Status"]
+            ]
+        outcome, updated_item = repository.transition_task(
+            task_id, expected_statuses, updates, exclude=True
         )
-        return updated_item if updated_item is not None else registry_item
+        if outcome == TRANSITION_NOT_FOUND:
+            return "Error, task_id not registered"
+
+        if outcome == TRANSITION_INVALID_STATUS:
+            return "Error, task already finished"
+
+        return updated_item
 
     def datarequest_status_patch_multiple(self, updates):
         """modify multiple download tasks' information"""
         if not isinstance(updates, dict):
             return "Error, invalid payload"
 
-        updated_items = {}
         errors = {}
-        repository = self._get_repository()
+        invalid = set()
+        bulk_updates = {}
 
         for task_id, data_object in updates.items():
             task_key = str(task_id)
-            registry_item = repository.get_task(task_key)
-            if registry_item is None:
-                errors[task_key] = "Error, task_id not registered"
-                continue
-
             if not isinstance(data_object, dict):
+                invalid.add(task_key)
+                data_object = {}
+            bulk_updates[task_key] = _patch_updates(data_object)
+
+        repository = self._get_repository()
+        updated, missing, finished = repository.update_tasks_bulk(
+            bulk_updates
+        )
+
+        missing = set(missing)
+        finished = set(finished)
+        updated_items = {}
+        for task_key in bulk_updates:
+            if task_key in missing:
+                errors[task_key] = "Error, task_id not registered"
+            elif task_key in finished:
+                errors[task_key] = "Error, task already finished"
+            elif task_key in invalid:
                 errors[task_key] = "Error, invalid data_object"
-                continue
-
-            task_updates = {}
-
-            if "Status" in data_object:
-                task_updates["Status"] = data_object["Status"]
-            if "DownloadURL" in data_object:
-                task_updates["DownloadURL"] = data_object["DownloadURL"]
-            if "FileSize" in data_object:
-                task_updates["FileSize"] = data_object["FileSize"]
-            if "FinalizationDateTime" in data_object:
-                task_updates["FinalizationDateTime"] = data_object[
-                    "FinalizationDateTime"
-                ]
-            if "FMETaskId" in data_object:
-                task_updates["FMETaskId"] = data_object["FMETaskId"]
-            if "Message" in data_object:
-                task_updates["Message"] = data_object["Message"]
-            if "cdse_errors" in data_object:
-                task_updates["cdse_errors"] = data_object["cdse_errors"]
-
-            if task_updates:
-                updated_item = repository.update_task(
-                    task_key, task_updates, status=task_updates.get("Status")
-                )
-                updated_items[task_key] = (
-                    updated_item if updated_item is not None else registry_item
-                )
             else:
-                updated_items[task_key] = registry_item
+                updated_items[task_key] = updated[task_key]
 
         if errors:
             return {"updated": updated_items, "errors": errors}
@@ -253,6 +428,109 @@ class DownloadToolUtility:
         repository.delete_all()
         return {}
 
+    def archive_finished_tasks(self, days=None):
+        """Move finished tasks registered days ago to the archive"""
+        if days is None:
+            days = os.environ.get(
+                "DOWNLOADTOOL_ARCHIVE_AFTER_DAYS", DEFAULT_ARCHIVE_AFTER_DAYS
+            )
+        try:
+            days = int(days)
+        except (TypeError, ValueError):
+            return "Error, days must be a number"
+        if days < 1:
+            return "Error, days must be at least 1"
+
+        repository = self._get_repository()
+        older_than = datetime.now(timezone.utc) - timedelta(days=days)
+        archived = repository.archive_finished_tasks(older_than)
+        log.info("Archived %s finished tasks", archived)
+        return {"archived": archived}
+
+    def purge_expired_tasks(self, days=None, batch_size=None, pause=None,
+                            max_seconds=None):
+        """Delete tasks past the retention days of their status"""
+        try:
+            days = retention_days(days)
+        except ValueError as e:
+            return "Error, {0}".format(e)
+        try:
+            batch_size = int(
+                DEFAULT_PURGE_BATCH_SIZE if batch_size is None else batch_size
+            )
+            pause = float(DEFAULT_PURGE_PAUSE if pause is None else pause)
+            if max_seconds is not None:
+                max_seconds = float(max_seconds)
+        except (TypeError, ValueError):
+            return "Error, batch_size, pause and max_seconds must be numbers"
+        if batch_size < 1:
+            return "Error, batch_size must be at least 1"
+
+        repository = self._get_repository()
+        result = purge_expired_tasks(
+            repository,
+            days,
+            batch_size=batch_size,
+            pause=pause,
+            max_seconds=max_seconds,
+        )
+        log.info("Purged %s expired tasks", result["total"])
+        return result
+
+    def outbox_prepare_jobs(self, jobs):
+        """Store async jobs in the outbox without committing them.
+
+        Returns a PreparedOutboxJobs to commit or roll back with the
+        transaction, errors are raised.
+        """
+        repository = self._get_repository()
+        return repository.prepare_outbox_jobs(jobs)
+
+    def relay_outbox_jobs(self, publish, batch_size=None, max_seconds=None):
+        """Publish the outbox jobs with publish, in batches"""
+        try:
+            batch_size = int(
+                DEFAULT_RELAY_BATCH_SIZE if batch_size is None else batch_size
+            )
+            if max_seconds is not None:
+                max_seconds = float(max_seconds)
+        except (TypeError, ValueError):
+            return "Error, batch_size and max_seconds must be numbers"
+        if batch_size < 1:
+            return "Error, batch_size must be at least 1"
+
+        repository = self._get_repository()
+        return relay_jobs(
+            repository, publish, batch_size=batch_size, max_seconds=max_seconds
+        )
+
+    def datarequest_stats(self, hours=None):
+        """Return task counts and queue age percentiles.
+
+        Registrations are counted per hour for the last hours only.
+        """
+        if hours is None:
+            hours = DEFAULT_STATS_HOURS
+        try:
+            hours = int(hours)
+        except (TypeError, ValueError):
+            return "Error, hours must be a number"
+        if hours < 1:
+            return "Error, hours must be at least 1"
+
+        repository = self._get_repository()
+        since = datetime.now(timezone.utc) - timedelta(hours=hours)
+        return repository.task_stats(since=since)
+
+    def repository_metrics(self):
+        """Return the repository metrics in the Prometheus text format"""
+        repository = self._get_repository()
+        if self._metrics is None:
+            return "Error, repository metrics are disabled"
+
+        pool_stats = getattr(unwrap_repository(repository), "pool_stats", None)
+        return self._metrics.render(pool_stats() if pool_stats else None)
+
     def datarequest_remove_task(self, task_id):
         """Remove all data about the given task"""
         repository = self._get_repository()
@@ -263,6 +541,10 @@ class DownloadToolUtility:
 
     def datarequest_inspect(self, **query):
         """inspect the queries according to the query"""
+        return list(self.datarequest_inspect_iter(**query))
+
+    def datarequest_inspect_iter(self, **query):
+        """inspect the queries according to the query, one task at a time"""
         repository = self._get_repository()
 
         if "TaskID" in query:
@@ -270,14 +552,10 @@ class DownloadToolUtility:
             task = repository.get_task(task_id)
             if task is not None:
                 task.update({"TaskId": task_id})
-                return [task]
+                yield task
+            return
 
-            return []
-
-        rows = repository.inspect_tasks(query if query else None)
-        data_objects = []
+        rows = repository.iter_inspect_tasks(query if query else None)
         for key, db_value in rows:
             db_value.update({"TaskId": key})
-            data_objects.append(db_value)
-
-        return data_objects
+            yield db_value
@@ -77,11 +77,17 @@ setup(
             "plone.app.robotframework",
             "plone.restapi[test]",
         ],
+        "async": [
+            "asyncpg",
+        ],
     },
     entry_points="""
     [z3c.autoinclude.plugin]
     target = plone
     [console_scripts]
     update_locale = clms.downloadtool.locales.update:update_locale
+    downloadtool_benchmark = clms.downloadtool.storage.benchmark:main
+    downloadtool_purge = clms.downloadtool.storage.retention:main
+    downloadtool_outbox_relay = clms.downloadtool.asyncjobs.outbox:main
     """,
 )